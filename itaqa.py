@@ -7,23 +7,28 @@ ITaly Air Quality Aggregator
 Entrypoint of the project, using this script:
 - Download AQS lists for multiple regions
 - Update AQS lists with the most recent data
+- Export the plots of AQS lists to HTML or image files
 - Run unit tests
 """
 
 import ipdb
 import logging
 import os
-import pandas as pd
 import pytest
 import sys
+import time
+import traceback
 
 from argparse import ArgumentParser, RawTextHelpFormatter, SUPPRESS
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
 
 from itaqa.core.AirQualityStationCollection import AirQualityStationCollection
-from itaqa.crawler.defs import REGION_CRAWLERS
+from itaqa.crawler.defs import CRAWLER_RANGES, CRAWLER_REGIONS, REGION_CRAWLERS
+from itaqa.utils import AQSC_utils, serialization_utils
 from itaqa.utils.pandas_utils import print_full
+from itaqa.visualization import export
 from itaqa.gui.AQS_viewer import start_GUI
 
 # Setup logging
@@ -37,28 +42,114 @@ logger = logging.getLogger(__name__)
 logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
 
 
-def download_AQS(region, min_date, max_date, filename, redownload):
+def download_AQS(region, min_date, max_date, filename, redownload, rollups=False):
     """
     Download mode
 
-    Given a region and a time range, download the AQS list and store it locally
+    Given a region and a time range, download the AQS list and store it locally (with its rollups, if rollups)
     """
     get_AQSC = REGION_CRAWLERS[region]
     AQSC = get_AQSC(dt_range=[min_date, max_date], redownload=redownload)
-    AQSC.save(f'dump/{region}/{filename}')
+    os.makedirs(f'dump/{region}', exist_ok=True)
+    AQSC.save(f'dump/{region}/{filename}', rollups=rollups)
     logger.info(f"Download completed! Saved in 'dump/{region}/{filename}'")
 
 
+def download_regions(regions, min_date, max_date, filenames, redownload, workers=None, rollups=False):
+    """
+    Download mode (multiple regions)
+
+    Run the download of each region concurrently in a process pool, each one saving its AQSC in dump/REGION/
+    A failing region does not abort the others: timings and failures are reported at the end
+    Return the list of failed regions
+    """
+    outcomes = {}
+    with ProcessPoolExecutor(max_workers=workers or len(regions)) as executor:
+        futures = {}
+        for region in regions:
+            future = executor.submit(timed_download_AQS, region, min_date, max_date, filenames[region], redownload,
+                                     rollups)
+            futures[future] = region
+        for future in as_completed(futures):
+            outcomes[futures[future]] = future.result()
+
+    logger.info("Download summary:")
+    failed_regions = []
+    for region in regions:
+        elapsed, error = outcomes[region]
+        if error:
+            failed_regions.append(region)
+            logger.error(f"  {region:20} FAILED after {elapsed:.1f}s: {error}")
+        else:
+            logger.info(f"  {region:20} completed in {elapsed:.1f}s ('dump/{region}/{filenames[region]}')")
+    return failed_regions
+
+
+def timed_download_AQS(region, min_date, max_date, filename, redownload, rollups=False):
+    """Run download_AQS, return the elapsed time and the error message (None if successful)"""
+    start = time.perf_counter()
+    try:
+        download_AQS(region, min_date, max_date, filename, redownload, rollups)
+    except Exception as err:
+        logger.error(f"Download of {region} failed\n{traceback.format_exc()}")
+        return time.perf_counter() - start, repr(err)
+    return time.perf_counter() - start, None
+
+
 def update_AQS(file_path, overwrite=False):
     """
     Update mode
 
-    Given an existing AQS list, update it with the latest data, or given 2 lists, merge them
+    Given an existing AQS list, download only the data newer than the last entry of each station and append it
+    If overwrite, the new data is appended in place as new segments (see the compact mode), otherwise the whole
+    updated AQSC is written in a new file of the same folder
+    """
+    AQSC = AirQualityStationCollection(file_path=file_path, lazy=True)
+    regions = {AQS.region for AQS in AQSC}
+    crawler_regions = [kk for kk, vv in CRAWLER_REGIONS.items() if vv in regions]
+    if len(regions) != 1 or len(crawler_regions) != 1:
+        raise ValueError(f"Cannot determine the crawler to use for the AQSC regions ({regions})")
+    region = crawler_regions[0]
+    logger.info(f"Updating {region} data")
+    new_file_path, appended_rows = AQSC_utils.update_AQSC_file(AQSC,
+                                                               file_path,
+                                                               REGION_CRAWLERS[region],
+                                                               overwrite,
+                                                               available_range=CRAWLER_RANGES.get(region))
+    if new_file_path is None:
+        logger.info(f"No new data available for {region}, '{file_path}' not updated")
+    else:
+        logger.info(f"Update completed! Appended {appended_rows} entries, saved in '{new_file_path}'")
+
+
+def compact_AQSC(file_path):
+    """
+    Compact mode
+
+    Rewrite an AQSC file merging the segments appended by the updates (one segment per station)
+    Can run in background: if the file is modified meanwhile, it's left untouched
+    """
+    if serialization_utils.compact_AQSC_file(file_path):
+        logger.info(f"Compaction completed! ('{file_path}')")
+    else:
+        logger.warning(f"'{file_path}' was modified during the compaction, not compacted")
+
+
+def export_plots(file_path, out_dir, fmt, mode, workers=None, stations=None):
+    """
+    Export mode
+
+    Render the plots of every station of an AQSC (or only of the specified ones) to files in out_dir, in parallel
+    Return the list of the stations whose export failed
     """
-    print("TODO")
-    # TODO: Given the filename determine the region
-    # Load msgpack, check last entry date, download complementary AQS list and merge them
-    # Save the new list (if specified, overwrite the old file)
+    start = time.perf_counter()
+    outcomes = export.export_AQSC_file(file_path, out_dir, fmt, mode, workers, stations)
+    failed = [uuid for uuid, (_, error) in outcomes.items() if error]
+    for uuid in failed:
+        logger.error(f"  {uuid} FAILED: {outcomes[uuid][1]}")
+    logger.info(f"Export completed in {time.perf_counter() - start:.1f}s! "
+                f"{len(outcomes) - len(failed)}/{len(outcomes)} plots saved in '{out_dir}'")
+    return failed
 
 
 def run_tests():
@@ -97,7 +188,9 @@ if __name__ == "__main__":
     desc += "From here you can perform data download, update, visualization, you can\n"
     desc += "run unit tests or play around in the sandbox section\n\n"
     epilog = "For help on a specific command, run: 'python3 itaqa.py <COMMAND> -h'\n\n"
-    epilog += "Sample usage:\n'python3 itaqa.py download --region lombardia --min_date 20200101 --filename test'"
+    epilog += "Sample usage:\n'python3 itaqa.py download --region lombardia --min_date 20200101 --filename test'\n"
+    epilog += "'python3 itaqa.py download --region all --min_date 20200101'\n"
+    epilog += "'python3 itaqa.py export --file dump/lombardia/AQSC.msgpack --format html'"
     parser = ArgumentParser(description=desc, usage=SUPPRESS, formatter_class=RawTextHelpFormatter, epilog=epilog)
     parser._action_groups.pop()
     parser._action_groups[0].title = "Available modes"
@@ -109,11 +202,18 @@ if __name__ == "__main__":
     dl_parser._action_groups.pop()
     dl_required = dl_parser.add_argument_group("required arguments")
     dl_optional = dl_parser.add_argument_group("optional arguments")
-    dl_required.add_argument('--region', required=True, help="Region of Italy")
+    dl_required.add_argument('--region',
+                             required=True,
+                             nargs='+',
+                             help="Region(s) of Italy (space or comma separated, 'all' for every region)")
     dl_required.add_argument('--min_date', required=True, help="Minimum download date (YYYYMMDD)")
     dl_optional.add_argument('--max_date', help="Maximum download date (YYYYMMDD, default=today)")
     dl_optional.add_argument('--filename', help="Output file name (default=autogenerated)")
     dl_optional.add_argument('--redownload', default=False, help="Force the redownload of fresh tables")
+    dl_optional.add_argument('--workers', type=int, help="Regions downloaded in parallel (default=all at once)")
+    dl_optional.add_argument('--rollups',
+                             action='store_true',
+                             help="Store also daily, weekly, monthly aggregates of the data (faster analysis)")
 
     # Mode: update
     up_parser = subparsers.add_parser('update', help='Update existing AQS collection with new data')
@@ -123,6 +223,31 @@ if __name__ == "__main__":
     up_required.add_argument('--file', help="Specify a file containing an AQSC to update")
     up_optional.add_argument('--overwrite', default=False, help="Overwrite the original file after the update")
 
+    # Mode: compact
+    cp_parser = subparsers.add_parser('compact', help='Compact an AQSC file updated in place (merge its segments)')
+    cp_parser.set_defaults(mode='compact')
+    cp_required = cp_parser.add_argument_group("required arguments")
+    cp_required.add_argument('--file', required=True, help="Specify a file containing an AQSC to compact")
+
+    # Mode: export
+    ex_parser = subparsers.add_parser('export', help='Export the plots of the stations of an AQSC to HTML/image files')
+    ex_parser.set_defaults(mode='export')
+    ex_parser._action_groups.pop()
+    ex_required = ex_parser.add_argument_group("required arguments")
+    ex_optional = ex_parser.add_argument_group("optional arguments")
+    ex_required.add_argument('--file', required=True, help="Specify a file containing an AQSC to export")
+    ex_optional.add_argument('--format',
+                             default='html',
+                             choices=export.EXPORT_FORMATS,
+                             help="Output format (default=html, images require kaleido)")
+    ex_optional.add_argument('--output', help="Output folder (default=export/FILENAME/)")
+    ex_optional.add_argument('--plot',
+                             default='multiple',
+                             choices=['single', 'multiple'],
+                             help="Pollutants in a single plot or in subplots (default=multiple)")
+    ex_optional.add_argument('--stations', nargs='+', help="Names of the stations to export (default=all)")
+    ex_optional.add_argument('--workers', type=int, help="Plots rendered in parallel (default=CPU count)")
+
     # Mode: view
     pl_parser = subparsers.add_parser('view', help='Enter interactive GUI mode to view and plot AQS data')
     pl_parser.set_defaults(mode='view')
@@ -145,9 +270,14 @@ if __name__ == "__main__":
     # Validate region and dates, if they are used
     dt_now = datetime.now()
     if parameters.mode == 'download':
-        if parameters.region not in REGION_CRAWLERS:
-            raise ValueError(f"Invalid region or not implemented yet ({parameters.region})")
-            sys.exit(1)
+        regions = [rr for region in parameters.region for rr in region.split(',') if rr]
+        if 'all' in regions:
+            # 'all' includes every region, also if listed along with others
+            regions = list(REGION_CRAWLERS)
+        for region in regions:
+            if region not in REGION_CRAWLERS:
+                dl_parser.error(f"Invalid region or not implemented yet ({region})")
+        regions = list(dict.fromkeys(regions))
         try:
             min_date = datetime.strptime(parameters.min_date, '%Y%m%d')
         except ValueError:
@@ -168,14 +298,19 @@ if __name__ == "__main__":
             # TODO: Fix undesired behavior (if --redownload=False, still treated as True)
             logger.info("(No redownload flag set, will use latest downloaded data, may be outdated)")
         # yapf: disable
-        filename = ''.join([
+        filenames = {region: ''.join([
             dt_now.strftime('%Y%m%d%H%M%S_'),
             min_date.strftime('m%y%m%d_'),
             max_date.strftime('M%y%m%d_'),
-            f'{parameters.region}_{filename}.msgpack'
-        ])
+            f'{region}_{filename}.msgpack'
+        ]) for region in regions}
         # yapf: enable
-        download_AQS(parameters.region, min_date, max_date, filename, parameters.redownload)
+        if len(regions) == 1:
+            download_AQS(regions[0], min_date, max_date, filenames[regions[0]], parameters.redownload,
+                         parameters.rollups)
+        elif download_regions(regions, min_date, max_date, filenames, parameters.redownload, parameters.workers,
+                              parameters.rollups):
+            sys.exit(1)
 
     elif parameters.mode == 'update':
         if Path(parameters.file).exists():
@@ -183,6 +318,20 @@ if __name__ == "__main__":
         else:
             raise FileNotFoundError("The specified file doesn't exist")
 
+    elif parameters.mode == 'compact':
+        if Path(parameters.file).exists():
+            compact_AQSC(file_path=parameters.file)
+        else:
+            raise FileNotFoundError("The specified file doesn't exist")
+
+    elif parameters.mode == 'export':
+        if not Path(parameters.file).exists():
+            raise FileNotFoundError("The specified file doesn't exist")
+        out_dir = parameters.output or Path('export') / Path(parameters.file).stem
+        if export_plots(parameters.file, out_dir, parameters.format, parameters.plot, parameters.workers,
+                        parameters.stations):
+            sys.exit(1)
+
     elif parameters.mode == 'view':
         # TODO: Support file as parameter
         start_GUI()
@@ -6,14 +6,19 @@ Class AirQualityStation
 
 import json
 import pandas as pd
+import threading
 import uuid
 
-from copy import deepcopy
-from datetime import datetime
-
 from itaqa.geography import Italy
+from itaqa.utils import aggregation_utils
+from itaqa.utils.pandas_utils import decode_df_columns, encode_df_columns
 from itaqa.visualization import plotting
 
+# Version of the msgpack representation produced by AirQualityStation.encode_AQS_msgpack
+# 1: DataFrame dumped as JSON string, Unix time timestamps
+# 2: DataFrame stored as contiguous typed column buffers (see pandas_utils.encode_df_columns)
+SERIALIZATION_VERSION = 2
+
 
 class AirQualityStation():
     """
@@ -29,7 +34,7 @@ class AirQualityStation():
         comune (str): Comune in which the station is located
         geolocation (list): Geographic coordinates (lat, lng, alt)
         metadata(dict): Information on station, data, and uuid
-        data(pandas.DataFrame): Air pollution data of the station
+        data(pandas.DataFrame): Air pollution data of the station (decoded on first access if lazily loaded)
 
     Examples:
         AirQualityStation('Mount Doom')
@@ -42,6 +47,13 @@ class AirQualityStation():
         self.geolocation = None
         self.metadata = {'uuid': str(uuid.uuid4())}
         self._data = pd.DataFrame()
+        self._data_loader = None
+        self._data_lock = None
+        self._data_summary = None
+        self._column_views = None
+        self._data_version = 0
+        self._rollups = dict()
+        self._rollup_loaders = dict()
 
     def __repr__(self):
         return f"AirQualityStation('{self.name}')"
@@ -51,8 +63,8 @@ class AirQualityStation():
         ret += f"AirQualityStation\n\nName:\t\t{self.name:20}\n"
         ret += f"Location:\t{self.comune}, {self.province}, {self.region}\n"
         ret += f"Geolocation:\t{self.geolocation}\n"
-        ret += f"Data shape:\t{self.data.shape}\n"
-        ret += f"Pollutants:\t{', '.join(map(str, [pl for pl in self.data.columns.to_list() if pl != 'Timestamp']))}\n"
+        ret += f"Data shape:\t{(self.entries, len(self.pollutants) + 1)}\n"
+        ret += f"Pollutants:\t{', '.join(map(str, self.pollutants))}\n"
         ret += f"{90*'-'}"
         return ret
 
@@ -62,6 +74,13 @@ class AirQualityStation():
     @property
     def data(self):
         """Data property"""
+        loader = self._data_loader
+        if loader is not None:
+            with self._data_lock:
+                # Another thread may have decoded the data meanwhile
+                if self._data_loader is loader:
+                    self._data = loader()
+                    self._data_loader = None
         return self._data
 
     @data.setter
@@ -69,6 +88,140 @@ class AirQualityStation():
         """Data setter"""
         # TODO: Check if provided data is a valid pandas df with a Timestamp column
         self._data = value
+        self._data_loader = None
+        self._data_summary = None
+        self._column_views = None
+        self._rollup_loaders = dict()
+        self._data_version += 1
+
+    @property
+    def data_version(self):
+        """Counter incremented at each assignment of data (in-place changes of the DataFrame are not tracked)"""
+        return self._data_version
+
+    @property
+    def is_loaded(self):
+        """False if the data is still to be decoded (lazy loading)"""
+        return self._data_loader is None
+
+    @property
+    def pollutants(self):
+        """List of the pollutants stored in data (available without decoding data)"""
+        if not self.is_loaded:
+            return list(self._data_summary['pollutants'])
+        return [pl for pl in self._data.columns.to_list() if pl != 'Timestamp']
+
+    @property
+    def entries(self):
+        """Amount of rows stored in data (available without decoding data, if in the summary of lazy data)"""
+        if not self.is_loaded and 'rows' in self._data_summary:
+            return self._data_summary['rows']
+        return self.data.shape[0]
+
+    @property
+    def time_range(self):
+        """First and last Timestamp stored in data (available without decoding data, if in the summary of lazy data)"""
+        if not self.is_loaded and 'min_ts' in self._data_summary:
+            return pd.Timestamp(self._data_summary['min_ts']), pd.Timestamp(self._data_summary['max_ts'])
+        if self.data.empty:
+            return pd.NaT, pd.NaT
+        ts = pd.to_datetime(self.data['Timestamp'])
+        return ts.min(), ts.max()
+
+    def get_column(self, name):
+        """
+        Return a data column as a NumPy array
+
+        If the AQS was loaded from a memory-mapped file, this is a read-only zero-copy view over the file (the
+        data is not decoded), otherwise the column of data is returned
+        """
+        if self._column_views is not None:
+            return self._column_views[name]
+        return self.data[name].to_numpy()
+
+    def get_columns(self):
+        """Return a dict with all the data columns as NumPy arrays (see get_column)"""
+        if self._column_views is not None:
+            return dict(self._column_views)
+        return {name: self.get_column(name) for name in self.data.columns}
+
+    def aggregate(self, metric, **params):
+        """
+        Compute an aggregation metric on all the pollutants at once (see aggregation_utils.METRICS)
+
+        Examples:
+            AQS.aggregate('resample', freq='monthly', stat='mean')
+            AQS.aggregate('exceedances', freq='monthly')
+        """
+        freq, stat = params.get('freq', 'daily'), params.get('stat', 'mean')
+        if metric == 'resample' and stat in aggregation_utils.ROLLUP_STATS and self.has_rollup(freq):
+            return aggregation_utils.resample_from_rollup(self.get_rollup(freq), stat, params.get('min_count'))
+        return aggregation_utils.aggregate(self.get_series(), metric, **params)
+
+    def get_series(self):
+        """Return the numeric pollutants of data indexed by Timestamp (sorted)"""
+        df = self.data.set_index(pd.to_datetime(self.data['Timestamp'])).drop(columns='Timestamp')
+        if not df.index.is_monotonic_increasing:
+            df = df.sort_index()
+        return df.select_dtypes('number')
+
+    def has_rollup(self, freq):
+        """
+        True if the rollup of freq is available without computing it from data (stored in the file, derivable from a
+        stored one of a finer frequency or already computed)
+        """
+        return self._get_rollup_source(freq) is not None
+
+    def _get_rollup_source(self, freq):
+        """Return the frequency of the available rollup the one of freq is obtained from (None if not available)"""
+        for source in aggregation_utils.get_rollup_sources(freq):
+            if source in self._rollup_loaders:
+                return source
+            if source in self._rollups and self._rollups[source][0] == self._data_version:
+                return source
+        return None
+
+    def get_rollup(self, freq):
+        """
+        Return count, min, max, mean, sum of each pollutant for each period of freq (see aggregation_utils.get_rollup)
+
+        Rollups stored in the AQSC file are read instead of being computed from data, coarser ones are derived from
+        them (e.g. monthly from daily, see aggregation_utils.ROLLUP_SOURCES)
+        """
+        source = self._get_rollup_source(freq)
+        if source is None:
+            self._rollups[freq] = (self._data_version, aggregation_utils.get_rollup(self.get_series(), freq))
+            return self._rollups[freq][1]
+        if source in self._rollup_loaders:
+            rollup = self._rollup_loaders.pop(source)()
+            pollutants = [pl for pl in rollup.columns.get_level_values(0).unique() if pl in self.pollutants]
+            self._rollups[source] = (self._data_version, rollup[pollutants])
+        if source != freq:
+            self._rollups[freq] = (self._data_version, aggregation_utils.coarsen_rollup(self._rollups[source][1], freq))
+        return self._rollups[freq][1]
+
+    def set_rollup_loader(self, freq, loader):
+        """Set the function (with no arguments) returning the rollup of freq stored in a file (see get_rollup)"""
+        self._rollup_loaders[freq] = loader
+
+    def set_column_views(self, column_views):
+        """Set the views over a memory-mapped file backing the data columns (see get_column)"""
+        self._column_views = column_views
+
+    def set_lazy_data(self, loader, summary):
+        """
+        Defer the decoding of data until its first access
+
+        Args:
+            loader (callable): Function with no arguments returning the data DataFrame
+            summary (dict): Content of data known in advance ('pollutants', 'rows', 'min_ts', 'max_ts'); if rows or the
+                            time range are missing, accessing them decodes data
+        """
+        self._data = None
+        # Serializes the decoding, which can be requested by multiple threads (e.g. the GUI loader)
+        self._data_lock = threading.Lock()
+        self._data_loader = loader
+        self._data_summary = summary
 
     @property
     def uuid(self):
@@ -89,47 +242,51 @@ class AirQualityStation():
         # TODO: Make this a named tuple
         self.geolocation = [lat, lng, alt]
 
-    def plot(self, mode='multiple', pollutant=None):
-        """Call visualization functions and create plotly graphs"""
+    def plot(self, mode='multiple', pollutant=None, **kwargs):
+        """Call visualization functions and create plotly graphs (kwargs: n_points, method, widget, freq)"""
         if mode == 'single':
-            plotting.AQS_plot(self, pollutant)
+            return plotting.AQS_plot(self, pollutant, **kwargs)
         if mode == 'multiple':
-            plotting.AQS_multiplot(self)
+            return plotting.AQS_multiplot(self, **kwargs)
 
     @staticmethod
     def encode_AQS_msgpack(AQS):
         """Encoder from AQS to msgpack"""
         if isinstance(AQS, AirQualityStation):
-            # Convert pd.Timestamp to Unix time (ensure original object is not affected)
-            data_copy = deepcopy(AQS.data)
-            data_copy['Timestamp'] = data_copy['Timestamp'].map(lambda dt: int((pd.Timestamp(dt)).value / (10**9)))
             return {
                 '__AirQualityStation__': True,
+                'm_version': SERIALIZATION_VERSION,
                 'm_name': AQS.name,
                 'm_region': AQS.region.value,
                 'm_province': AQS.province.value,
                 'm_comune': AQS.comune,
                 'm_geolocation': AQS.geolocation,
                 'm_metadata': json.dumps(AQS.metadata),
-                'm_data': json.dumps(data_copy.to_dict())
+                'm_data': encode_df_columns(AQS.data)
             }
         else:
             return None
 
     @staticmethod
     def decode_AQS_msgpack(obj):
-        """Decoder from msgpack to AQS"""
-        AQS = None
-        if '__AirQualityStation__' in obj:
-            AQS = AirQualityStation(obj['m_name'])
-            AQS.region = Italy.Region(obj['m_region'])
-            AQS.province = Italy.Province(obj['m_province'])
-            AQS.comune = obj['m_comune']
-            AQS.geolocation = obj['m_geolocation']
-            AQS.metadata = json.loads(obj['m_metadata'])
-            # Not proud of this, I will think about it later
-            df = pd.DataFrame.from_dict(json.loads(obj['m_data']))
-            # Convert Unix time to pd.Timestamp
-            df['Timestamp'] = df['Timestamp'].map(lambda unix_time: pd.Timestamp(unix_time * (10**9)))
-            AQS.data = df
+        """Decoder from msgpack to AQS (objects that are not an AQS are returned untouched)"""
+        if '__AirQualityStation__' not in obj:
+            return obj
+        AQS = AirQualityStation(obj['m_name'])
+        AQS.region = Italy.Region(obj['m_region'])
+        AQS.province = Italy.Province(obj['m_province'])
+        AQS.comune = obj['m_comune']
+        AQS.geolocation = obj['m_geolocation']
+        AQS.metadata = json.loads(obj['m_metadata'])
+        if obj.get('m_version', 1) >= 2:
+            AQS.data = decode_df_columns(obj['m_data'])
+        else:
+            AQS.data = decode_legacy_data(obj['m_data'])
         return AQS
+
+
+def decode_legacy_data(m_data):
+    """Decode the data of an AQS serialized with the first format (JSON dump of the df, Unix time)"""
+    df = pd.DataFrame.from_dict(json.loads(m_data))
+    df['Timestamp'] = pd.to_datetime(df['Timestamp'], unit='s')
+    return df
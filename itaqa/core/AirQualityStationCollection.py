@@ -6,6 +6,8 @@ Class AirQualityStationCollection
 
 import json
 import msgpack
+import numpy as np
+import pandas as pd
 import warnings
 
 from pathlib import Path
@@ -13,6 +15,12 @@ from rich.console import Console
 from rich.table import Table
 
 from itaqa.core.AirQualityStation import AirQualityStation
+from itaqa.core.NameIndex import NameIndex
+from itaqa.core.defs import Pollutant
+from itaqa.geography.spatial import SpatialIndex
+from itaqa.utils import aggregation_utils, serialization_utils
+from itaqa.utils.AQS_utils import get_coordinates
+from itaqa.visualization import plotting
 
 
 class AirQualityStationCollection():
@@ -22,19 +30,32 @@ class AirQualityStationCollection():
         Args:
         AQS (str): Existing AQS object/list/dict to add to the collection
         file_path: Path of a serialized existing AQSC to load
+        lazy (bool): If True, the data of each AQS loaded from file_path is decoded only on first access
+        use_mmap (bool): If True, file_path is memory-mapped and the AQS columns are zero-copy views over it
+        filters: Filters applied while loading file_path (min_dt, max_dt, pollutants, regions, provinces, stations,
+                 see load())
 
     Attributes:
         AQS_dict(dict): Dict of AirQualityStation objects
+        version(int): Counter incremented at each change of the collection (to invalidate derived data)
+
+    The AQS are indexed by uuid and name: an AQS renamed after being added must be removed and added again
 
     Examples:
         AirQualityStationCollection('Mordor')
     """
-    def __init__(self, AQS=None, file_path=None):
+    def __init__(self, AQS=None, file_path=None, lazy=False, use_mmap=False, **filters):
         self._AQS_dict = dict()
+        self._name_index = NameIndex()
+        self._sorted_AQS_list = None
+        self._spatial_indexes = dict()
+        self._datasets = dict()
+        self._datasets_key = None
+        self._version = 0
         if AQS:
             self.add(AQS)
         if file_path:
-            self.load(file_path)
+            self.load(file_path, lazy=lazy, use_mmap=use_mmap, **filters)
 
     def __str__(self):
         self.info()
@@ -57,20 +78,35 @@ class AirQualityStationCollection():
     @AQS_dict.setter
     def set_AQS_dict(self, AQS_dict):
         """Update the AQS collection"""
-        self._AQS_dict.update(AQS_dict)
+        self.remove([uuid for uuid in AQS_dict if uuid in self._AQS_dict])
+        self.add(AQS_dict)
 
     @property
     def AQS_list(self):
-        """Return a list of the AQS objects in the collection"""
-        AQS_list = [v for v in self.AQS_dict.values()]
-        AQS_list.sort()
-        return AQS_list
+        """Return a list of the AQS objects in the collection, sorted by name (cached until the next change)"""
+        if self._sorted_AQS_list is None:
+            # uuid breaks ties among AQS with the same name, so the order does not depend on the order of addition
+            self._sorted_AQS_list = sorted(self.AQS_dict.values(), key=lambda AQS: (AQS.name, AQS.uuid))
+        return list(self._sorted_AQS_list)
+
+    @property
+    def version(self):
+        """Return the version of the collection, incremented at each addition/removal"""
+        return self._version
+
+    def _changed(self):
+        """Invalidate the data derived from the collection"""
+        self._sorted_AQS_list = None
+        self._spatial_indexes.clear()
+        self._version += 1
 
     def add(self, AQS):
         """Add to the collection the provided AQS object(s)"""
         if isinstance(AQS, AirQualityStation):
             if not AQS.uuid in self.AQS_dict:
                 self.AQS_dict[AQS.uuid] = AQS
+                self._name_index.add(AQS)
+                self._changed()
             else:
                 warnings.warn("AQS already present in collection, skipping addition")
         elif isinstance(AQS, list):
@@ -92,29 +128,275 @@ class AirQualityStationCollection():
                 del self.AQS_dict[uuid]
             except KeyError:
                 warnings.warn("No AQS with the specified uuid, ignoring command")
+            else:
+                self._name_index.remove(uuid)
+                self._changed()
 
     def search(self, search_term, mode='name'):
-        """Get the AQS that match (even partially, not case sensitive) the specified name"""
+        """
+        Get the AQS that match the search term (a single AQS if only one matches, otherwise a list sorted by name)
+
+        Modes:
+            name: Name containing the term (not case sensitive, accents and punctuation ignored)
+            prefix: Name starting with the term (not case sensitive, accents and punctuation ignored)
+            normalized: Name equal to the term (not case sensitive, accents and punctuation ignored)
+            exact: Name exactly equal to the term
+            uuid: AQS with the specified uuid
+        """
         if mode == 'name':
-            res = [AQS for AQS in self.AQS_list if search_term.lower() in AQS.name.lower()]
-            if len(res) == 1:
-                return res[0]
-            return res
-
-    def save(self, file_path):
-        """Serialize and save the AQS collection"""
-        with open(file_path, 'wb') as fp:
-            packed = msgpack.packb(self.AQS_list, default=AirQualityStation.encode_AQS_msgpack)
-            fp.write(packed)
-
-    def load(self, file_path):
-        """Load a serialized AQS collection"""
-        if Path(file_path).exists():
-            with open(file_path, 'rb') as fp:
-                bytedata = fp.read()
-            self.add(msgpack.unpackb(bytedata, object_hook=AirQualityStation.decode_AQS_msgpack))
+            res = self._name_index.get_substring(search_term)
+        elif mode == 'prefix':
+            res = self._name_index.get_prefix(search_term)
+        elif mode == 'normalized':
+            res = self._name_index.get_normalized(search_term)
+        elif mode == 'exact':
+            res = self._name_index.get_exact(search_term)
+        elif mode == 'uuid':
+            res = [self.AQS_dict[search_term]] if search_term in self.AQS_dict else []
         else:
+            raise ValueError(f"Unknown search mode '{mode}'")
+        if len(res) == 1:
+            return res[0]
+        return sorted(res)
+
+    def get_by_name(self, name):
+        """Return the list of AQS with exactly the specified name"""
+        return self._name_index.get_exact(name)
+
+    def group_by(self, key='name'):
+        """
+        Group the AQS in a single pass and return a dict with as key the group and as value the list of its AQS
+
+        The lists hold the AQS objects of the collection themselves (no copies), sorted as AQS_list
+        Groups are ordered by their first AQS in AQS_list, so the result does not depend on the order of addition
+
+        Args:
+            key (str/callable): AQS attribute to group by ('name', 'comune', 'province', 'region', ...) or function
+                                returning the group of an AQS
+        """
+        if isinstance(key, str):
+            attribute = key
+
+            def key(AQS):
+                return getattr(AQS, attribute)
+
+        groups = dict()
+        for AQS in self.AQS_list:
+            groups.setdefault(key(AQS), []).append(AQS)
+        return groups
+
+    def to_long(self):
+        """
+        Return the data of all the AQS as a single long format DataFrame
+
+        Columns: station_id (categorical, uuid of the AQS), Timestamp, pollutant (categorical), value (float64)
+        Missing values are dropped, rows are sorted by station (as AQS_list), pollutant, Timestamp (as data)
+        The DataFrame is cached until the collection changes or data is assigned to one of its AQS
+        """
+        datasets = self._get_datasets()
+        if 'long' not in datasets:
+            datasets['long'] = build_long_dataset(self.AQS_list)
+        return datasets['long']
+
+    def to_wide(self, pollutant):
+        """
+        Return the values of a pollutant for all the AQS measuring it as a wide DataFrame
+
+        Index: Timestamp (sorted), columns: uuid of the AQS measuring the pollutant (as AQS_list); cached as to_long()
+        """
+        if isinstance(pollutant, Pollutant):
+            pollutant = pollutant.name
+        datasets = self._get_datasets()
+        if ('wide', pollutant) not in datasets:
+            long_df = self.to_long()
+            long_df = long_df[long_df['pollutant'] == pollutant]
+            long_df = long_df.assign(station_id=long_df['station_id'].astype(str))
+            long_df = long_df.drop_duplicates(['station_id', 'Timestamp'])
+            wide_df = long_df.pivot(index='Timestamp', columns='station_id', values='value')
+            stations = [AQS.uuid for AQS in self.AQS_list if pollutant in AQS.pollutants]
+            datasets[('wide', pollutant)] = wide_df.reindex(columns=stations).rename_axis(columns=None)
+        return datasets[('wide', pollutant)]
+
+    def pollutant_stats(self):
+        """Return count, mean, std, min, max of the values of each AQS and pollutant (computed on to_long() at once)"""
+        datasets = self._get_datasets()
+        if 'stats' not in datasets:
+            grouped = self.to_long().groupby(['station_id', 'pollutant'], observed=True, sort=False)['value']
+            datasets['stats'] = grouped.agg(['count', 'mean', 'std', 'min', 'max'])
+        return datasets['stats']
+
+    def aggregate(self, pollutant, metric, **params):
+        """
+        Compute an aggregation metric of a pollutant on all the AQS measuring it at once (on to_wide(pollutant))
+
+        Limit value and daily metric of 'exceedances' default to the regulatory ones of the pollutant
+        The result is cached (keyed by pollutant, metric and parameters) as to_long()
+        'resample' is computed from the rollups of the AQS, if all available (see AirQualityStation.get_rollup)
+
+        Examples:
+            AQSC.aggregate('NO2', 'resample', freq='daily', stat='mean')
+            AQSC.aggregate('O3', 'exceedances')
+            AQSC.aggregate('PM10', 'percentiles', q=[0.5, 0.9])
+        """
+        if isinstance(pollutant, Pollutant):
+            pollutant = pollutant.name
+        if metric == 'exceedances':
+            if 'limit' not in params and pollutant not in aggregation_utils.LIMIT_VALUES:
+                raise ValueError(f"No limit value known for {pollutant}, specify it")
+            params.setdefault('limit', aggregation_utils.LIMIT_VALUES.get(pollutant))
+            params.setdefault('daily_metric', aggregation_utils.DAILY_METRICS.get(pollutant, 'daily_mean'))
+        datasets = self._get_datasets()
+        key = ('aggregate', pollutant, aggregation_utils.get_spec_key(metric, params))
+        if key not in datasets:
+            if metric == 'resample':
+                datasets[key] = self._resample_from_rollups(pollutant, **params)
+            if datasets.get(key) is None:
+                datasets[key] = aggregation_utils.aggregate(self.to_wide(pollutant), metric, **params)
+        return datasets[key]
+
+    def _resample_from_rollups(self, pollutant, freq='daily', stat='mean', min_count=None):
+        """Return the 'resample' metric of a pollutant from the rollups of the AQS (None if not all available)"""
+        AQS_list = [AQS for AQS in self.AQS_list if pollutant in AQS.pollutants]
+        if (not AQS_list or stat not in aggregation_utils.ROLLUP_STATS
+                or not all(AQS.has_rollup(freq) for AQS in AQS_list)):
+            return None
+        rollup = pd.concat({AQS.uuid: AQS.get_rollup(freq)[pollutant] for AQS in AQS_list}, axis=1)
+        # As resampling to_wide(), periods range over all the AQS (with no values where an AQS has no data)
+        periods = pd.date_range(rollup.index.min(),
+                                rollup.index.max(),
+                                freq=aggregation_utils.get_frequency(freq),
+                                name='Timestamp')
+        rollup = rollup.reindex(periods)
+        for zero_stat in ('count', 'sum'):
+            cols = rollup.columns.get_level_values(1) == zero_stat
+            rollup.loc[:, cols] = rollup.loc[:, cols].fillna(0)
+        return aggregation_utils.resample_from_rollup(rollup, stat, min_count)
+
+    def _get_datasets(self):
+        """Return the cache of the datasets derived from the AQS data, emptied if the data changed"""
+        key = (self._version, tuple(AQS.data_version for AQS in self.AQS_dict.values()))
+        if key != self._datasets_key:
+            self._datasets = dict()
+            self._datasets_key = key
+        return self._datasets
+
+    def get_spatial_index(self, pollutant=None):
+        """
+        Return the SpatialIndex of the geolocated AQS (measuring pollutant, if specified) and the list of those AQS
+
+        The index is built on first use and cached until the next change of the collection
+        """
+        if isinstance(pollutant, Pollutant):
+            pollutant = pollutant.name
+        if pollutant not in self._spatial_indexes:
+            AQS_list, coords = [], []
+            for AQS in self.AQS_list:
+                if pollutant and pollutant not in AQS.pollutants:
+                    continue
+                coordinates = get_coordinates(AQS)
+                if coordinates is None:
+                    continue
+                AQS_list.append(AQS)
+                coords.append(coordinates)
+            lat, lng = zip(*coords) if coords else ((), ())
+            self._spatial_indexes[pollutant] = (SpatialIndex(lat, lng), AQS_list)
+        return self._spatial_indexes[pollutant]
+
+    def nearest(self, lat, lng, k=1, pollutant=None):
+        """Return the k AQS (measuring pollutant, if specified) nearest to lat/lng, as (AQS, distance km) pairs"""
+        index, AQS_list = self.get_spatial_index(pollutant)
+        idx, dist = index.query_knn(lat, lng, k)
+        return [(AQS_list[ii], dd) for ii, dd in zip(idx, dist)]
+
+    def within_radius(self, lat, lng, radius, pollutant=None):
+        """Return the AQS (measuring pollutant, if specified) within radius km from lat/lng, as (AQS, distance km)"""
+        index, AQS_list = self.get_spatial_index(pollutant)
+        idx, dist = index.query_radius(lat, lng, radius)
+        return [(AQS_list[ii], dd) for ii, dd in zip(idx, dist)]
+
+    def within_bbox(self, min_lat, min_lng, max_lat, max_lng, pollutant=None):
+        """Return the AQS (measuring pollutant, if specified) within the lat/lng bounding box, sorted by name"""
+        index, AQS_list = self.get_spatial_index(pollutant)
+        return [AQS_list[ii] for ii in index.query_bbox(min_lat, min_lng, max_lat, max_lng)]
+
+    def plot(self, pollutant, mode='overlay', stations=None, group_by=None, **kwargs):
+        """
+        Compare a pollutant among the AQS (or groups of AQS) of the collection in a single plotly graph, returned
+
+        Modes: 'overlay', 'multiple' (small multiples), 'heatmap' (see plotting.AQSC_plot for kwargs)
+
+        Examples:
+            AQSC.plot('NO2', mode='heatmap')
+            AQSC.plot('PM10', mode='multiple', group_by='province')
+        """
+        if isinstance(pollutant, Pollutant):
+            pollutant = pollutant.name
+        return plotting.AQSC_plot(self, pollutant, mode, stations, group_by, **kwargs)
+
+    def save(self, file_path, rollups=False):
+        """
+        Serialize and save the AQS collection
+
+        Args:
+            rollups (bool/list): Store also the rollups of each AQS (at the specified frequencies, if a list, otherwise
+                                 at aggregation_utils.ROLLUP_FREQUENCIES), read by aggregate() instead of the data
+        """
+        if rollups is True:
+            rollups = aggregation_utils.ROLLUP_FREQUENCIES
+        serialization_utils.dump_AQSC_file(self.AQS_list, file_path, rollups=rollups or None)
+
+    def append_segments(self, file_path, new_data):
+        """
+        Append to an existing AQSC file only new time slices of the AQS data, without rewriting the file
+
+        Args:
+            file_path (str): Path of the AQSC file, previously saved
+            new_data (dict): uuid of an AQS of the collection: DataFrame with its rows not in the file yet
+                             (AQS not in the file are added)
+        """
+        serialization_utils.append_AQSC_segments(file_path, [(self[uuid], data) for uuid, data in new_data.items()])
+
+    def load(self,
+             file_path,
+             lazy=False,
+             use_mmap=False,
+             min_dt=None,
+             max_dt=None,
+             pollutants=None,
+             regions=None,
+             provinces=None,
+             stations=None):
+        """
+        Load a serialized AQS collection
+
+        If lazy, only the index of the file is read and each AQS data is decoded on first access
+        (listing, search and info() do not require the data)
+        If use_mmap, the file is memory-mapped: the page cache is shared among processes opening the same file and
+        AQS.get_column() returns zero-copy NumPy views over it (AQS.data is built on first access)
+
+        Only the AQS in the specified regions/provinces, with the specified names/uuids (stations) and measuring
+        any of the specified pollutants are loaded, with only the data of those pollutants between min_dt and max_dt
+        (AQS without data in the time range are skipped). The filters are applied while decoding: AQS, columns and
+        blocks of rows not selected are not read from the file (see serialization_utils.load_AQSC_file)
+        """
+        if not Path(file_path).exists():
             raise FileNotFoundError("The specified file doesn't exist")
+        filters = serialization_utils.get_load_filters(min_dt=min_dt,
+                                                       max_dt=max_dt,
+                                                       pollutants=pollutants,
+                                                       regions=regions,
+                                                       provinces=provinces,
+                                                       stations=stations)
+        if serialization_utils.is_AQSC_file(file_path):
+            self.add(serialization_utils.load_AQSC_file(file_path, lazy=lazy, use_mmap=use_mmap, filters=filters))
+        else:
+            # Files saved before the indexed layout: a single msgpack list, always fully decoded
+            with open(file_path, 'rb') as fp:
+                bytedata = fp.read()
+            AQS_list = msgpack.unpackb(bytedata, object_hook=AirQualityStation.decode_AQS_msgpack)
+            if filters:
+                AQS_list = serialization_utils.filter_AQS_list(AQS_list, filters)
+            self.add(AQS_list)
 
     def info(self):
         """Generate an informative rich.table of the contained AQS"""
@@ -127,14 +409,42 @@ class AirQualityStationCollection():
         table.add_column("Entries")
         table.add_column("Datetime range", style='dim')
         for vv in self.AQS_dict.values():
-            ts = vv.data['Timestamp']
+            ts_min, ts_max = vv.time_range
             # yapf: disable
             table.add_row(
                 f"[bold]{vv.name}[/bold]",
                 f"{vv.uuid}",
                 f"{vv.comune}",
-                ", ".join(map(str,[pl for pl in vv.data.columns.to_list() if pl != 'Timestamp'])),
-                str(vv.data.shape[0]),
-                str(ts.min())[0:10] + " - " + str(ts.max())[0:10])
+                ", ".join(map(str, vv.pollutants)),
+                str(vv.entries),
+                str(ts_min)[0:10] + " - " + str(ts_max)[0:10])
             # yapf: enable
         console.print(table)
+
+
+def build_long_dataset(AQS_list):
+    """Build the long format DataFrame of the data of the AQS (see AirQualityStationCollection.to_long)"""
+    pollutants = sorted({pollutant for AQS in AQS_list for pollutant in AQS.pollutants})
+    pollutant_codes = {pollutant: code for code, pollutant in enumerate(pollutants)}
+    station_codes, timestamps, codes, values = [], [], [], []
+    for station_code, AQS in enumerate(AQS_list):
+        if not AQS.pollutants:
+            continue
+        columns = AQS.get_columns()
+        ts = pd.to_datetime(columns['Timestamp']).to_numpy()
+        for pollutant in AQS.pollutants:
+            value = pd.to_numeric(columns[pollutant], errors='coerce').astype('float64', copy=False)
+            valid = ~np.isnan(value)
+            station_codes.append(np.full(valid.sum(), station_code, dtype='int32'))
+            timestamps.append(ts[valid])
+            codes.append(np.full(valid.sum(), pollutant_codes[pollutant], dtype='int32'))
+            values.append(value[valid])
+    if not values:
+        dtypes = ('int32', '<M8[ns]', 'int32', 'float64')
+        station_codes, timestamps, codes, values = [[np.empty(0, dtype)] for dtype in dtypes]
+    return pd.DataFrame({
+        'station_id': pd.Categorical.from_codes(np.concatenate(station_codes), [AQS.uuid for AQS in AQS_list]),
+        'Timestamp': np.concatenate(timestamps),
+        'pollutant': pd.Categorical.from_codes(np.concatenate(codes), pollutants),
+        'value': np.concatenate(values)
+    })
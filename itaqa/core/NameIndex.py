@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Class NameIndex
+"""
+
+import bisect
+import re
+import unicodedata
+
+from collections import defaultdict
+
+
+def normalize_name(name):
+    """Return name lowercase, without accents and with any sequence of punctuation/whitespace as a single space"""
+    name = unicodedata.normalize('NFKD', str(name))
+    name = ''.join(char for char in name if not unicodedata.combining(char))
+    return re.sub(r'[\W_]+', ' ', name.casefold()).strip()
+
+
+def get_trigrams(normalized_name):
+    """Return the set of 3-characters substrings of a normalized name"""
+    return {normalized_name[idx:idx + 3] for idx in range(len(normalized_name) - 2)}
+
+
+class NameIndex():
+    """
+    Index the AQS of a collection by name, to look them up without scanning the whole collection
+
+    Exact and normalized (see normalize_name) names are hashed, substring search uses a trigram index over the
+    normalized names and prefix search a sorted list of them (built on first use after a change)
+
+    Attributes:
+        exact(dict): Name: dict of AQS with that name (uuid: AQS)
+        normalized(dict): Normalized name: dict of AQS with that normalized name (uuid: AQS)
+
+    Examples:
+        NameIndex()
+    """
+    def __init__(self):
+        self.exact = defaultdict(dict)
+        self.normalized = defaultdict(dict)
+        self._names = dict()
+        self._trigrams = defaultdict(set)
+        self._sorted_names = None
+
+    def add(self, AQS):
+        """Index an AQS by its current name"""
+        norm_name = normalize_name(AQS.name)
+        self._names[AQS.uuid] = (AQS.name, norm_name)
+        self.exact[AQS.name][AQS.uuid] = AQS
+        if norm_name not in self.normalized:
+            for trigram in get_trigrams(norm_name):
+                self._trigrams[trigram].add(norm_name)
+            self._sorted_names = None
+        self.normalized[norm_name][AQS.uuid] = AQS
+
+    def remove(self, uuid):
+        """Remove an AQS (given its uuid) from the index, using the name it was indexed with"""
+        name, norm_name = self._names.pop(uuid)
+        del self.exact[name][uuid]
+        if not self.exact[name]:
+            del self.exact[name]
+        del self.normalized[norm_name][uuid]
+        if not self.normalized[norm_name]:
+            del self.normalized[norm_name]
+            for trigram in get_trigrams(norm_name):
+                self._trigrams[trigram].discard(norm_name)
+                if not self._trigrams[trigram]:
+                    del self._trigrams[trigram]
+            self._sorted_names = None
+
+    def get_exact(self, name):
+        """Return the AQS with exactly the specified name"""
+        return list(self.exact.get(name, {}).values())
+
+    def get_normalized(self, name):
+        """Return the AQS whose name is equal to the specified one once both are normalized"""
+        return list(self.normalized.get(normalize_name(name), {}).values())
+
+    def get_prefix(self, prefix):
+        """Return the AQS whose normalized name starts with the normalized prefix"""
+        prefix = normalize_name(prefix)
+        if self._sorted_names is None:
+            self._sorted_names = sorted(self.normalized)
+        start = bisect.bisect_left(self._sorted_names, prefix)
+        res = []
+        for norm_name in self._sorted_names[start:]:
+            if not norm_name.startswith(prefix):
+                break
+            res.extend(self.normalized[norm_name].values())
+        return res
+
+    def get_substring(self, substring):
+        """Return the AQS whose normalized name contains the normalized substring"""
+        substring = normalize_name(substring)
+        trigrams = get_trigrams(substring)
+        if trigrams:
+            # Only the names containing all the trigrams of the substring are candidates
+            candidates = set.intersection(*(self._trigrams.get(trigram, set()) for trigram in trigrams))
+        else:
+            candidates = self.normalized.keys()
+        res = []
+        for norm_name in candidates:
+            if substring in norm_name:
+                res.extend(self.normalized[norm_name].values())
+        return res
@@ -4,6 +4,13 @@
 Definition of region-specific functions
 """
 
-from itaqa.crawler import piemonte, lombardia
+from itaqa.crawler import emilia_romagna, piemonte, lombardia
+from itaqa.geography import Italy
 
-REGION_CRAWLERS = {'lombardia': lombardia.get_AQSC}
+REGION_CRAWLERS = {'emilia_romagna': emilia_romagna.get_AQSC, 'lombardia': lombardia.get_AQSC}
+
+# Region of the AQS produced by each crawler
+CRAWLER_REGIONS = {'emilia_romagna': Italy.Region.EMILIAROMAGNA, 'lombardia': Italy.Region.LOMBARDIA}
+
+# Time range (min, max datetime) of the data available to each crawler, if limited
+CRAWLER_RANGES = {'lombardia': lombardia.AVAILABLE_RANGE}
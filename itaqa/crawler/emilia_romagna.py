@@ -4,13 +4,115 @@
 Emilia-Romagna data downloader and parser
 """
 
+import logging
 import pandas as pd
-import urllib
+import requests
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from functools import reduce
+from io import StringIO
 
+from itaqa.core.AirQualityStation import AirQualityStation
+from itaqa.core.AirQualityStationCollection import AirQualityStationCollection
 from itaqa.core.defs import Pollutant
+from itaqa.geography import Italy
+from itaqa.geography.converter import lookup_province_enum
+from itaqa.utils import http_utils, pandas_utils
+
+logger = logging.getLogger(__name__)
+
+BASE_URL = 'https://apps.arpae.it/qualita-aria/bollettino-qa/'
+# yapf: disable
+BULLETIN_COLUMNS = [
+    'Province', 'Station', Pollutant.PM10.name, Pollutant.PM2_5.name, Pollutant.NO2.name, Pollutant.O3.name, 'O3_8h',
+    Pollutant.BENZENE.name, Pollutant.CO.name, Pollutant.SO2.name
+]
+# yapf: enable
+BULLETIN_POLLUTANTS = [col for col in BULLETIN_COLUMNS if col in Pollutant.__members__]
+
+
+def get_AQSC(dt_range, redownload, base_url=BASE_URL, max_workers=8):
+    """
+    Return the AQSC for Emilia-Romagna for the specified dt_range (one measurement per day)
+
+    Daily bulletins are fetched concurrently (at most max_workers requests at a time) through the shared HTTP
+    cache, so that all the pollutants are extracted from a single fetch of each page
+
+    Data origin: ARPA Emilia-Romagna
+    Website: https://apps.arpae.it/qualita-aria/bollettino-qa
+    """
+    min_dt, max_dt = dt_range
+    dates = pd.date_range(start=min_dt, end=max_dt, freq='D', normalize=True)
+    html_docs = fetch_bulletins(dates, redownload, base_url=base_url, max_workers=max_workers)
+
+    bulletins = [parse_bulletin(html_doc, date) for date, html_doc in html_docs.items() if html_doc]
+    if not bulletins:
+        raise ValueError("No bulletin available for the specified dt_range")
+    bulletins_df = pd.concat(bulletins, ignore_index=True)
+
+    # Create an AirQualityStation for each station appearing in the bulletins
+    AQS_list = []
+    for station_name, station_df in bulletins_df.groupby('Station', sort=True):
+        AQS = AirQualityStation(station_name)
+        AQS.set_address(region=Italy.Region.EMILIAROMAGNA, province=get_province_enum(station_df['Province'].iloc[0]))
+        AQS.metadata['type'] = station_df['Type'].iloc[0]
+        data_df = station_df[['Timestamp'] + BULLETIN_POLLUTANTS].dropna(axis=1, how='all')
+        AQS.data = pandas_utils.reorder_columns(data_df.sort_values(by='Timestamp').reset_index(drop=True))
+        AQS_list.append(AQS)
+    return AirQualityStationCollection(AQS=AQS_list)
+
+
+def fetch_bulletins(dates, redownload, base_url=BASE_URL, max_workers=8):
+    """Fetch concurrently the bulletins of the specified dates, return a dict date: html (None if unavailable)"""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        html_docs = executor.map(lambda date: fetch_bulletin(date, redownload, base_url), dates)
+        return dict(zip(dates, html_docs))
+
+
+def fetch_bulletin(date, redownload, base_url=BASE_URL):
+    """Return the html of the bulletin of the specified date, downloading it only if not cached or redownload"""
+    date_string = date.strftime('%Y%m%d')
+    try:
+        cached_path = http_utils.fetch(base_url + date_string, revalidate=redownload)
+    except requests.HTTPError as err:
+        logger.warning(f"Bulletin of {date_string} not available ({err.response.status_code}), skipping it")
+        return None
+    # TODO: Discard or warn if page contains "Dati in attesa di validazione"
+    return cached_path.read_bytes()
+
+
+def parse_bulletin(html_doc, date):
+    """Parse a daily bulletin, return a df with one row for each station (Timestamp, Province, Station, Type, ...)"""
+    pd_table_list = pd.read_html(StringIO(html_doc.decode('utf-8')))
+    pd_table_list.pop(-1)    # Last table is just pollutants threshold values
+
+    for pd_table in pd_table_list:
+        # TODO: Add robust-ish checks rather than "blind" hardcoded indices?
+        # Drop last columns (threshold overshooting counts)
+        pd_table.drop(pd_table.columns[[10, 11, 12, 13]], axis=1, inplace=True)
+        pd_table.columns = BULLETIN_COLUMNS
+        # Split Station field into Station, Type
+        # TODO: Differentiate between Location and Name in Station field...
+        station_data = pd_table['Station'].str.split(" / ", n=1, expand=True)
+        pd_table['Station'] = station_data[0]
+        pd_table['Type'] = station_data[1] if station_data.shape[1] > 1 else None
+
+    bulletin = pd.concat(pd_table_list, ignore_index=True)
+    # TODO: Support values such as "< 3" (now missing, as "n.d.")
+    bulletin[BULLETIN_POLLUTANTS] = bulletin[BULLETIN_POLLUTANTS].apply(pd.to_numeric, errors='coerce')
+    bulletin.insert(0, 'Timestamp', pd.Timestamp(date))
+    return bulletin
+
+
+def get_province_enum(province):
+    """Return Province given its name or abbreviation as shown in the bulletins"""
+    if province in Italy.Province.__members__:
+        return Italy.Province[province]
+    try:
+        return lookup_province_enum(province)
+    except KeyError:
+        return Italy.Province.UNSET
 
 
 def get_csv(pollutant=Pollutant.UNSET, days=10):
@@ -21,52 +123,20 @@ def get_csv(pollutant=Pollutant.UNSET, days=10):
     Data origin: ARPA Emilia-Romagna
     Website: https://apps.arpae.it/qualita-aria/bollettino-qa
     """
-
-    # TODO: Support arbitrary date ranges
-    # TODO: Catch HTTPError for unavailable pages and drop them
-    # TODO: Discard or warn if page contains "Dati in attesa di validazione"
     end_date = datetime.today() - timedelta(2)
-
-    date_list = pd.date_range(end=end_date, periods=days).tolist()
-    date_string_list = [x.strftime('%Y%m%d') for x in date_list]
+    date_list = pd.date_range(end=end_date, periods=days, normalize=True)
+    html_docs = fetch_bulletins(date_list, redownload=False)
 
     pd_singleday_list = []    # List of prepped tables for merging + output
-
-    base_url = 'https://apps.arpae.it/qualita-aria/bollettino-qa/'
-    for date_string in date_string_list:
-        url = base_url + date_string
-        html_doc = urllib.request.urlopen(url).read()
-
-        pd_table_list = pd.read_html(html_doc)
-        pd_table_list.pop(-1)    # Last table is just pollutants threshold values
-
-        for pd_table in pd_table_list:
-            # TODO: Improve - e.g. do most stuff as inplace
-            # TODO: Add robust-ish checks rather than "blind" hardcoded indices?
-            # Drop last columns (threshold overshooting counts)
-            pd_table.drop(pd_table.columns[[10, 11, 12, 13]], axis=1, inplace=True)
-            # Rename headers
-            # TODO: Decide "how to yapf" these kinds of lists
-            pd_table.columns = [
-                'Province', 'Station', Pollutant.PM10, Pollutant.PM2_5, Pollutant.NO2, Pollutant.O3, 'O3_8h',
-                Pollutant.BENZENE, Pollutant.CO, Pollutant.SO2
-            ]
-            # Split Station field into Station, Type
-            # TODO: Differentiate between Location and Name in Station field...
-            station_data = pd_table['Station'].str.split(" / ", n=1, expand=True)
-            pd_table['Station'] = station_data[0]
-            pd_table['Type'] = station_data[1]
-
-        # New data frame merging all stations for the single day and pollutant
-        pd_singleday = pd.concat(pd_table_list, axis=0)[['Station', pollutant]]
-        pd_singleday.reset_index(drop=True)
-        pd_singleday.columns = ['Station', date_string]
-
+    for date, html_doc in html_docs.items():
+        if not html_doc:
+            continue
+        # New data frame with all stations for the single day and pollutant
+        pd_singleday = parse_bulletin(html_doc, date)[['Station', pollutant.name]]
+        pd_singleday.columns = ['Station', date.strftime('%Y%m%d')]
         pd_singleday_list.append(pd_singleday)
 
     pd_output = reduce(lambda x, y: pd.merge(x, y, on='Station'), pd_singleday_list)
-    # TODO: Support values such as "< 3" or "n.d." and numeric vs text
-
     return pd_output.to_csv()
 
 
@@ -9,7 +9,9 @@ import logging
 import pandas as pd
 import progressbar
 
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from itertools import repeat
 from pathlib import Path
 
 from itaqa.core.AirQualityStation import AirQualityStation
@@ -21,44 +23,46 @@ from itaqa.utils import AQSC_utils, csv_utils, pandas_utils
 logger = logging.getLogger(__name__)
 
 
-def get_AQSC(dt_range, redownload):
+METADATA_URL = 'https://www.dati.lombardia.it/resource/ib47-atvt.csv'
+# Yearly data tables
+DATA_URLS = {
+    2018: 'https://www.dati.lombardia.it/api/views/bgqm-yq56/rows.csv',
+    2019: 'https://www.dati.lombardia.it/api/views/kujm-kavy/rows.csv',
+    2020: 'https://www.dati.lombardia.it/api/views/nicp-bhqi/rows.csv'
+}
+# Time range covered by the data tables
+AVAILABLE_RANGE = (datetime(min(DATA_URLS), 1, 1), datetime(max(DATA_URLS), 12, 31, 23, 59, 59))
+
+
+def get_AQSC(dt_range, redownload, max_workers=None):
     """
     Return the AQSC for Lombardia for the specified dt_range
 
+    A dt_range spanning multiple years is split in one job per year (yearly data table), parsed in parallel worker
+    processes (at most max_workers) and merged at the end
+
     Data origin: https://www.dati.lombardia.it
     """
     min_dt, max_dt = dt_range
+    years = list(range(min_dt.year, max_dt.year + 1))
+    unknown_years = [year for year in years if year not in DATA_URLS]
+    if unknown_years:
+        raise ValueError(f"Data table unknown for the specified year(s) ({unknown_years})")
 
-    metadata_url = 'https://www.dati.lombardia.it/resource/ib47-atvt.csv'
-    if min_dt.year == max_dt.year:
-        ref_year = min_dt.year
-        if ref_year == 2020:
-            data_url = 'https://www.dati.lombardia.it/api/views/nicp-bhqi/rows.csv'
-        elif ref_year == 2019:
-            data_url = 'https://www.dati.lombardia.it/api/views/kujm-kavy/rows.csv'
-        elif ref_year == 2018:
-            data_url = 'https://www.dati.lombardia.it/api/views/bgqm-yq56/rows.csv'
-        else:
-            raise ValueError("Data table unknown for the specified year")
-    else:
-        raise ValueError("Cannot use different years as min and max date (for now)")
-
-    metadata_file = f'dump/data/lombardia_metadata_{ref_year}.out'
-    data_file = f'dump/data/lombardia_data_{ref_year}.out'
+    metadata_file = 'dump/data/lombardia_metadata.csv'
+    data_files = {year: f'dump/data/lombardia_data_{year}.csv' for year in years}
 
     # Download data from ARPA Lombardia
     if redownload:
         logger.info("Started download from ARPA Lombardia")
-        csv_utils.download_csv(metadata_url, metadata_file)
-        csv_utils.download_csv(data_url, data_file)
+        csv_utils.download_csv(METADATA_URL, metadata_file)
     else:
-        if Path(metadata_file).exists() and Path(data_file).exists():
+        if Path(metadata_file).exists() and all(Path(data_file).exists() for data_file in data_files.values()):
             logger.info("Using stored csv for data")
         else:
             raise FileNotFoundError("Data not existing, run again with redownload=True")
 
     metadata_reader, metadata_len = csv_utils.read_csv(metadata_file)
-    data_reader, data_len = csv_utils.read_csv(data_file)
     header_row = next(metadata_reader, None)
     # Fix rows with wrong title
     header_row[16] = 'Limiti amministrativi 2014'
@@ -103,29 +107,25 @@ def get_AQSC(dt_range, redownload):
                 stations_dict[str(kk)] = AQS
             else:
                 ignored_pollutants.add(station['nometiposensore'])
-    # Fill AQS objects with data, reading the data CSV row by row
-    header_row = next(data_reader, None)
-    data_dict = collections.defaultdict(dict)
+    # Fill AQS objects with data, parsing the yearly data CSVs (in parallel if more than one)
+    year_jobs = [(year, data_files[year], redownload, list(stations_dict), max(min_dt, datetime(year, 1, 1)),
+                  min(max_dt, datetime(year, 12, 31, 23, 59, 59))) for year in years]
+    if len(year_jobs) == 1:
+        year_results = [parse_year(*year_jobs[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers or len(year_jobs)) as executor:
+            year_results = list(executor.map(parse_year, *zip(*year_jobs), repeat(False)))
     missing_sensors = set()
-    pbar = progressbar.ProgressBar(maxval=data_len).start()
-    for row in data_reader:
-        datetime_object = datetime.strptime(row[1], '%d/%m/%Y %I:%M:%S %p')
-        # Include only data in specified datetime range
-        if (datetime_object >= min_dt) and (datetime_object <= max_dt):
-            if (row[2] != '-9999'):
-                sensor_id = row[0]
-                if sensor_id in stations_dict:
-                    dt = datetime_object.isoformat()
-                    data_dict[sensor_id][dt] = row[2]
-                else:
-                    missing_sensors.add(sensor_id)
-        pbar.update(data_reader.line_num)
-
-    # Create df for all AQS (performance friendly approach: assigned to AQS.data only here)
-    for k, v in data_dict.items():
-        AQS = stations_dict[k]
-        data_df = pd.DataFrame(list(v.items()), columns=AQS.data.columns)
-        AQS.data = AQS.data.append(data_df, ignore_index=True)
+    sensor_frames = collections.defaultdict(list)
+    for data_dfs, year_missing_sensors in year_results:
+        missing_sensors.update(year_missing_sensors)
+        for sensor_id, data_df in data_dfs.items():
+            sensor_frames[sensor_id].append(data_df)
+    for sensor_id, frames in sensor_frames.items():
+        AQS = stations_dict[sensor_id]
+        data_df = pd.concat(frames, ignore_index=True).drop_duplicates(subset='Timestamp', keep='last')
+        data_df.columns = AQS.data.columns
+        AQS.data = data_df.reset_index(drop=True)
 
     # Notify the user on parsing outcome (ignored items)
     if missing_sensors:
@@ -143,8 +143,8 @@ def get_AQSC(dt_range, redownload):
     AQSC = AirQualityStationCollection(AQS=[v for v in stations_dict.values()])
     # Remove stations without data
     AQSC_utils.remove_empty_stations(AQSC)
-    # Merge stations with the same name (indicating the same place)
-    stations_grouped = AQSC_utils.group_by_name(AQSC)
+    # Merge stations with the same name located nearby (indicating the same place)
+    stations_grouped = AQSC_utils.group_by_location(AQSC)
     stations_merged = AQSC_utils.merge_by_group(AQSC, stations_grouped)
     # Perform single operations on AQS data
     for AQS in AQSC:
@@ -156,6 +156,56 @@ def get_AQSC(dt_range, redownload):
     return AQSC
 
 
+def parse_year(year, data_file, redownload, sensor_ids, min_dt, max_dt, show_progress=True):
+    """Job for a single year: download (if redownload) and parse its data table (see parse_data_table)"""
+    if redownload:
+        csv_utils.download_csv(DATA_URLS[year], data_file)
+    logger.info(f"Parsing Lombardia data of {year}")
+    return parse_data_table(data_file, sensor_ids, min_dt, max_dt, show_progress=show_progress)
+
+
+def parse_data_table(data_file, sensor_ids, min_dt, max_dt, show_progress=True):
+    """
+    Parse the Lombardia data table, return a numeric df (Timestamp, value) for each of the specified sensors
+
+    The table is read in chunks, each one converted at once: fixed-format datetime parsing, numeric values with
+    -9999 marking missing data, a single groupby on the sensor id. Rows outside [min_dt, max_dt] are dropped
+    Return also the set of sensor ids not among the specified ones
+    """
+    sensor_ids = set(sensor_ids)
+    sensor_frames = collections.defaultdict(list)
+    missing_sensors = set()
+    if show_progress:
+        pbar = progressbar.ProgressBar(maxval=csv_utils.count_lines(data_file)).start()
+    parsed_rows = 0
+    for chunk in csv_utils.read_csv_chunks(data_file, usecols=[0, 1, 2], dtype=str):
+        parsed_rows += len(chunk)
+        chunk.columns = ['IdSensore', 'Data', 'Valore']
+        # Include only valid data of known sensors
+        known = chunk['IdSensore'].isin(sensor_ids)
+        missing_sensors.update(chunk.loc[~known, 'IdSensore'].unique())
+        chunk = chunk[known]
+        values = pd.to_numeric(chunk['Valore'], errors='coerce')
+        chunk = chunk.assign(Valore=values.mask(values == -9999)).dropna(subset=['Valore'])
+        # Include only data in specified datetime range
+        timestamps = pd.to_datetime(chunk['Data'], format='%d/%m/%Y %I:%M:%S %p')
+        in_range = (timestamps >= min_dt) & (timestamps <= max_dt)
+        chunk = pd.DataFrame({'IdSensore': chunk['IdSensore'], 'Timestamp': timestamps, 'Valore': chunk['Valore']})
+        for sensor_id, sensor_chunk in chunk[in_range].groupby('IdSensore', sort=False):
+            sensor_frames[sensor_id].append(sensor_chunk[['Timestamp', 'Valore']])
+        if show_progress:
+            pbar.update(parsed_rows)
+    if show_progress:
+        pbar.finish()
+
+    data_dfs = {}
+    for sensor_id, frames in sensor_frames.items():
+        data_df = pd.concat(frames, ignore_index=True)
+        # Keep the last measurement if a timestamp is repeated
+        data_dfs[sensor_id] = data_df.drop_duplicates(subset='Timestamp', keep='last').reset_index(drop=True)
+    return data_dfs, missing_sensors
+
+
 def get_pollutant_enum(pollutant_name):
     """Return Pollutant given the Lombardia-specific name"""
     if pollutant_name == 'Ossidi di Azoto':
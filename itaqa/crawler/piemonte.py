@@ -6,10 +6,11 @@ Piemonte data downloader and parser
 
 import pandas as pd
 import re
-import urllib
 
 from bs4 import BeautifulSoup
 
+from itaqa.utils import http_utils
+
 
 def get_PM10_csv():
     """
@@ -20,7 +21,7 @@ def get_PM10_csv():
     """
 
     url = 'http://www.arpa.piemonte.it/rischinaturali/dati_stazioni_pm10.html'
-    html_doc = urllib.request.urlopen(url).read()
+    html_doc = http_utils.fetch(url).read_bytes()
 
     html_soup = BeautifulSoup(html_doc, "lxml")
     table_script = html_soup.findAll("script")[4]
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Spatial index on geographic coordinates, for radius, k-nearest and bounding box queries
+
+Points are indexed by a k-d tree over their 3D unit vectors: the chord between two unit vectors is monotonic with the
+great-circle (haversine) distance, so the tree prunes with plain Euclidean bounds and needs no special case around
+the poles or the antimeridian. Distances are returned in km
+"""
+
+import heapq
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+LEAF_SIZE = 16
+
+
+def to_unit_vectors(lat, lng):
+    """Given lat/lng (degrees) arrays, return the (n, 3) array of the correspondent unit vectors"""
+    lat = np.radians(np.asarray(lat, dtype='float64'))
+    lng = np.radians(np.asarray(lng, dtype='float64'))
+    return np.stack([np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)], axis=-1)
+
+
+def chord_to_distance(chord):
+    """Convert the chord between unit vectors to great-circle distance (km)"""
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(np.asarray(chord) / 2, 1))
+
+
+def distance_to_chord(distance):
+    """Convert a great-circle distance (km) to the chord between unit vectors"""
+    return 2 * np.sin(np.minimum(distance / EARTH_RADIUS_KM, np.pi) / 2)
+
+
+def haversine_distance(lat1, lng1, lat2, lng2):
+    """Great-circle distance (km) between points given in degrees (arrays are broadcasted)"""
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    hav = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2)**2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(hav, 1)))
+
+
+class SpatialIndex():
+    """
+    Static spatial index over a set of points given as lat/lng (degrees)
+
+    Queries return the positions of the points (in the order they were given) and their distances in km
+
+    Args:
+        lat (array-like): Latitudes of the points
+        lng (array-like): Longitudes of the points
+        leaf_size (int): Maximum amount of points in a leaf of the k-d tree
+
+    Examples:
+        SpatialIndex([45.46, 45.07], [9.19, 7.69]).query_knn(45.5, 9.2, k=1)
+    """
+    def __init__(self, lat, lng, leaf_size=LEAF_SIZE):
+        self.lat = np.asarray(lat, dtype='float64').reshape(-1)
+        self.lng = np.asarray(lng, dtype='float64').reshape(-1)
+        self.points = to_unit_vectors(self.lat, self.lng).reshape(-1, 3)
+        self.leaf_size = leaf_size
+        self.order = np.arange(len(self.lat))
+        # Nodes of the k-d tree: [start, end] range in order, children (-1 for leaves), bounding box of the points
+        self._nodes = []
+        self._box_min = []
+        self._box_max = []
+        if len(self.lat):
+            self._build(0, len(self.lat))
+        self._box_min = np.array(self._box_min).reshape(-1, 3)
+        self._box_max = np.array(self._box_max).reshape(-1, 3)
+        # Points sorted by latitude, for bounding box queries
+        self._lat_order = np.argsort(self.lat, kind='stable')
+        self._lat_sorted = self.lat[self._lat_order]
+
+    def __len__(self):
+        return len(self.lat)
+
+    def _build(self, start, end):
+        """Build the subtree holding order[start:end], return the id of its root node"""
+        node_id = len(self._nodes)
+        points = self.points[self.order[start:end]]
+        self._nodes.append([start, end, -1, -1])
+        self._box_min.append(points.min(axis=0))
+        self._box_max.append(points.max(axis=0))
+        if end - start > self.leaf_size:
+            # Split at the median of the widest dimension
+            dim = np.argmax(self._box_max[node_id] - self._box_min[node_id])
+            mid = (start + end) // 2
+            partition = np.argpartition(points[:, dim], mid - start)
+            self.order[start:end] = self.order[start:end][partition]
+            self._nodes[node_id][2] = self._build(start, mid)
+            self._nodes[node_id][3] = self._build(mid, end)
+        return node_id
+
+    def _box_chord(self, node_id, point):
+        """Lower bound of the chord between point and the points of a node"""
+        gap = np.maximum(0, np.maximum(self._box_min[node_id] - point, point - self._box_max[node_id]))
+        return np.sqrt(gap @ gap)
+
+    def _leaf_chords(self, node_id, point):
+        """Return positions and chords from point of the points of a leaf"""
+        start, end = self._nodes[node_id][:2]
+        idx = self.order[start:end]
+        return idx, np.sqrt(((self.points[idx] - point)**2).sum(axis=1))
+
+    def query_radius(self, lat, lng, radius):
+        """Return positions and distances of the points within radius km from lat/lng, sorted by distance"""
+        if not self._nodes:
+            return np.empty(0, dtype='int64'), np.empty(0)
+        point = to_unit_vectors(lat, lng)
+        max_chord = distance_to_chord(radius)
+        found_idx, found_chords = [np.empty(0, dtype='int64')], [np.empty(0)]
+        stack = [0]
+        while stack:
+            node_id = stack.pop()
+            if self._box_chord(node_id, point) > max_chord:
+                continue
+            _, _, left, right = self._nodes[node_id]
+            if left < 0:
+                idx, chords = self._leaf_chords(node_id, point)
+                within = chords <= max_chord
+                found_idx.append(idx[within])
+                found_chords.append(chords[within])
+            else:
+                stack.extend((left, right))
+        idx, chords = np.concatenate(found_idx), np.concatenate(found_chords)
+        sort = np.argsort(chords, kind='stable')
+        return idx[sort], chord_to_distance(chords[sort])
+
+    def query_knn(self, lat, lng, k):
+        """Return positions and distances of the k points nearest to lat/lng, sorted by distance"""
+        if not self._nodes or k < 1:
+            return np.empty(0, dtype='int64'), np.empty(0)
+        point = to_unit_vectors(lat, lng)
+        # Best-first visit of the nodes, nearest bounding boxes first; best holds the k nearest points (max-heap)
+        nodes = [(self._box_chord(0, point), 0)]
+        best = []
+        while nodes:
+            box_chord, node_id = heapq.heappop(nodes)
+            if len(best) == k and box_chord > -best[0][0]:
+                break
+            _, _, left, right = self._nodes[node_id]
+            if left < 0:
+                idx, chords = self._leaf_chords(node_id, point)
+                for pos, chord in zip(idx, chords):
+                    if len(best) < k:
+                        heapq.heappush(best, (-chord, pos))
+                    elif chord < -best[0][0]:
+                        heapq.heapreplace(best, (-chord, pos))
+            else:
+                for child in (left, right):
+                    heapq.heappush(nodes, (self._box_chord(child, point), child))
+        best.sort(key=lambda item: (-item[0], item[1]))
+        idx = np.array([pos for _, pos in best], dtype='int64')
+        return idx, chord_to_distance(np.array([-chord for chord, _ in best]))
+
+    def query_bbox(self, min_lat, min_lng, max_lat, max_lng):
+        """
+        Return positions of the points within the bounding box, sorted by position
+
+        If min_lng > max_lng, the box crosses the antimeridian
+        """
+        start = np.searchsorted(self._lat_sorted, min_lat, side='left')
+        end = np.searchsorted(self._lat_sorted, max_lat, side='right')
+        idx = self._lat_order[start:end]
+        lng = self.lng[idx]
+        if min_lng <= max_lng:
+            within = (lng >= min_lng) & (lng <= max_lng)
+        else:
+            within = (lng >= min_lng) | (lng <= max_lng)
+        return np.sort(idx[within])
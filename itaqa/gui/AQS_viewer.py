@@ -10,7 +10,7 @@ import sys
 from datetime import datetime
 from pathlib import Path
 
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QThread, pyqtSignal
 from PyQt5.QtGui import QBrush, QColor, QFont, QGuiApplication, QKeySequence
 from PyQt5.QtWidgets import (
     QAbstractItemView,
@@ -21,6 +21,7 @@ from PyQt5.QtWidgets import (
     QHeaderView,
     QLabel,
     QListWidget,
+    QProgressBar,
     QPushButton,
     QShortcut,
     QTableWidget,
@@ -29,12 +30,46 @@ from PyQt5.QtWidgets import (
     QVBoxLayout,
 )
 
-from itaqa.core.AirQualityStationCollection import AirQualityStationCollection
 from itaqa.core.defs import Pollutant
+from itaqa.utils.AQSC_utils import load_AQSC_progressively
+from itaqa.utils.AQS_utils import count_values
+from itaqa.utils.cache_utils import CollectionCache, get_file_signature
 
 logger = logging.getLogger(__name__)
 
 
+class AQSCLoader(QThread):
+    """
+    Load an AQSC file in background, without freezing the GUI
+
+    The collection is first loaded lazily (only the index) and emitted with metadata_loaded, then the data of each
+    AQS is decoded, emitting progress (decoded AQS, total AQS) and finally data_loaded (see
+    AQSC_utils.load_AQSC_progressively)
+    The loading stops at the next AQS once an interruption is requested (see QThread.requestInterruption)
+    The signature of the file is taken before the loading (see cache_utils.get_file_signature)
+    """
+    metadata_loaded = pyqtSignal(object)
+    progress = pyqtSignal(int, int)
+    data_loaded = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, file_path, parent=None):
+        super(AQSCLoader, self).__init__(parent)
+        self.file_path = file_path
+        self.signature = None
+
+    def run(self):
+        try:
+            self.signature = get_file_signature(self.file_path)
+            AQSC = load_AQSC_progressively(self.file_path, self.metadata_loaded.emit, self.progress.emit,
+                                           self.isInterruptionRequested)
+            if AQSC is not None:
+                self.data_loaded.emit(AQSC)
+        except Exception as err:
+            logger.exception(f"Loading of '{self.file_path}' failed")
+            self.failed.emit(repr(err))
+
+
 class Dialog(QDialog):
     def __init__(self, parent=None):
         super(Dialog, self).__init__()
@@ -51,6 +86,10 @@ class Dialog(QDialog):
         self.AQS_stored.setSelectionMode(QAbstractItemView.ExtendedSelection)
         self.AQS_stored.setMinimumHeight(200)
         self.AQS_info = QTextBrowser()
+        # AQSC loading progress
+        self.loading_progress = QProgressBar()
+        self.loading_progress.setFormat("Loading data: %v/%m")
+        self.loading_progress.hide()
         # AQS pollutants table
         self.table_pl = QTableWidget()
         self.table_pl.setSelectionMode(QAbstractItemView.NoSelection)
@@ -93,6 +132,7 @@ class Dialog(QDialog):
         grid.addWidget(self.AQS_info, 6, 1, 1, 1)
         grid.addWidget(self.table_pl, 7, 1, 2, 1)
         grid.addLayout(buttons_layout, 6, 2, 3, 1)
+        grid.addWidget(self.loading_progress, 9, 0, 1, 3)
 
         ## Window properties
         self.setLayout(grid)
@@ -116,6 +156,8 @@ class Dialog(QDialog):
         self.dir_path = ''
         self.AQSC_loaded = None
         self.AQS_selected = None
+        self.AQSC_loader = None
+        self.AQSC_cache = CollectionCache()
 
     def browse_folder(self):
         """Open 'browse folder' dialog"""
@@ -131,24 +173,94 @@ class Dialog(QDialog):
                 self.files_list.addItem(ff.name)
 
     def refresh_selected_AQSC_info(self, item):
-        """List all .msgpack files in the selected folder"""
-        AQSC_selected = Path(self.dir_path + '/' + item.text())
-        self.AQSC_loaded = AirQualityStationCollection(file_path=AQSC_selected)
-        filename_info = parse_filename(item.text())
-        self.AQSC_info.setMarkdown(f"Stored AQS: **{len(self.AQSC_loaded.AQS_list)}**\n\n" +
-                                   f"Date range: from **{filename_info['min_dt']}** to "
-                                   f"**{filename_info['max_dt']}**")
+        """
+        Show the selected AQSC, from the cache if loaded before (and unchanged), otherwise loading it in background
+
+        The loading of the previously selected AQSC, if any, is stopped
+        """
+        if self.AQSC_loader is not None:
+            self.AQSC_loader.requestInterruption()
+            self.AQSC_loader = None
+        self.clear_selection()
+        self.AQSC_loaded = None
+        self.AQS_selected = None
+        self.button_AQS_plot.setDisabled(True)
+        file_path = Path(self.dir_path + '/' + item.text())
+        AQSC = self.AQSC_cache.get(file_path)
+        if AQSC is not None:
+            self.show_AQSC(AQSC, file_path)
+            return
+        self.AQSC_info.setMarkdown(f"Loading **{item.text()}**...")
+
+        # The loader is owned by the dialog and deleted once finished (also if interrupted, see loader_finished)
+        self.AQSC_loader = AQSCLoader(file_path, parent=self)
+        self.AQSC_loader.metadata_loaded.connect(self.show_AQSC_metadata)
+        self.AQSC_loader.progress.connect(self.show_loading_progress)
+        self.AQSC_loader.data_loaded.connect(self.loading_completed)
+        self.AQSC_loader.failed.connect(self.loading_failed)
+        self.AQSC_loader.finished.connect(self.loader_finished)
+        self.AQSC_loader.start()
+
+    def is_current_loader(self):
+        """Check if a signal comes from the loader of the selected AQSC (not from an interrupted one)"""
+        return self.AQSC_loader is not None and self.sender() is self.AQSC_loader
+
+    def loader_finished(self):
+        """Delete a loader once its thread is finished"""
+        if self.is_current_loader():
+            self.AQSC_loader = None
+        self.sender().deleteLater()
+
+    def show_AQSC(self, AQSC, file_path):
+        """Show the AQSC information and list its AQS"""
+        self.AQSC_loaded = AQSC
+        info = f"Stored AQS: **{len(AQSC.AQS_list)}**"
+        try:
+            filename_info = parse_filename(file_path.name)
+            info += f"\n\nDate range: from **{filename_info['min_dt']}** to **{filename_info['max_dt']}**"
+        except (IndexError, ValueError):
+            logger.warning(f"Cannot parse the file name '{file_path.name}'")
+        self.AQSC_info.setMarkdown(info)
         self.AQS_stored.clear()
-        for AQS in self.AQSC_loaded.AQS_list:
+        for AQS in AQSC.AQS_list:
             self.AQS_stored.addItem(AQS.name)
 
+    def show_AQSC_metadata(self, AQSC):
+        """Show the AQSC as soon as its index is loaded, while its data keeps loading"""
+        if not self.is_current_loader():
+            return
+        self.show_AQSC(AQSC, self.AQSC_loader.file_path)
+        self.loading_progress.setRange(0, len(AQSC.AQS_list))
+        self.loading_progress.setValue(0)
+        self.loading_progress.show()
+
+    def show_loading_progress(self, loaded, total):
+        """Update the progress bar with the AQS decoded so far"""
+        if self.is_current_loader():
+            self.loading_progress.setValue(loaded)
+
+    def loading_completed(self, AQSC):
+        """Hide the progress bar once the data of all the AQS is decoded, cache the fully loaded AQSC"""
+        if self.is_current_loader():
+            self.loading_progress.hide()
+            self.AQSC_cache.put(self.AQSC_loader.file_path, AQSC, self.AQSC_loader.signature)
+
+    def loading_failed(self, error):
+        """Show the error that stopped the loading"""
+        if self.is_current_loader():
+            self.loading_progress.hide()
+            self.AQSC_info.setMarkdown(f"Loading failed: {error}")
+
     def refresh_selected_AQS_info(self, item):
-        """Update the shown information on the selected AQS"""
-        self.AQS_selected = self.AQSC_loaded.search(item.text())
+        """Update the shown information on the selected AQS (counting its values from its rollups, if stored)"""
+        if self.AQSC_loaded is None:
+            return
+        self.AQS_selected = self.AQSC_loaded.search(item.text(), mode='exact')
         if isinstance(self.AQS_selected, list):
             raise ValueError("More than one station with the same name")
-        tot_data = self.AQS_selected.data.shape[0]
-        pls = ', '.join(map(str, [pl for pl in self.AQS_selected.data.columns.to_list() if pl != 'Timestamp']))
+        tot_data = self.AQS_selected.entries
+        counts = count_values(self.AQS_selected)
+        pls = ', '.join(map(str, counts))
         self.AQS_info.setMarkdown(f"**{self.AQS_selected.name}**\n\nEntries: **{tot_data}**\n\nPollutants:\n\n{pls}")
         self.table_pl.clearContents()
 
@@ -160,9 +272,9 @@ class Dialog(QDialog):
         pl_list = [pl.name for pl in Pollutant if pl.name != 'UNSET']
         for i, pl in enumerate(pl_list):
             header_pl = self.table_pl.model().headerData(i, Qt.Vertical)
-            if header_pl in [pl for pl in self.AQS_selected.data.columns.to_list() if pl != 'Timestamp']:
+            if header_pl in counts:
                 self.table_pl.setItem(i, 0, QTableWidgetItem(green_cell))
-                count_cell = QTableWidgetItem(str(self.AQS_selected.data[pl].count()))
+                count_cell = QTableWidgetItem(str(counts[header_pl]))
                 count_cell.setFont(fnt)
                 self.table_pl.setItem(i, 1, count_cell)
             else:
@@ -172,13 +284,29 @@ class Dialog(QDialog):
 
     def AQS_plot(self):
         """Call AQS.plot()"""
-        self.AQS_selected.plot()
+        if self.AQS_selected is not None:
+            self.AQS_selected.plot()
+
+    def stop_loaders(self):
+        """Interrupt the running loaders and wait for their threads to finish"""
+        loaders = self.findChildren(AQSCLoader)
+        for loader in loaders:
+            loader.requestInterruption()
+        for loader in loaders:
+            loader.wait()
+
+    def closeEvent(self, event):
+        """Stop the running loaders before closing the dialog"""
+        self.stop_loaders()
+        super(Dialog, self).closeEvent(event)
 
     def clear_selection(self):
         """Clear all widgets"""
         self.AQSC_info.clear()
         self.AQS_stored.clear()
         self.AQS_info.clear()
+        self.table_pl.clearContents()
+        self.loading_progress.hide()
 
 
 def prepare_table_cells():
@@ -216,6 +344,8 @@ def start_GUI():
     # Create and show the main Dialog
     dialog = Dialog(app)
     dialog.show()
+    # Also when the dialog is dismissed without being closed (e.g. Esc)
+    app.aboutToQuit.connect(dialog.stop_loaders)
 
     # Run the main Qt loop
     sys.exit(app.exec_())
@@ -4,8 +4,12 @@
 Tests for AirQualityStation objects
 """
 
+import json
+import msgpack
 import pandas as pd
 import pytest
+import threading
+import time
 
 from itaqa.core.AirQualityStation import AirQualityStation
 from itaqa.utils.AQS_utils import check_AQS_equality
@@ -48,3 +52,79 @@ def test_serialization_regression_load():
         load_AQS_from_msgpack('itaqa/test/test_data/AQS_MountDoom.msgpack')
     except Exception:
         pytest.fail("myFunc() raised ExceptionType unexpectedly!")
+
+
+def test_serialization_columnar(dummy_AQS):
+    """
+    Check if the columnar format preserves dtypes and missing values
+    [Fail] If typed column buffers are not decoded back to the original data
+    """
+    dummy_AQS.data['SO2'] = dummy_AQS.data['SO2'].astype('float32')
+    dummy_AQS.data['NO2'] = 1.5
+    dummy_AQS.data.loc[3, 'NO2'] = float('nan')
+    encoded_AQS = AirQualityStation.encode_AQS_msgpack(dummy_AQS)
+    decoded_AQS = AirQualityStation.decode_AQS_msgpack(msgpack.unpackb(msgpack.packb(encoded_AQS)))
+    assert decoded_AQS.data['Timestamp'].dtype == 'datetime64[ns]'
+    assert decoded_AQS.data['SO2'].dtype == 'float32'
+    pd.testing.assert_frame_equal(decoded_AQS.data, dummy_AQS.data.astype({'Timestamp': 'datetime64[ns]'}))
+
+
+def test_serialization_legacy_decode(dummy_AQS):
+    """
+    Check if AQS encoded with the first (JSON-based) format are still decoded
+    [Fail] If legacy decoding is broken
+    """
+    legacy_data = dummy_AQS.data.copy()
+    legacy_data['Timestamp'] = pd.to_datetime(legacy_data['Timestamp']).astype('int64') // 10**9
+    encoded_AQS = AirQualityStation.encode_AQS_msgpack(dummy_AQS)
+    encoded_AQS.pop('m_version')
+    encoded_AQS['m_data'] = json.dumps(legacy_data.to_dict())
+    decoded_AQS = AirQualityStation.decode_AQS_msgpack(encoded_AQS)
+    assert check_AQS_equality([dummy_AQS, decoded_AQS], compare_metadata=False, compare_data=True)
+
+
+def test_lazy_data_concurrent_access(dummy_AQS):
+    """
+    Check that lazy data requested by multiple threads at once is decoded only once
+    [Fail] If the decoding is not guarded (data decoded twice or loader called after being cleared)
+    """
+    calls = []
+
+    def loader():
+        calls.append(threading.get_ident())
+        time.sleep(0.05)
+        return dummy_AQS.data.copy()
+
+    AQS = AirQualityStation('Mount Doom')
+    AQS.set_lazy_data(loader, {'pollutants': ['SO2'], 'rows': dummy_AQS.entries, 'min_ts': None, 'max_ts': None})
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(AQS.data)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1 and len(results) == 4
+    assert all(df is results[0] for df in results) and AQS.is_loaded
+
+    # The decoding of an AQS does not wait for the one of another AQS
+    decoded = threading.Event()
+    waited = []
+
+    def waiting_loader():
+        waited.append(decoded.wait(timeout=5))
+        return dummy_AQS.data.copy()
+
+    def loader():
+        decoded.set()
+        return dummy_AQS.data.copy()
+
+    summary = {'pollutants': ['SO2'], 'rows': dummy_AQS.entries, 'min_ts': None, 'max_ts': None}
+    AQS_list = [AirQualityStation('Mount Doom'), AirQualityStation('Orodruin')]
+    for AQS, AQS_loader in zip(AQS_list, [waiting_loader, loader]):
+        AQS.set_lazy_data(AQS_loader, summary)
+    thread = threading.Thread(target=lambda: AQS_list[0].data)
+    thread.start()
+    time.sleep(0.05)
+    AQS_list[1].data
+    thread.join()
+    assert waited == [True]
@@ -0,0 +1,535 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for AirQualityStationCollection objects
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from datetime import datetime
+
+from itaqa.core.AirQualityStation import AirQualityStation
+from itaqa.core.AirQualityStationCollection import AirQualityStationCollection
+from itaqa.geography import Italy
+from itaqa.utils import AQSC_utils, serialization_utils
+from itaqa.utils.AQS_utils import check_AQS_equality, count_values
+from itaqa.utils.serialization_utils import dump_AQS_to_msgpack
+
+
+@pytest.fixture
+def dummy_AQSC():
+    AQSC = AirQualityStationCollection()
+    locations = [('Barad-dur', -39.20, 175.58), ('Minas Morgul', -39.28, 175.56), ('Cirith Ungol', -39.25, 175.60)]
+    for idx, (name, lat, lng) in enumerate(locations):
+        AQS = AirQualityStation(name)
+        AQS.set_address(region=Italy.Region.LOMBARDIA, province=Italy.Province.MI, comune='Mordor')
+        AQS.set_geolocation(lat=lat, lng=lng, alt=1000 + idx)
+        timestamps = pd.date_range(start='2020-01-01', periods=48 * (idx + 1), freq='H')
+        AQS.data = pd.DataFrame({
+            'Timestamp': timestamps,
+            'NO2': np.arange(len(timestamps), dtype='float64') + idx,
+            'PM10': np.linspace(10, 60, len(timestamps))
+        })
+        AQSC.add(AQS)
+    return AQSC
+
+
+def test_save_load(dummy_AQSC, tmp_path):
+    """
+    Check if a collection is unchanged after save and load
+    [Fail] If the AQSC file layout is broken
+    """
+    dummy_AQSC.save(tmp_path / 'AQSC.msgpack')
+    loaded_AQSC = AirQualityStationCollection(file_path=tmp_path / 'AQSC.msgpack')
+    assert len(loaded_AQSC.AQS_list) == len(dummy_AQSC.AQS_list)
+    for AQS in dummy_AQSC:
+        assert check_AQS_equality([AQS, loaded_AQSC[AQS.uuid]], compare_metadata=True, compare_data=True)
+
+
+def test_load_lazy(dummy_AQSC, tmp_path):
+    """
+    Check if a lazily loaded collection exposes the index without decoding the data
+    [Fail] If the AQS data is decoded before being accessed, or the index is wrong
+    """
+    dummy_AQSC.save(tmp_path / 'AQSC.msgpack')
+    lazy_AQSC = AirQualityStationCollection(file_path=tmp_path / 'AQSC.msgpack', lazy=True)
+    AQS = lazy_AQSC.search('minas')
+    assert not AQS.is_loaded
+    assert AQS.pollutants == ['NO2', 'PM10']
+    assert AQS.entries == 96
+    assert AQS.time_range == (pd.Timestamp('2020-01-01 00:00'), pd.Timestamp('2020-01-04 23:00'))
+    lazy_AQSC.info()
+    assert not any(AQS.is_loaded for AQS in lazy_AQSC)
+    pd.testing.assert_frame_equal(AQS.data, dummy_AQSC[AQS.uuid].data)
+    assert AQS.is_loaded
+
+
+def test_load_legacy_layout(dummy_AQSC, tmp_path):
+    """
+    Check if collections saved as a plain msgpack list of AQS are still loadable
+    [Fail] If loading of files written before the indexed layout is broken
+    """
+    dump_AQS_to_msgpack(dummy_AQSC.AQS_list, tmp_path / 'AQSC.msgpack')
+    loaded_AQSC = AirQualityStationCollection(file_path=tmp_path / 'AQSC.msgpack', lazy=True)
+    assert sorted(loaded_AQSC.AQS_dict) == sorted(dummy_AQSC.AQS_dict)
+
+
+def test_load_mmap(dummy_AQSC, tmp_path):
+    """
+    Check if a memory-mapped collection exposes zero-copy column views and the same data
+    [Fail] If column buffers are copied or decoded wrongly from the mapped file
+    """
+    dummy_AQSC.save(tmp_path / 'AQSC.msgpack')
+    mmap_AQSC = AirQualityStationCollection(file_path=tmp_path / 'AQSC.msgpack', use_mmap=True)
+    for AQS in mmap_AQSC:
+        NO2 = AQS.get_column('NO2')
+        assert not NO2.flags.owndata and not NO2.flags.writeable
+        assert AQS.get_column('Timestamp').dtype == 'datetime64[ns]'
+        assert not AQS.is_loaded
+        pd.testing.assert_frame_equal(AQS.data, dummy_AQSC[AQS.uuid].data)
+        AQS.data.loc[0, 'NO2'] = -1
+
+
+def test_load_AQSC_progressively(dummy_AQSC, tmp_path):
+    """
+    Check the background loading of the viewer: index first, then the data of each AQS, stopping when interrupted
+    [Fail] If the index is not emitted before decoding the data, progress is wrong or interruptions are ignored
+    """
+    dummy_AQSC.save(tmp_path / 'AQSC.msgpack')
+    events = []
+
+    def metadata_loaded(AQSC):
+        events.append(('metadata', sum(AQS.is_loaded for AQS in AQSC)))
+
+    def progress(decoded, total):
+        events.append(('progress', decoded, total))
+
+    AQSC = AQSC_utils.load_AQSC_progressively(tmp_path / 'AQSC.msgpack', metadata_loaded, progress, lambda: False)
+    assert events == [('metadata', 0), ('progress', 1, 3), ('progress', 2, 3), ('progress', 3, 3)]
+    assert all(AQS.is_loaded for AQS in AQSC)
+
+    def is_interrupted():
+        return len(events) > 1
+
+    events.clear()
+    assert AQSC_utils.load_AQSC_progressively(tmp_path / 'AQSC.msgpack', metadata_loaded, progress,
+                                              is_interrupted) is None
+    assert events == [('metadata', 0), ('progress', 1, 3)]
+
+
+def test_update_AQSC_file(dummy_AQSC, tmp_path):
+    """
+    Check if only the data newer than the last entry of each station is appended, in a new file or in place
+    [Fail] If the incremental update duplicates or loses data
+    """
+    def get_AQSC(dt_range, redownload):
+        new_AQSC = AirQualityStationCollection()
+        for name in ['Barad-dur', 'Osgiliath']:
+            AQS = AirQualityStation(name)
+            timestamps = pd.date_range(start='2020-01-02', periods=48, freq='H')
+            AQS.data = pd.DataFrame({'Timestamp': timestamps, 'NO2': 1.0})
+            new_AQSC.add(AQS)
+        return new_AQSC
+
+    file_path = tmp_path / 'AQSC.msgpack'
+    dummy_AQSC.save(file_path, rollups=['daily'])
+    for overwrite in [False, True]:
+        AQSC = AirQualityStationCollection(file_path=file_path, lazy=True)
+        new_file_path, appended_rows = AQSC_utils.update_AQSC_file(AQSC, file_path, get_AQSC, overwrite)
+        assert appended_rows == 24 + 48
+        assert new_file_path == (file_path if overwrite else tmp_path / 'AQSC_updated.msgpack')
+        if overwrite:
+            # Only the added station is in memory, the new rows of the others are appended without decoding them
+            assert [AQS.name for AQS in AQSC if AQS.is_loaded] == ['Osgiliath']
+        updated_AQSC = AirQualityStationCollection(file_path=new_file_path)
+        AQS = updated_AQSC.search('Barad-dur')
+        assert AQS.entries == 72 and list(AQS.data.columns) == ['Timestamp', 'NO2', 'PM10']
+        assert AQS.data['Timestamp'].is_monotonic_increasing and AQS.data['Timestamp'].is_unique
+        assert len(updated_AQSC.AQS_list) == 4
+        if not overwrite:
+            assert serialization_utils.get_rollup_frequencies(new_file_path) == ['daily']
+            assert all(AQS.has_rollup('daily') for AQS in updated_AQSC)
+
+
+def test_update_range_and_matching(dummy_AQSC, tmp_path):
+    """
+    Check the time range requested by an update and the matching of the new data with stations sharing a name
+    [Fail] If updates ask for data the crawler cannot provide, are started by lagging stations, or attach new data to
+           the wrong station
+    """
+    file_path = tmp_path / 'AQSC.msgpack'
+    dummy_AQSC.save(file_path)
+    AQSC = AirQualityStationCollection(file_path=file_path, lazy=True)
+    requested_ranges = []
+
+    def get_AQSC(dt_range, redownload):
+        requested_ranges.append(dt_range)
+        return AirQualityStationCollection()
+
+    # The oldest last entry is on 2020-01-02 23:00, the crawler provides data up to 2020-01-02
+    available_range = (datetime(2018, 1, 1), datetime(2020, 1, 2))
+    assert AQSC_utils.update_AQSC_file(AQSC, file_path, get_AQSC, available_range=available_range) == (None, 0)
+    assert not requested_ranges
+    # The update starts from the oldest last entry, except for the stations lagging more than max_lag behind
+    AQSC_utils.update_AQSC_file(AQSC, file_path, get_AQSC, dt_now=datetime(2020, 2, 1))
+    assert requested_ranges[-1] == [datetime(2020, 1, 2, 23), datetime(2020, 2, 1)]
+    assert AQSC_utils.get_update_start(AQSC, max_lag=pd.Timedelta(days=1)) == pd.Timestamp('2020-01-06 23:00')
+
+    # The max date of downloaded files is the one of the data, clamped to the crawler range
+    filename = '20200101000000_m190101_M191231_lombardia_AQSC.msgpack'
+    AQSC.save(tmp_path / filename)
+    new_file_path, _ = AQSC_utils.update_AQSC_file(AQSC,
+                                                   tmp_path / filename,
+                                                   get_AQSC,
+                                                   dt_now=datetime(2020, 2, 1, 12),
+                                                   available_range=(datetime(2018, 1, 1), datetime(2020, 1, 10)))
+    assert new_file_path.name == '20200201120000_m190101_M200110_lombardia_AQSC.msgpack'
+
+    # Two stations named Barad-dur: new data is matched by location (also given as strings), or discarded if it
+    # cannot be; stations far from the ones with their name are new
+    twin_AQS = AirQualityStation('Barad-dur')
+    twin_AQS.set_geolocation(lat='45.46', lng='9.19')
+    twin_AQS.data = pd.DataFrame({'Timestamp': pd.date_range(start='2020-01-01', periods=24, freq='H'), 'NO2': 0.0})
+    AQSC.add(twin_AQS)
+    new_AQSC = AirQualityStationCollection()
+    for name, lat, lng in [('Barad-dur', '45.461', '9.191'), ('Barad-dur', -39.201, 175.581), ('Barad-dur', None, None),
+                           ('Minas Morgul', '45.0', '9.0'), ('Cirith Ungol', '', '')]:
+        AQS = AirQualityStation(name)
+        if lat is not None:
+            AQS.set_geolocation(lat=lat, lng=lng)
+        AQS.data = pd.DataFrame({'Timestamp': pd.date_range(start='2020-01-02', periods=48, freq='H'), 'NO2': 1.0})
+        new_AQSC.add(AQS)
+    new_data, new_AQS_list = AQSC_utils.get_new_data(AQSC, new_AQSC)
+    original_AQS = [AQS for AQS in AQSC.get_by_name('Barad-dur') if AQS is not twin_AQS][0]
+    assert {uuid: data.shape[0] for uuid, data in new_data.items()} == {twin_AQS.uuid: 48, original_AQS.uuid: 24}
+    # Without a geolocation the only station with the name is matched (its data is already up to date)
+    assert [AQS.name for AQS in new_AQS_list] == ['Minas Morgul']
+
+
+def test_append_segments(dummy_AQSC, tmp_path):
+    """
+    Check if new time slices appended as segments are loaded (lazily, mmap) and kept by the compaction
+    [Fail] If appending segments or compacting an AQSC file is broken
+    """
+    file_path = tmp_path / 'AQSC.msgpack'
+    dummy_AQSC.save(file_path)
+    AQSC = AirQualityStationCollection(file_path=file_path, lazy=True)
+    new_AQSC = AirQualityStationCollection()
+    for name in ['Barad-dur', 'Osgiliath']:
+        AQS = AirQualityStation(name)
+        AQS.data = pd.DataFrame({'Timestamp': pd.date_range(start='2020-01-02', periods=48, freq='H'), 'O3': 1.0})
+        new_AQSC.add(AQS)
+    new_data, new_AQS_list = AQSC_utils.get_new_data(AQSC, new_AQSC)
+    AQSC.add(new_AQS_list)
+    new_data.update({AQS.uuid: AQS.data for AQS in new_AQS_list})
+    AQSC.append_segments(file_path, new_data)
+    assert not any(AQS.is_loaded for AQS in AQSC if AQS.name != 'Osgiliath')
+
+    for loaded_AQSC in [AirQualityStationCollection(file_path=file_path, lazy=True),
+                        AirQualityStationCollection(file_path=file_path, use_mmap=True)]:
+        AQS = loaded_AQSC.search('Barad-dur')
+        assert AQS.pollutants == ['NO2', 'PM10', 'O3'] and AQS.entries == 72
+        assert AQS.data.shape == (72, 4) and AQS.data['Timestamp'].is_monotonic_increasing
+        assert loaded_AQSC.search('Osgiliath').entries == 48
+    assert serialization_utils.compact_AQSC_file(file_path)
+    compacted_AQSC = AirQualityStationCollection(file_path=file_path)
+    assert compacted_AQSC.search('Barad-dur').data.shape == (72, 4)
+    assert len(serialization_utils.load_AQSC_index(file_path)['stations'][0]['segments']) == 1
+
+
+def test_replace_lazily_loaded_file(dummy_AQSC, tmp_path):
+    """
+    Check if lazy AQS decode the data of the file they were loaded from, after it's compacted or overwritten
+    [Fail] If lazy loaders read the new file at the offsets of the old index
+    """
+    file_path = tmp_path / 'AQSC.msgpack'
+    dummy_AQSC.save(file_path, rollups=['daily'])
+    new_data = {
+        AQS.uuid: AQS.data.assign(Timestamp=AQS.data['Timestamp'] + pd.Timedelta(days=30))
+        for AQS in dummy_AQSC
+    }
+    dummy_AQSC.append_segments(file_path, new_data)
+    AQSC = AirQualityStationCollection(file_path=file_path, lazy=True)
+    expected = {AQS.uuid: AQS.data for AQS in AirQualityStationCollection(file_path=file_path)}
+
+    assert serialization_utils.compact_AQSC_file(file_path)
+    AQS = AQSC.search('Barad-dur')
+    pd.testing.assert_frame_equal(AQS.data, expected[AQS.uuid])
+    AirQualityStationCollection().save(file_path)
+    for AQS in AQSC:
+        pd.testing.assert_frame_equal(AQS.data, expected[AQS.uuid])
+
+    dummy_AQSC.save(file_path, rollups=['daily'])
+    AQSC = AirQualityStationCollection(file_path=file_path, lazy=True)
+    dummy_AQSC.save(file_path, rollups=['monthly'])
+    AQS = AQSC.search('Barad-dur')
+    pd.testing.assert_frame_equal(AQS.get_rollup('daily'), dummy_AQSC[AQS.uuid].get_rollup('daily'), check_freq=False)
+
+
+def test_merge_AQSC_multiple(dummy_AQSC):
+    """
+    Check if multiple collections covering overlapping time ranges are merged in a single sorted collection
+    [Fail] If the k-way merge of the AQS data is broken, or stations missing in some collections are not skipped
+    """
+    AQSC_list = []
+    for day in range(3):
+        AQSC = AirQualityStationCollection()
+        for AQS in dummy_AQSC:
+            if AQS.name == 'Cirith Ungol' and day == 1:
+                continue
+            sliced_AQS = AirQualityStation(AQS.name)
+            sliced_AQS.set_address(region=AQS.region, province=AQS.province, comune=AQS.comune)
+            sliced_AQS.geolocation = AQS.geolocation
+            mask = AQS.data['Timestamp'].between(pd.Timestamp('2020-01-01') + pd.Timedelta(days=day),
+                                                 pd.Timestamp('2020-01-02 12:00') + pd.Timedelta(days=day))
+            sliced_AQS.data = AQS.data[mask].reset_index(drop=True)
+            AQSC.add(sliced_AQS)
+        AQSC_list.append(AQSC)
+    merged_AQSC = AQSC_utils.merge_AQSC_multiple(AQSC_list[::-1])
+    assert len(merged_AQSC.AQS_list) == 3
+    for AQS in dummy_AQSC:
+        merged_AQS = merged_AQSC.search(AQS.name)
+        expected = AQS.data[AQS.data['Timestamp'] <= pd.Timestamp('2020-01-04 12:00')].reset_index(drop=True)
+        if AQS.name == 'Cirith Ungol':
+            # Missing in the second collection, the hours not covered by the first and third ones are lost
+            expected = expected[~expected['Timestamp'].between('2020-01-02 12:01', '2020-01-02 23:59')]
+            expected = expected.reset_index(drop=True)
+        pd.testing.assert_frame_equal(merged_AQS.data, expected)
+
+
+def test_search(dummy_AQSC):
+    """
+    Check the name, prefix, exact and uuid searches, and the indexes after additions and removals
+    [Fail] If the name indexes of the collection are not kept in sync
+    """
+    assert dummy_AQSC.search('MINAS').name == 'Minas Morgul'
+    assert [AQS.name for AQS in dummy_AQSC.search('r')] == ['Barad-dur', 'Cirith Ungol', 'Minas Morgul']
+    assert dummy_AQSC.search('barad dur').name == 'Barad-dur'
+    assert dummy_AQSC.search('cir', mode='prefix').name == 'Cirith Ungol'
+    assert dummy_AQSC.search('ungol', mode='prefix') == []
+    assert dummy_AQSC.search('barad dur', mode='exact') == []
+    AQS = dummy_AQSC.search('Barad-dur', mode='exact')
+    assert dummy_AQSC.search(AQS.uuid, mode='uuid') is AQS
+    version = dummy_AQSC.version
+    dummy_AQSC.add(AirQualityStation('Barad-dûr'))
+    assert dummy_AQSC.version == version + 1
+    assert len(dummy_AQSC.search('barad dur', mode='normalized')) == 2
+    assert [AQS.name for AQS in dummy_AQSC.AQS_list][:2] == ['Barad-dur', 'Barad-dûr']
+    dummy_AQSC.remove(AQS.uuid)
+    assert dummy_AQSC.search('barad').name == 'Barad-dûr'
+    assert dummy_AQSC.get_by_name('Barad-dur') == []
+    assert len(dummy_AQSC.AQS_list) == 3
+
+
+def test_spatial_queries(dummy_AQSC):
+    """
+    Check the nearest station, radius and bounding box queries on a collection, filtered by pollutant
+    [Fail] If the spatial index of the collection is broken or not invalidated on changes
+    """
+    AQS, distance = dummy_AQSC.nearest(-39.20, 175.59)[0]
+    assert AQS.name == 'Barad-dur' and 0.8 < distance < 0.9
+    assert [AQS.name for AQS, _ in dummy_AQSC.within_radius(-39.20, 175.58, 6)] == ['Barad-dur', 'Cirith Ungol']
+    bbox_AQS = dummy_AQSC.within_bbox(-39.30, 175.55, -39.22, 175.61)
+    assert [AQS.name for AQS in bbox_AQS] == ['Cirith Ungol', 'Minas Morgul']
+    assert dummy_AQSC.nearest(-39.20, 175.58, pollutant='O3') == []
+    AQS = AirQualityStation('Osgiliath')
+    AQS.set_geolocation(lat='-39.21', lng='175.58')
+    AQS.data = pd.DataFrame({'Timestamp': pd.date_range(start='2020-01-01', periods=24, freq='H'), 'O3': 1.0})
+    dummy_AQSC.add(AQS)
+    assert dummy_AQSC.nearest(-39.20, 175.58, k=3, pollutant='O3')[0][0] is AQS
+    assert dummy_AQSC.nearest(-39.20, 175.58, k=2)[1][0] is AQS
+
+
+def test_group_by_location():
+    """
+    Check if sensors with the same name are merged only when nearby, aligning their data on Timestamp
+    [Fail] If the clustering of the sensors or the merge of their data is broken
+    """
+    AQSC = AirQualityStationCollection()
+    sensors = [('Isengard', 'NO2', (-39.02, 175.60), 0), ('Isengard', 'PM10', (-39.02, 175.60), 12),
+               ('Isengard', 'CO', (-39.02, 175.6001), 0), ('Isengard', 'O3', None, 0),
+               ('Isengard', 'NO2', (-40.02, 175.60), 0),
+               ('Edoras', 'NO2', (-39.02, 175.60), 0)]
+    for name, pollutant, geolocation, shift in sensors:
+        AQS = AirQualityStation(name)
+        if geolocation:
+            AQS.set_geolocation(*geolocation)
+        AQS.data = pd.DataFrame({
+            'Timestamp': pd.date_range(start='2020-01-01', periods=24, freq='H') + pd.Timedelta(hours=shift),
+            pollutant: 1.0
+        })
+        AQSC.add(AQS)
+    groups = AQSC_utils.group_by_location(AQSC)
+    assert {name: len(group) for name, group in groups.items()} == {'Edoras': 1, 'Isengard': 4, 'Isengard (2)': 1}
+    AQSC_utils.merge_by_group(AQSC, groups)
+    AQS = AQSC.search('Isengard', mode='exact')
+    assert AQS.geolocation == [-39.02, 175.60, None]
+    assert sorted(AQS.metadata['premerge_history']) == ['CO', 'NO2', 'O3', 'PM10']
+    assert AQS.data.shape == (36, 5) and AQS.data['Timestamp'].is_monotonic_increasing
+    assert AQS.data['PM10'].isna().sum() == 12 and AQS.data['NO2'].isna().sum() == 12
+    assert AQSC.search('Isengard (2)', mode='exact').data.shape == (24, 2)
+
+    # Clusters of the same size are keyed by location, whatever the order of the AQS
+    for locations in [[(-41.0, 175.60), (-40.0, 175.60)], [(-40.0, 175.60), (-41.0, 175.60)]]:
+        AQSC = AirQualityStationCollection()
+        for lat, lng in locations:
+            AQS = AirQualityStation('Rohan')
+            AQS.set_geolocation(lat=lat, lng=lng)
+            AQSC.add(AQS)
+        groups = AQSC_utils.group_by_location(AQSC)
+        assert [groups[name][0].geolocation[0] for name in ['Rohan', 'Rohan (2)']] == [-41.0, -40.0]
+
+
+def test_group_by(dummy_AQSC):
+    """
+    Check if grouping by attribute or function returns the AQS themselves, whatever the order of addition
+    [Fail] If the grouping depends on the order of the AQS or copies them
+    """
+    AQS_list = dummy_AQSC.AQS_list
+    twin_AQS = AirQualityStation('Barad-dur')
+    twin_AQS.set_address(region=Italy.Region.LOMBARDIA, province=Italy.Province.LC)
+    groups = [
+        AirQualityStationCollection(AQS=AQS_list + [twin_AQS]).group_by('name'),
+        AirQualityStationCollection(AQS=[twin_AQS] + AQS_list[::-1]).group_by('name')
+    ]
+    assert groups[0] == groups[1]
+    assert list(groups[0]) == ['Barad-dur', 'Cirith Ungol', 'Minas Morgul']
+    assert twin_AQS in groups[0]['Barad-dur'] and groups[0]['Minas Morgul'][0] is dummy_AQSC.search('Minas')
+    dummy_AQSC.add(twin_AQS)
+    provinces = dummy_AQSC.group_by('province')
+    assert {k: len(v) for k, v in provinces.items()} == {Italy.Province.MI: 3, Italy.Province.LC: 1}
+    assert sorted(dummy_AQSC.group_by(lambda AQS: AQS.entries > 48)) == [False, True]
+    assert AQSC_utils.group_by_name(dummy_AQSC) == dummy_AQSC.group_by('name')
+
+
+def test_long_wide_datasets(dummy_AQSC, tmp_path):
+    """
+    Check the long and wide datasets of a collection, their cache and their statistics
+    [Fail] If the collection-wide datasets do not match the AQS data or are not invalidated on changes
+    """
+    long_df = dummy_AQSC.to_long()
+    assert long_df.shape == (2 * (48 + 96 + 144), 4)
+    assert list(long_df['pollutant'].cat.categories) == ['NO2', 'PM10']
+    assert dummy_AQSC.to_long() is long_df
+    wide_df = dummy_AQSC.to_wide('NO2')
+    assert wide_df.shape == (144, 3) and list(wide_df.columns) == [AQS.uuid for AQS in dummy_AQSC.AQS_list]
+    AQS = dummy_AQSC.search('Minas')
+    assert np.array_equal(wide_df[AQS.uuid].dropna().to_numpy(), AQS.data['NO2'].to_numpy())
+    stats = dummy_AQSC.pollutant_stats()
+    assert stats.loc[(AQS.uuid, 'NO2'), 'max'] == AQS.data['NO2'].max()
+    AQS.data = AQS.data.assign(NO2=np.nan)
+    assert dummy_AQSC.to_long().shape[0] == long_df.shape[0] - 96
+    assert dummy_AQSC.to_wide('NO2')[AQS.uuid].isna().all()
+    dummy_AQSC.save(tmp_path / 'AQSC.msgpack')
+    mmap_AQSC = AirQualityStationCollection(file_path=tmp_path / 'AQSC.msgpack', use_mmap=True)
+    pd.testing.assert_frame_equal(mmap_AQSC.pollutant_stats(), dummy_AQSC.pollutant_stats(), check_categorical=False)
+    assert not any(AQS.is_loaded for AQS in mmap_AQSC)
+
+
+def test_load_filters(tmp_path, monkeypatch):
+    """
+    Check if loading with filters returns the same AQS and data as filtering the whole collection, in all modes
+    [Fail] If the predicate pushdown (index, columns or blocks selection) is broken
+    """
+    AQSC = AirQualityStationCollection()
+    for idx, (name, province) in enumerate([('Hobbiton', Italy.Province.MI), ('Bree', Italy.Province.CO),
+                                            ('Rivendell', Italy.Province.MI)]):
+        AQS = AirQualityStation(name)
+        AQS.set_address(region=Italy.Region.LOMBARDIA, province=province)
+        timestamps = pd.date_range(start='2020-01-01', periods=2000 + 100 * idx, freq='H')
+        AQS.data = pd.DataFrame({
+            'Timestamp': timestamps,
+            'NO2': np.arange(len(timestamps), dtype='float64'),
+            'PM10': pd.array(np.where(np.arange(len(timestamps)) % 7 == 0, None, 1), dtype='Int64'),
+            'Notes': [f'note {ii}' for ii in range(len(timestamps))]
+        })
+        AQSC.add(AQS)
+    file_path = tmp_path / 'AQSC.msgpack'
+    AQSC.save(file_path)
+    filters = {'min_dt': '2020-02-03 05:00', 'max_dt': '2020-02-10', 'pollutants': ['PM10', 'Notes']}
+    for mode in [{}, {'lazy': True}, {'use_mmap': True}]:
+        loaded_AQSC = AirQualityStationCollection(file_path=file_path, provinces=Italy.Province.MI, **filters, **mode)
+        assert [AQS.name for AQS in loaded_AQSC.AQS_list] == ['Hobbiton', 'Rivendell']
+        for AQS in loaded_AQSC:
+            assert AQS.pollutants == ['PM10', 'Notes'] and AQS.entries == 164
+            assert AQS.time_range == (pd.Timestamp(filters['min_dt']), pd.Timestamp(filters['max_dt']))
+            data = AQSC.search(AQS.name).data
+            data = data[data['Timestamp'].between(filters['min_dt'], filters['max_dt'])]
+            pd.testing.assert_frame_equal(AQS.data, data[['Timestamp', 'PM10', 'Notes']].reset_index(drop=True))
+    mmap_AQSC = AirQualityStationCollection(file_path=file_path, use_mmap=True, min_dt='2020-03-01', stations='Bree')
+    AQS = mmap_AQSC.search('Bree')
+    assert not AQS.get_column('NO2').flags.owndata and AQS.get_column('NO2')[0] == 1440
+    assert len(AirQualityStationCollection(file_path=file_path, min_dt='2020-03-29').AQS_list) == 1
+
+    # Lazily, only the index is read at loading: the blocks are read when the data is accessed
+    read_buffer = serialization_utils.read_buffer
+    reads = []
+    monkeypatch.setattr(serialization_utils, 'read_buffer',
+                        lambda fp, offset, size: reads.append(size) or read_buffer(fp, offset, size))
+    lazy_AQSC = AirQualityStationCollection(file_path=file_path, lazy=True, **filters)
+    assert len(lazy_AQSC.AQS_list) == 3 and not reads
+    AQS = lazy_AQSC.search('Hobbiton')
+    assert AQS.entries == 164 and AQS.is_loaded and reads
+    AQS = AirQualityStationCollection(file_path=file_path, lazy=True, pollutants='NO2').search('Bree')
+    assert AQS.entries == 2100 and AQS.time_range[1] == pd.Timestamp('2020-03-28 11:00') and not AQS.is_loaded
+
+
+def test_aggregate(dummy_AQSC):
+    """
+    Check if collection-wide aggregations match the per-station ones and are cached until the data changes
+    [Fail] If the aggregation of the collection is broken or its cache is not invalidated
+    """
+    daily = dummy_AQSC.aggregate('PM10', 'resample', freq='daily', stat='mean')
+    assert daily is dummy_AQSC.aggregate('PM10', 'resample', freq='daily', stat='mean')
+    for AQS in dummy_AQSC:
+        expected = AQS.aggregate('resample', freq='daily', stat='mean')['PM10']
+        pd.testing.assert_series_equal(daily[AQS.uuid].dropna(), expected, check_names=False, check_freq=False)
+    exceedances = dummy_AQSC.aggregate('PM10', 'exceedances')
+    assert exceedances.iloc[0].tolist() == [0, 1, 1]
+    with pytest.raises(ValueError):
+        dummy_AQSC.aggregate('NO2', 'exceedances')
+    AQS = dummy_AQSC.search('Barad-dur')
+    AQS.data = AQS.data.assign(PM10=100.0)
+    assert dummy_AQSC.aggregate('PM10', 'exceedances').iloc[0].tolist() == [2, 1, 1]
+
+
+def test_rollups(dummy_AQSC, tmp_path):
+    """
+    Check if rollups stored with the AQSC are read instead of the data, and dropped when segments are appended
+    [Fail] If storing, loading or invalidating rollups is broken, or they differ from the aggregated data
+    """
+    file_path = tmp_path / 'AQSC.msgpack'
+    dummy_AQSC.save(file_path, rollups=['daily', 'monthly'])
+    AQSC = AirQualityStationCollection(file_path=file_path, lazy=True)
+    assert all(AQS.has_rollup('daily') and not AQS.has_rollup('weekly') for AQS in AQSC)
+    for stat in ['mean', 'count', 'sum']:
+        expected = dummy_AQSC.aggregate('NO2', 'resample', freq='daily', stat=stat, min_count=20)
+        pd.testing.assert_frame_equal(AQSC.aggregate('NO2', 'resample', freq='daily', stat=stat, min_count=20),
+                                      expected,
+                                      check_freq=False,
+                                      check_dtype=False)
+    AQS = AQSC.search('Barad-dur')
+    pd.testing.assert_frame_equal(AQS.aggregate('resample', freq='monthly', stat='max'),
+                                  dummy_AQSC.search('Barad-dur').aggregate('resample', freq='monthly', stat='max'),
+                                  check_freq=False)
+    assert not any(AQS.is_loaded for AQS in AQSC)
+    new_data = {AQS.uuid: AQS.data.assign(Timestamp=AQS.data['Timestamp'] + pd.Timedelta(days=30)).iloc[:24]}
+    AQSC.append_segments(file_path, new_data)
+    AQSC = AirQualityStationCollection(file_path=file_path, lazy=True)
+    assert [AQS.has_rollup('daily') for AQS in AQSC.AQS_list] == [False, True, True]
+    assert serialization_utils.compact_AQSC_file(file_path)
+    AQSC = AirQualityStationCollection(file_path=file_path, lazy=True)
+    assert AQSC.search('Barad-dur').get_rollup('monthly')[('NO2', 'count')].tolist() == [72]
+
+    # Coarser rollups are derived from the stored ones, counts of values are read from them
+    dummy_AQSC.save(file_path, rollups=['daily'])
+    AQSC = AirQualityStationCollection(file_path=file_path, lazy=True)
+    for AQS in AQSC:
+        assert AQS.has_rollup('yearly') and not AQS.has_rollup('weekly')
+        pd.testing.assert_frame_equal(AQS.get_rollup('monthly'),
+                                      dummy_AQSC[AQS.uuid].get_rollup('monthly'),
+                                      check_freq=False)
+        assert count_values(AQS) == {'NO2': AQS.entries, 'PM10': AQS.entries}
+    assert not any(AQS.is_loaded for AQS in AQSC)
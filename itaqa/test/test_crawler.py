@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for the region crawlers (run on local data, no network access)
+"""
+
+import csv
+import pandas as pd
+import pytest
+import threading
+
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from itaqa.crawler import emilia_romagna, lombardia
+from itaqa.geography import Italy
+
+EMILIA_ROMAGNA_BULLETIN = Path(__file__).parent / 'test_data' / 'emilia_romagna_bulletin.html'
+
+# yapf: disable
+LOMBARDIA_METADATA_HEADER = [
+    'idsensore', 'nometiposensore', 'unitamisura', 'idstazione', 'nomestazione', 'quota', 'provincia', 'comune',
+    'storico', 'datastart', 'datastop', 'utm_nord', 'utm_est', 'lat', 'lng', 'location', 'region_1', 'region_2'
+]
+LOMBARDIA_SENSORS = [
+    ['5504', 'Biossido di Azoto', 'µg/m³', '501', 'Milano - Senato', '120', 'MI', 'Milano', 'N',
+     '2001-01-01T00:00:00.000', '', '5035000', '515000', '45.470', '9.197', '(45.470, 9.197)', '1', '2'],
+    ['5551', 'PM10 (SM2005)', 'µg/m³', '501', 'Milano - Senato', '120', 'MI', 'Milano', 'N',
+     '2001-01-01T00:00:00.000', '', '5035000', '515000', '45.470', '9.197', '(45.470, 9.197)', '1', '2'],
+    ['6328', 'Ozono', 'µg/m³', '620', 'Bergamo - Meucci', '249', 'BG', 'Bergamo', 'N',
+     '2001-01-01T00:00:00.000', '', '5062000', '550000', '45.690', '9.642', '(45.690, 9.642)', '1', '2'],
+    ['9999', 'Ammoniaca', 'µg/m³', '620', 'Bergamo - Meucci', '249', 'BG', 'Bergamo', 'N',
+     '2001-01-01T00:00:00.000', '', '5062000', '550000', '45.690', '9.642', '(45.690, 9.642)', '1', '2'],
+]
+# yapf: enable
+
+
+def lombardia_timestamp(dt):
+    """Format a datetime as in the Lombardia open data tables"""
+    return dt.strftime('%d/%m/%Y %I:%M:%S %p')
+
+
+def write_lombardia_data(file_path, start_dt, hours):
+    """Write a Lombardia-like data table with hourly data of the sensors in LOMBARDIA_SENSORS (and an unknown one)"""
+    with open(file_path, 'w', newline='', encoding='utf-8') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(['IdSensore', 'Data', 'Valore', 'Stato', 'idOperatore'])
+        for hour in range(hours):
+            dt = start_dt + timedelta(hours=hour)
+            writer.writerow(['5504', lombardia_timestamp(dt), str(40 + hour % 5), 'VA', '1'])
+            writer.writerow(['5551', lombardia_timestamp(dt), '-9999' if hour == 3 else str(hour), 'VA', '1'])
+            writer.writerow(['6328', lombardia_timestamp(dt), f'{hour / 2:.1f}', 'VA', '1'])
+            writer.writerow(['1234', lombardia_timestamp(dt), '1', 'VA', '1'])
+
+
+@pytest.fixture
+def lombardia_tables(tmp_path, monkeypatch):
+    """Write Lombardia-like metadata and data tables (2019, 2020) in tmp_path/dump/data and move there"""
+    data_dir = tmp_path / 'dump' / 'data'
+    data_dir.mkdir(parents=True)
+    with open(data_dir / 'lombardia_metadata.csv', 'w', newline='', encoding='utf-8') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(LOMBARDIA_METADATA_HEADER)
+        writer.writerows(LOMBARDIA_SENSORS)
+    write_lombardia_data(data_dir / 'lombardia_data_2019.csv', datetime(2019, 12, 31), 24)
+    write_lombardia_data(data_dir / 'lombardia_data_2020.csv', datetime(2020, 1, 1), 72)
+    monkeypatch.chdir(tmp_path)
+
+
+def test_lombardia_get_AQSC(lombardia_tables):
+    """
+    Check if Lombardia tables are parsed into merged stations, restricted to the date range
+    [Fail] If Lombardia ingestion is broken
+    """
+    AQSC = lombardia.get_AQSC(dt_range=[datetime(2020, 1, 1), datetime(2020, 1, 2, 23)], redownload=False)
+    assert sorted(AQS.name for AQS in AQSC) == ['Bergamo - Meucci', 'Milano - Senato']
+    AQS = AQSC.search('Senato')
+    assert AQS.pollutants == ['NO2', 'PM10']
+    assert AQS.entries == 48
+    assert AQS.time_range == (pd.Timestamp('2020-01-01 00:00'), pd.Timestamp('2020-01-02 23:00'))
+    assert AQS.data['PM10'].isna().sum() == 1
+    assert AQS.data['NO2'].dtype == 'float64' and AQS.data['Timestamp'].dtype == 'datetime64[ns]'
+
+
+def test_lombardia_get_AQSC_multiple_years(lombardia_tables):
+    """
+    Check if a dt_range spanning multiple years is parsed from the yearly tables and merged
+    [Fail] If the per-year jobs are not merged in a single collection
+    """
+    AQSC = lombardia.get_AQSC(dt_range=[datetime(2019, 12, 31, 12), datetime(2020, 1, 1, 11)], redownload=False)
+    AQS = AQSC.search('Senato')
+    assert AQS.entries == 24
+    assert AQS.time_range == (pd.Timestamp('2019-12-31 12:00'), pd.Timestamp('2020-01-01 11:00'))
+    assert AQS.data['Timestamp'].is_monotonic_increasing
+
+
+@pytest.fixture
+def bulletin_server(tmp_path, monkeypatch):
+    """Serve the fixture bulletin for every date but 20200102 (unavailable), count the requests"""
+    requests_log = []
+
+    class BulletinHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_log.append(self.path)
+            if self.path.endswith('20200102'):
+                self.send_error(404)
+                return
+            body = EMILIA_ROMAGNA_BULLETIN.read_bytes()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), BulletinHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.chdir(tmp_path)
+    yield f'http://127.0.0.1:{server.server_port}/', requests_log
+    server.shutdown()
+
+
+def test_emilia_romagna_get_AQSC(bulletin_server):
+    """
+    Check if Emilia-Romagna bulletins are fetched once, cached and parsed into stations
+    [Fail] If Emilia-Romagna download, caching or parsing is broken
+    """
+    base_url, requests_log = bulletin_server
+    dt_range = [datetime(2020, 1, 1), datetime(2020, 1, 4)]
+    AQSC = emilia_romagna.get_AQSC(dt_range, redownload=False, base_url=base_url, max_workers=4)
+    assert sorted(requests_log) == [f'/2020010{day}' for day in range(1, 5)]
+    assert len(AQSC.AQS_list) == 3
+    AQS = AQSC.search('PORTA SAN FELICE')
+    assert AQS.province == Italy.Province.BO
+    assert AQS.entries == 3
+    assert AQS.pollutants == ['BENZENE', 'CO', 'NO2', 'PM10']
+    assert AQS.data['PM10'].tolist() == [38.0, 38.0, 38.0]
+    # Cached bulletins are not downloaded again
+    emilia_romagna.get_AQSC(dt_range, redownload=False, base_url=base_url)
+    assert len(requests_log) == 5
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for the geography modules
+"""
+
+import numpy as np
+
+from itaqa.geography.spatial import SpatialIndex, haversine_distance
+
+
+def test_spatial_index_queries():
+    """
+    Check radius, k-nearest and bounding box queries against a brute force search
+    [Fail] If the k-d tree construction or its pruning is broken
+    """
+    rng = np.random.default_rng(42)
+    lat, lng = rng.uniform(36, 47, 2000), rng.uniform(6, 19, 2000)
+    index = SpatialIndex(lat, lng)
+    for q_lat, q_lng in rng.uniform((36, 6), (47, 19), (20, 2)):
+        dist = haversine_distance(q_lat, q_lng, lat, lng)
+        idx, idx_dist = index.query_radius(q_lat, q_lng, 50)
+        assert set(idx) == set(np.flatnonzero(dist <= 50))
+        assert np.allclose(idx_dist, dist[idx]) and np.all(np.diff(idx_dist) >= 0)
+        idx, idx_dist = index.query_knn(q_lat, q_lng, 5)
+        assert np.allclose(idx_dist, np.sort(dist)[:5])
+    idx = index.query_bbox(44, 8, 45, 10)
+    assert np.array_equal(idx, np.flatnonzero((lat >= 44) & (lat <= 45) & (lng >= 8) & (lng <= 10)))
+    assert len(SpatialIndex([], []).query_knn(45, 9, 3)[0]) == 0
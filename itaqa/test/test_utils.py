@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for the utilities modules
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from itaqa.core.AirQualityStation import AirQualityStation
+from itaqa.core.AirQualityStationCollection import AirQualityStationCollection
+from itaqa.utils import aggregation_utils, cache_utils, csv_utils, http_utils
+
+
+@pytest.fixture
+def table_server():
+    """Serve a csv table with an ETag, answer 304 to matching conditional requests, log the status codes"""
+    status_log = []
+
+    class TableHandler(BaseHTTPRequestHandler):
+        body = b'IdSensore,Data,Valore\n5504,01/01/2020 12:00:00 AM,42\n'
+
+        def do_GET(self):
+            etag = '"v1"'
+            if self.headers.get('If-None-Match') == etag:
+                status_log.append(304)
+                self.send_response(304)
+                self.end_headers()
+                return
+            status_log.append(200)
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(self.body)))
+            self.end_headers()
+            self.wfile.write(self.body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TableHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/table.csv', status_log, TableHandler.body
+    server.shutdown()
+
+
+def test_http_cache_revalidation(table_server, tmp_path):
+    """
+    Check if unchanged resources are revalidated instead of downloaded again
+    [Fail] If the HTTP cache does not use conditional requests or loses the cached body
+    """
+    url, status_log, body = table_server
+    cached_path = http_utils.fetch(url, cache_dir=tmp_path)
+    assert cached_path.read_bytes() == body
+    assert http_utils.fetch(url, cache_dir=tmp_path) == cached_path
+    assert http_utils.fetch(url, revalidate=False, cache_dir=tmp_path) == cached_path
+    assert status_log == [200, 304]
+
+    # A body whose download fails leaves no temporary file in the cache
+    def failing_chunks():
+        yield b'partial'
+        raise ConnectionError()
+
+    with pytest.raises(ConnectionError):
+        http_utils.store_object(failing_chunks(), cache_dir=tmp_path)
+    assert [path for path in (tmp_path / 'objects').iterdir() if path.is_file()] == []
+
+
+def test_download_csv(table_server, tmp_path, monkeypatch):
+    """
+    Check if downloaded tables are made available at the requested path
+    [Fail] If csv_utils.download_csv does not go through the HTTP cache
+    """
+    url, status_log, body = table_server
+    monkeypatch.chdir(tmp_path)
+    csv_utils.download_csv(url, 'dump/data/table.csv')
+    csv_utils.download_csv(url, 'dump/data/table.csv')
+    assert (tmp_path / 'dump' / 'data' / 'table.csv').read_bytes() == body
+    assert status_log == [200, 304]
+
+
+def test_aggregation_metrics():
+    """
+    Check the regulatory daily metrics and the exceedances count on hourly data
+    [Fail] If the resampling, rolling or exceedances computation (or the minimum data coverage) is broken
+    """
+    df = pd.DataFrame({
+        'PM10': np.repeat([40.0, 60.0, 60.0], 24),
+        'O3': 100.0
+    }, index=pd.date_range(start='2020-03-01', periods=72, freq='H'))
+    df.iloc[58:, 0] = np.nan
+    df.iloc[30:38, 1] = 130.0
+    daily = aggregation_utils.aggregate(df, 'daily_mean')
+    assert daily['PM10'].tolist()[:2] == [40.0, 60.0] and np.isnan(daily['PM10'].iloc[2])
+    assert aggregation_utils.aggregate(df[['O3']], 'max_daily_8h_mean')['O3'].tolist() == [100.0, 130.0, 100.0]
+    exceedances = aggregation_utils.aggregate(df, 'exceedances', freq='monthly')
+    assert exceedances.to_dict('records') == [{'PM10': 1, 'O3': 1}]
+    assert aggregation_utils.aggregate(df, 'resample', freq='daily', stat='max')['O3'].tolist() == [100, 130, 100]
+    assert aggregation_utils.aggregate(df, 'percentiles', q=[0.5]).loc['O3', 0.5] == 100.0
+    with pytest.raises(ValueError):
+        aggregation_utils.aggregate(df, 'median_of_means')
+
+
+def test_collection_cache(tmp_path):
+    """
+    Check eviction by memory in LRU order and invalidation of the cached collections on file changes
+    [Fail] If the cache exceeds its memory budget, evicts recently used collections or serves stale ones
+    """
+    collections = {}
+    for name in ['lombardia', 'piemonte', 'veneto']:
+        AQS = AirQualityStation(name)
+        AQS.data = pd.DataFrame({'Timestamp': pd.date_range('2020-01-01', periods=1000, freq='H'), 'NO2': 1.0})
+        collections[name] = AirQualityStationCollection(AQS=[AQS])
+        collections[name].save(tmp_path / f'{name}.msgpack')
+    memory = cache_utils.get_AQSC_memory(collections['lombardia'])
+    assert memory >= 16000
+
+    cache = cache_utils.CollectionCache(max_memory=2 * memory)
+    cache.put(tmp_path / 'lombardia.msgpack', collections['lombardia'])
+    cache.put(tmp_path / 'piemonte.msgpack', collections['piemonte'])
+    assert cache.get(tmp_path / 'lombardia.msgpack') is collections['lombardia']
+    cache.put(tmp_path / 'veneto.msgpack', collections['veneto'])
+    assert len(cache) == 2 and cache.memory == 2 * memory
+    assert tmp_path / 'piemonte.msgpack' not in cache and tmp_path / 'lombardia.msgpack' in cache
+
+    # A lazily loaded collection uses no memory until its data is decoded
+    lazy_AQSC = AirQualityStationCollection(file_path=tmp_path / 'piemonte.msgpack', lazy=True)
+    assert cache_utils.get_AQSC_memory(lazy_AQSC) == 0
+
+    collections['veneto'].save(tmp_path / 'veneto.msgpack')
+    with open(tmp_path / 'veneto.msgpack', 'ab') as fp:
+        fp.write(b'\0')
+    assert cache.get(tmp_path / 'veneto.msgpack') is None
+    assert len(cache) == 1 and cache.memory == memory
+    cache.clear()
+    assert len(cache) == 0 and cache.memory == 0
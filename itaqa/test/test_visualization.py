@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for the visualization modules
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from itaqa.core.AirQualityStation import AirQualityStation
+from itaqa.core.AirQualityStationCollection import AirQualityStationCollection
+from itaqa.core.defs import Pollutant
+from itaqa.geography import Italy
+from itaqa.visualization import downsampling, export, plotting
+
+
+def test_downsampling():
+    """
+    Check that downsampled series are bounded in length, keep first/last points and the peaks
+    [Fail] If the bucketing of LTTB or min-max is broken
+    """
+    x = pd.date_range('2020-01-01', periods=100000, freq='H').to_numpy()
+    y = np.sin(np.arange(len(x)) / 500) * 10
+    y[12345], y[67890] = 100, -100
+    y[50] = np.nan
+
+    for method in ('lttb', 'minmax'):
+        x_out, y_out = downsampling.downsample(x, y, 1000, method)
+        assert len(x_out) <= 1000
+        assert np.all(np.diff(x_out.view('int64')) > 0)
+        assert not np.isnan(y_out).any()
+        assert x_out[0] == x[0] and x_out[-1] == x[-1]
+        assert y_out.max() == 100 and y_out.min() == -100
+
+    # Short series are returned as they are
+    x_out, y_out = downsampling.downsample(x[:10], y[:10], 1000)
+    assert len(x_out) == 10
+
+    # Zooming in: only the points within the range (plus a point per side) are kept
+    x_range = ['2020-02-01', '2020-02-02']
+    x_out, y_out = downsampling.select_range(x, y, x_range, 1000)
+    assert len(x_out) == 25 + 2
+    assert x_out[1] == np.datetime64('2020-02-01')
+
+    # Nullable integer columns (as decoded from AQSC files) with missing values
+    y_int = pd.array(np.arange(len(x)) % 100, dtype='Int64')
+    y_int[[10, 20000]] = pd.NA
+    for method in ('lttb', 'minmax'):
+        x_out, y_out = downsampling.downsample(x, y_int, 1000, method)
+        assert len(x_out) <= 1000 and y_out.dtype == 'float64' and not np.isnan(y_out).any()
+    x_out, y_out = downsampling.select_range(x, pd.Series(y_int), ['2020-01-01', '2020-01-02'], 1000)
+    assert len(x_out) == 25 + 1 - 1 and not np.isnan(y_out).any()
+
+    with pytest.raises(ValueError):
+        downsampling.downsample(x, y, 1000, 'random')
+
+
+def test_plot_data_lines():
+    """
+    Check that the traces built from an AQS are downsampled to the points budget
+    [Fail] If plotting passes the raw series to plotly
+    """
+    AQS = AirQualityStation('Station')
+    timestamps = pd.date_range('2020-01-01', periods=5000, freq='H')
+    AQS.data = pd.DataFrame({'Timestamp': timestamps, 'NO2': np.arange(5000.0), 'PM10': np.ones(5000)})
+
+    data_lines = plotting.get_data_lines(AQS, n_points=500)
+    assert [line.name for line in data_lines] == ['NO2', 'PM10']
+    assert all(len(line.x) <= 500 for line in data_lines)
+
+    data_lines = plotting.get_data_lines(AQS, 'PM10', n_points=500, method='minmax')
+    assert [line.name for line in data_lines] == ['PM10']
+    fig = plotting.get_AQS_figure(AQS, Pollutant.PM10, n_points=500)
+    assert [line.name for line in fig.data] == ['PM10']
+
+    # Only the lockdown dates within the data are marked (the others would extend the x-axis)
+    AQS.data = AQS.data.iloc[:24 * 60]
+    fig = plotting.get_AQS_multifigure(AQS, n_points=500)
+    assert [shape.x0 for shape in fig.layout.shapes] == [plotting.LOCKDOWN_DATES['first_cases']]
+
+
+def test_comparison_plots(monkeypatch):
+    """
+    Check the data aligned for comparison plots and the figures built from them (not shown)
+    [Fail] If the series are misaligned or mislabeled, or a plot mode is broken
+    """
+    AQSC = AirQualityStationCollection()
+    provinces = [Italy.Province.MI, Italy.Province.MI, Italy.Province.BG]
+    for idx, (name, province) in enumerate(zip(['Duomo', 'Duomo', 'Bergamo'], provinces)):
+        AQS = AirQualityStation(name)
+        AQS.set_address(region=Italy.Region.LOMBARDIA, province=province)
+        timestamps = pd.date_range(start='2020-02-01', periods=24 * 60, freq='H') + pd.Timedelta(hours=idx)
+        AQS.data = pd.DataFrame({'Timestamp': timestamps, 'NO2': np.full(len(timestamps), 10.0 * (idx + 1))})
+        AQSC.add(AQS)
+
+    comparison = plotting.get_comparison_data(AQSC, 'NO2')
+    assert comparison.shape == (24 * 60 + 2, 3)
+    assert sorted(label[:5] for label in comparison.columns) == ['Berga', 'Duomo', 'Duomo']
+    assert comparison['Bergamo'].dropna().eq(30).all()
+    assert list(plotting.get_comparison_data(AQSC, 'NO2', stations=['Bergamo']).columns) == ['Bergamo']
+    by_province = plotting.get_comparison_data(AQSC, 'NO2', group_by='province')
+    assert sorted(by_province.columns) == ['BG', 'MI']
+    assert by_province['MI'].iloc[1] == 15 and by_province['BG'].iloc[2] == 30
+
+    figures = []
+    monkeypatch.setattr(plotting.go.Figure, 'show', lambda fig: figures.append(fig))
+    for mode in ('overlay', 'multiple', 'heatmap'):
+        assert AQSC.plot(Pollutant.NO2, mode=mode, n_points=100) is figures[-1]
+    assert [len(fig.data) for fig in figures] == [3, 3, 1]
+    assert all(len(fig.layout.shapes) >= len(plotting.LOCKDOWN_DATES) for fig in figures)
+    assert len(figures[0].data[0].x) <= 100 and len(figures[2].data[0].x) == 61
+    with pytest.raises(ValueError):
+        AQSC.plot('NO2', mode='pie')
+
+
+def test_plots_from_rollups(tmp_path):
+    """
+    Check that plots of period means and heatmaps are built from the stored rollups, without decoding the data
+    [Fail] If plotting decodes the data of AQS whose rollups are stored
+    """
+    AQSC = AirQualityStationCollection()
+    for idx, name in enumerate(['Duomo', 'Bergamo']):
+        AQS = AirQualityStation(name)
+        timestamps = pd.date_range(start='2020-01-01', periods=24 * 90, freq='H')
+        AQS.data = pd.DataFrame({'Timestamp': timestamps, 'NO2': np.arange(len(timestamps), dtype='float64') + idx})
+        AQSC.add(AQS)
+    AQSC.save(tmp_path / 'AQSC.msgpack', rollups=['daily'])
+    lazy_AQSC = AirQualityStationCollection(file_path=tmp_path / 'AQSC.msgpack', lazy=True)
+
+    fig = plotting.get_AQS_figure(lazy_AQSC.search('Duomo'), freq='monthly')
+    assert list(fig.data[0].y) == AQSC.search('Duomo').aggregate('resample', freq='monthly')['NO2'].tolist()
+    fig = plotting.get_AQSC_figure(lazy_AQSC, 'NO2', mode='heatmap', n_points=100)
+    assert fig.data[0].z.shape == (2, 90)
+    assert not any(AQS.is_loaded for AQS in lazy_AQSC)
+    np.testing.assert_allclose(fig.data[0].z, plotting.get_AQSC_figure(AQSC, 'NO2', 'heatmap', n_points=100).data[0].z)
+
+
+def test_export_AQSC(tmp_path, monkeypatch):
+    """
+    Check the batch export of the plots of an AQSC file to HTML
+    [Fail] If the workers cannot load the AQSC or render the plots
+    """
+    AQSC = AirQualityStationCollection()
+    for name in ['Duomo', 'Bergamo', 'Lodi/Vignati']:
+        AQS = AirQualityStation(name)
+        timestamps = pd.date_range(start='2020-02-01', periods=24 * 10, freq='H')
+        AQS.data = pd.DataFrame({'Timestamp': timestamps, 'NO2': np.arange(len(timestamps), dtype='float64')})
+        AQSC.add(AQS)
+    AQSC.save(tmp_path / 'AQSC.msgpack')
+
+    outcomes = export.export_AQSC_file(tmp_path / 'AQSC.msgpack', tmp_path / 'export', 'html', workers=2)
+    assert sorted(outcomes) == sorted(AQS.uuid for AQS in AQSC)
+    assert all(error is None and path.exists() for path, error in outcomes.values())
+    assert outcomes[AQSC.search('Lodi').uuid][0].name.startswith('Lodi_Vignati_')
+    assert (tmp_path / 'export' / export.PLOTLYJS_FILENAME).exists()
+
+    outcomes = export.export_AQSC_file(tmp_path / 'AQSC.msgpack',
+                                       tmp_path / 'export',
+                                       mode='single',
+                                       stations=['Duomo'])
+    assert len(outcomes) == 1
+    with pytest.raises(ValueError):
+        export.export_AQSC_file(tmp_path / 'AQSC.msgpack', tmp_path / 'export', 'gif')
+    # Static images need kaleido: its absence is reported before starting the workers
+    monkeypatch.setattr(export.importlib.util, 'find_spec', lambda name: None)
+    with pytest.raises(ImportError, match='kaleido'):
+        export.export_AQSC_file(tmp_path / 'AQSC.msgpack', tmp_path / 'export', 'png')
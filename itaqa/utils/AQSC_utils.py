@@ -6,58 +6,106 @@ Utilities to handle and manipulate AirQualityStationCollection objects
 
 import json
 import logging
+import pandas as pd
 import warnings
 
 from collections import defaultdict
-from itertools import groupby
+from datetime import datetime
+from pathlib import Path
 
-from itaqa.core.AirQualityStation import AirQualityStation
 from itaqa.core.AirQualityStationCollection import AirQualityStationCollection
-from itaqa.utils.AQS_utils import merge_AQS_data
+from itaqa.geography.spatial import haversine_distance
+from itaqa.utils import serialization_utils
+from itaqa.utils.AQS_utils import get_coordinates, merge_AQS_data, merge_station_group
+from itaqa.utils.pandas_utils import reorder_columns
 
 logger = logging.getLogger(__name__)
 
+# Maximum distance between sensors with the same name to consider them part of the same station
+MERGE_MAX_DISTANCE_KM = 1.0
+
+# Stations whose last entry is older than this (compared to the most recent station) do not set the update start
+UPDATE_MAX_LAG = pd.Timedelta(days=30)
+
+
+def load_AQSC_progressively(file_path, metadata_loaded, progress, is_interrupted):
+    """
+    Load an AQSC file lazily, then decode the data of its AQS one by one (e.g. in a background thread)
+
+    Call metadata_loaded(AQSC) once the index is read and progress(decoded AQS, total AQS) after each AQS
+    Return the AQSC, or None as soon as is_interrupted() is True
+    """
+    AQSC = AirQualityStationCollection(file_path=file_path, lazy=True)
+    if is_interrupted():
+        return None
+    metadata_loaded(AQSC)
+    AQS_list = AQSC.AQS_list
+    for idx, AQS in enumerate(AQS_list):
+        if is_interrupted():
+            return None
+        # Decode the data (AQS accessed meanwhile by other threads may have been decoded already)
+        AQS.data
+        progress(idx + 1, len(AQS_list))
+    return AQSC
+
 
 def group_by_name(AQSC):
     """Return a dict with as key the name of the station and as value a list of AQS objects"""
-    AQS_by_name = defaultdict(list)
-    for k, g in groupby(AQSC.AQS_list, lambda x: x.name):
-        for station in g:
-            AQS_by_name[k].append(station)
-    return AQS_by_name
+    return AQSC.group_by('name')
 
 
-def merge_by_group(AQSC, AQS_group):
-    """Merge multiple groups of AQS and return a list of merged AQS objects"""
-    for k in AQS_group:
-        # Setup new resulting AQS
-        new_AQS = AirQualityStation(k)
-        new_AQS.set_address(region=AQS_group[k][0].region,
-                            province=AQS_group[k][0].province,
-                            comune=AQS_group[k][0].comune)
-        # TODO: Compute geolocation and check if they are not so nearby
-        new_AQS.metadata['premerge_history'] = {}
-        frames = []
-
-        for station in AQS_group[k]:
-            frames.append(station.data.set_index('Timestamp'))
-            # TODO: Refactor to handle stations with more than one pollutant before merge
-            cols = station.data.columns.to_list()
-            cols.remove('Timestamp')
-            pollutant = cols[0]
-            new_AQS.metadata['premerge_history'][pollutant] = {}
-            new_AQS.metadata['premerge_history'][pollutant]['name'] = station.name
-            new_AQS.metadata['premerge_history'][pollutant]['geolocation'] = station.geolocation
-
-        # Take first frame and merge all the others
-        merged_df = frames.pop()
-        for frame in frames:
-            merged_df = merged_df.merge(frame, how='outer', left_index=True, right_index=True)
-        merged_df.reset_index(inplace=True)
-        new_AQS.data = merged_df
+def group_by_location(AQSC, max_distance=MERGE_MAX_DISTANCE_KM):
+    """
+    Return a dict with as key the name of the station and as value a list of AQS with that name, located nearby
+
+    AQS with the same name are clustered (single linkage) by radius queries of max_distance km on the spatial index
+    of the collection. If the AQS with a name are split in more clusters, the largest one is keyed by the name and
+    the others with a progressive suffix ('name (2)'); clusters of the same size are ordered by their southwestern
+    location (lowest latitude, then longitude). AQS without geolocation are grouped with the largest cluster
+    """
+    index, located_AQS = AQSC.get_spatial_index()
+    positions = {AQS.uuid: pos for pos, AQS in enumerate(located_AQS)}
+    parents = list(range(len(located_AQS)))
+
+    def find(pos):
+        while parents[pos] != pos:
+            parents[pos] = parents[parents[pos]]
+            pos = parents[pos]
+        return pos
+
+    for pos, AQS in enumerate(located_AQS):
+        near_positions, _ = index.query_radius(index.lat[pos], index.lng[pos], max_distance)
+        for near_pos in near_positions:
+            if located_AQS[near_pos].name == AQS.name:
+                parents[find(near_pos)] = find(pos)
 
+    clusters_by_name = defaultdict(lambda: defaultdict(list))
+    for AQS in AQSC.AQS_list:
+        cluster = find(positions[AQS.uuid]) if AQS.uuid in positions else None
+        clusters_by_name[AQS.name][cluster].append(AQS)
+
+    AQS_by_location = dict()
+    def get_cluster_key(cluster):
+        return (-len(cluster), ) + min((index.lat[positions[AQS.uuid]], index.lng[positions[AQS.uuid]])
+                                       for AQS in cluster)
+
+    for name, clusters in clusters_by_name.items():
+        not_located = clusters.pop(None, [])
+        clusters = sorted(clusters.values(), key=get_cluster_key) or [[]]
+        clusters[0].extend(not_located)
+        if len(clusters) > 1:
+            logger.warning(f"Stations named '{name}' are more than {max_distance} km apart, not merging them all")
+        for idx, cluster in enumerate(clusters):
+            AQS_by_location[name if idx == 0 else f"{name} ({idx + 1})"] = cluster
+    return AQS_by_location
+
+
+def merge_by_group(AQSC, AQS_group):
+    """Merge multiple groups of AQS, replacing them in the AQSC with the merged AQS objects"""
+    for k, AQS_list in AQS_group.items():
+        new_AQS = merge_station_group(k, AQS_list)
         # Remove from AQSC the merged stations and add the new one
-        AQSC.remove([AQS.uuid for AQS in AQS_group[k]])
+        AQSC.remove([AQS.uuid for AQS in AQS_list])
         AQSC.add(new_AQS)
 
 
@@ -68,6 +116,150 @@ def remove_empty_stations(AQSC):
         AQSC.remove(empty_stations)
 
 
+def get_last_timestamps(AQSC):
+    """Return a dict with as key the uuid of the AQS and as value its last Timestamp (no data decoding needed)"""
+    return {AQS.uuid: AQS.time_range[1] for AQS in AQSC}
+
+
+def match_by_location(AQS, candidates, max_distance=MERGE_MAX_DISTANCE_KM):
+    """
+    Return the AQS among candidates within max_distance km from AQS
+
+    Geolocations are converted to floats (they are strings for some crawlers): candidates without a valid one are
+    skipped, none is returned if AQS has no valid geolocation
+    """
+    coordinates = get_coordinates(AQS)
+    if coordinates is None:
+        return []
+    matches = []
+    for candidate in candidates:
+        candidate_coordinates = get_coordinates(candidate)
+        if candidate_coordinates is None:
+            continue
+        if haversine_distance(*coordinates, *candidate_coordinates) <= max_distance:
+            matches.append(candidate)
+    return matches
+
+
+def get_new_data(AQSC, new_AQSC):
+    """
+    Return the data of the AQS in new_AQSC newer than the last Timestamp of the matching AQS in AQSC
+
+    AQS are matched by name and, if they have a geolocation, by location (see match_by_location): AQS far from all the
+    ones with their name are new stations, while the data of AQS near more than one of them (or, without geolocation,
+    sharing the name with more than one of them) is discarded, with a warning
+    The data of the AQS in AQSC is not needed (their last Timestamp is available without decoding it)
+    Return a dict with as key the uuid of the AQS in AQSC and as value its new rows, and the list of the AQS present
+    only in new_AQSC
+    """
+    AQS_by_name = AQSC.group_by('name')
+    last_timestamps = get_last_timestamps(AQSC)
+    new_data = {}
+    new_AQS_list = []
+    for new_AQS in new_AQSC.AQS_list:
+        candidates = AQS_by_name.get(new_AQS.name)
+        if not candidates:
+            new_AQS_list.append(new_AQS)
+            continue
+        if get_coordinates(new_AQS) is not None and any(get_coordinates(AQS) is not None for AQS in candidates):
+            candidates = match_by_location(new_AQS, candidates)
+            if not candidates:
+                logger.warning(f"Station '{new_AQS.name}' is far from the stations with its name, added as a new one")
+                new_AQS_list.append(new_AQS)
+                continue
+        if len(candidates) > 1:
+            logger.warning(f"Cannot tell which of the {len(candidates)} stations named '{new_AQS.name}' to update "
+                           f"(by location), new data discarded")
+            continue
+        AQS = candidates[0]
+        last_ts = last_timestamps[AQS.uuid]
+        data = new_AQS.data
+        if not pd.isna(last_ts):
+            data = data[pd.to_datetime(data['Timestamp']) > last_ts]
+        if not data.empty:
+            new_data[AQS.uuid] = data.reset_index(drop=True)
+    return new_data, new_AQS_list
+
+
+def append_new_data(AQSC, new_AQSC, update_data=True):
+    """
+    Append to the AQS of AQSC the data of the AQS with the same name in new_AQSC, newer than their last Timestamp
+
+    AQS present only in new_AQSC are added to AQSC
+    If not update_data, the data of the AQS already in AQSC is left untouched (and not decoded), to append the new
+    rows to the AQSC file as segments instead (see AirQualityStationCollection.append_segments)
+    Return a dict with as key the uuid of the updated (or added) AQS and as value the appended rows
+    """
+    new_data, new_AQS_list = get_new_data(AQSC, new_AQSC)
+    if update_data:
+        for uuid, data in new_data.items():
+            AQSC[uuid].data = reorder_columns(pd.concat([AQSC[uuid].data, data], ignore_index=True))
+    AQSC.add(new_AQS_list)
+    new_data.update({AQS.uuid: AQS.data for AQS in new_AQS_list})
+    return new_data
+
+
+def get_updated_filename(filename, dt_now, max_date):
+    """
+    Return the name of the file of an updated AQSC (if generated by download, with dt_now as creation date and the
+    max date of the updated data)
+    """
+    tok = filename.split('_', 3)
+    if len(tok) == 4 and tok[2].startswith('M'):
+        return '_'.join([dt_now.strftime('%Y%m%d%H%M%S'), tok[1], max_date.strftime('M%y%m%d'), tok[3]])
+    return f'{Path(filename).stem}_updated.msgpack'
+
+
+def get_update_start(AQSC, max_lag=UPDATE_MAX_LAG):
+    """
+    Return the Timestamp from which new data is needed: the oldest last entry among the stations up to date
+
+    Stations lagging more than max_lag behind the most recent one (e.g. no longer reporting) are logged and ignored,
+    so that they do not extend the update to their whole inactivity period
+    """
+    # The last entries are read from the index, the existing data of the stations is not decoded
+    last_timestamps = {uuid: ts for uuid, ts in get_last_timestamps(AQSC).items() if not pd.isna(ts)}
+    if not last_timestamps:
+        raise ValueError("The AQSC does not contain any data to update")
+    latest = max(last_timestamps.values())
+    for uuid, ts in last_timestamps.items():
+        if ts < latest - max_lag:
+            logger.warning(f"Station '{AQSC[uuid].name}' is behind since {ts}, not considered for the update start")
+    return min(ts for ts in last_timestamps.values() if ts >= latest - max_lag)
+
+
+def update_AQSC_file(AQSC, file_path, get_AQSC, overwrite=False, dt_now=None, available_range=None):
+    """
+    Update an AQSC (lazily loaded from file_path) with the data newer than the last entry of each station
+
+    The new data is downloaded with get_AQSC (the crawler of the AQSC region), within available_range (min, max
+    datetime of the data provided by the crawler, if limited) and up to dt_now
+    If overwrite, the new data is appended in place as new segments (see the compact mode), otherwise the whole
+    updated AQSC is written in a new file of the same folder, with the rollups stored in the original one
+    Return the path of the updated file and the amount of appended rows (None, 0 if no new data can be available)
+    """
+    dt_now = dt_now or datetime.now()
+    min_date = get_update_start(AQSC).to_pydatetime()
+    max_date = dt_now
+    if available_range:
+        min_date, max_date = max(min_date, available_range[0]), min(max_date, available_range[1])
+    if min_date >= max_date:
+        logger.info(f"No new data available after {min_date}")
+        return None, 0
+    logger.info(f"Downloading data from {min_date} to {max_date}")
+    new_AQSC = get_AQSC(dt_range=[min_date, max_date], redownload=True)
+    new_data = append_new_data(AQSC, new_AQSC, update_data=not overwrite)
+    appended_rows = sum(data.shape[0] for data in new_data.values())
+
+    if overwrite:
+        # Only the new data is written, as additional segments of the stations
+        AQSC.append_segments(file_path, new_data)
+        return Path(file_path), appended_rows
+    new_file_path = Path(file_path).with_name(get_updated_filename(Path(file_path).name, dt_now, max_date))
+    AQSC.save(new_file_path, rollups=serialization_utils.get_rollup_frequencies(file_path))
+    return new_file_path, appended_rows
+
+
 def merge_AQSC(AQSC1, AQSC2):
     """
     Merge the data of two AQSCs and return a new AQSC
@@ -77,7 +269,7 @@ def merge_AQSC(AQSC1, AQSC2):
     For example to merge two collections relative to different years
     """
     if len(AQSC1.AQS_list) != len(AQSC2.AQS_list):
-        warning.warn("The AQSCs contain a different number of AQSs")
+        warnings.warn("The AQSCs contain a different number of AQSs")
 
     new_AQSC = AirQualityStationCollection()
 
@@ -88,9 +280,7 @@ def merge_AQSC(AQSC1, AQSC2):
     AQS_names.sort()
 
     for AQS_name in AQS_names:
-        AQS1 = AQSC1.search(AQS_name)
-        AQS2 = AQSC2.search(AQS_name)
-        merged_AQS = merge_AQS_data([AQS1, AQS2])
+        merged_AQS = merge_AQS_data(AQSC1.get_by_name(AQS_name) + AQSC2.get_by_name(AQS_name))
         new_AQSC.add(merged_AQS)
 
     return new_AQSC
@@ -116,8 +306,8 @@ def merge_AQSC_multiple(AQSC_list):
     for AQS_name in AQS_names:
         AQSs_to_merge = list()
         for AQSC in AQSC_list:
-            AQS = AQSC.search(AQS_name)
-            AQSs_to_merge.append(AQS)
+            # Collections not containing the AQS are skipped
+            AQSs_to_merge.extend(AQSC.get_by_name(AQS_name))
         merged_AQS = merge_AQS_data(AQSs_to_merge)
         new_AQSC.add(merged_AQS)
 
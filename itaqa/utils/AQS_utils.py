@@ -7,54 +7,63 @@ Utilities to handle and manipulate AirQualityStation objects
 import logging
 import pandas as pd
 
-from itertools import groupby, combinations
+from itertools import combinations
 from collections import defaultdict
 
 from itaqa.core import AirQualityStation
-from itaqa.utils.pandas_utils import merge_dfs
+from itaqa.utils import aggregation_utils
+from itaqa.utils.pandas_utils import concat_on_timestamp, merge_dfs
 
 logger = logging.getLogger(__name__)
 
 
 def group_by_name(AQS_list):
-    """Return a dict with as key the name of the station and as value a list of AQS objects"""
+    """Return a dict with as key the name of the station and as value a list of AQS objects (in AQS_list order)"""
     AQS_by_name = defaultdict(list)
-    for k, g in groupby(AQS_list, lambda x: x.name):
-        for station in g:
-            AQS_by_name[k].append(station)
+    for station in AQS_list:
+        AQS_by_name[station.name].append(station)
     return AQS_by_name
 
 
 def merge_by_group(AQS_group):
     """Merge multiple groups of AQS and return a list of merged AQS objects"""
-    merged_AQS_list = []
-    for k in AQS_group:
-        # Setup new resulting AQS
-        new_AQS = AirQualityStation.AirQualityStation(k)
-        new_AQS.set_address(region=AQS_group[k][0].region,
-                            province=AQS_group[k][0].province,
-                            comune=AQS_group[k][0].comune)
-        # TODO: Compute geolocation and check if they are not so nearby
-        new_AQS.metadata['premerge_history'] = {}
-        frames = []
-
-        for station in AQS_group[k]:
-            frames.append(station.data.set_index('Timestamp'))
-            # TODO: Refactor to handle stations with more than one pollutant before merge
-            cols = station.data.columns.to_list()
-            cols.remove('Timestamp')
-            pollutant = cols[0]
-            new_AQS.metadata['premerge_history'][pollutant] = {}
-            new_AQS.metadata['premerge_history'][pollutant]['name'] = station.name
-            new_AQS.metadata['premerge_history'][pollutant]['geolocation'] = station.geolocation
-        # Take first frame and merge all the others
-        merged_df = frames.pop()
-        for frame in frames:
-            merged_df = merged_df.merge(frame, how='outer', left_index=True, right_index=True)
-        merged_df.reset_index(inplace=True)
-        new_AQS.data = merged_df
-        merged_AQS_list.append(new_AQS)
-    return merged_AQS_list
+    return [merge_station_group(k, AQS_list) for k, AQS_list in AQS_group.items()]
+
+
+def merge_station_group(name, AQS_list):
+    """
+    Merge AQS measuring different pollutants at the same location and return a new AQS with the specified name
+
+    The data of all the AQS is aligned on Timestamp at once (see pandas_utils.concat_on_timestamp)
+    """
+    new_AQS = AirQualityStation.AirQualityStation(name)
+    new_AQS.set_address(region=AQS_list[0].region, province=AQS_list[0].province, comune=AQS_list[0].comune)
+    new_AQS.geolocation = get_common_geolocation(AQS_list)
+    new_AQS.metadata['premerge_history'] = {}
+    for station in AQS_list:
+        for pollutant in station.pollutants:
+            new_AQS.metadata['premerge_history'].setdefault(pollutant, {
+                'name': station.name,
+                'geolocation': station.geolocation
+            })
+    new_AQS.data = concat_on_timestamp([station.data for station in AQS_list])
+    return new_AQS
+
+
+def get_coordinates(AQS):
+    """Return latitude and longitude of an AQS as floats (None if its geolocation is not set or not valid)"""
+    try:
+        return float(AQS.geolocation[0]), float(AQS.geolocation[1])
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def get_common_geolocation(AQS_list):
+    """Return the most frequent geolocation among the AQS (None if none is set)"""
+    geolocations = [AQS.geolocation for AQS in AQS_list if AQS.geolocation]
+    if not geolocations:
+        return None
+    return max(geolocations, key=geolocations.count)
 
 
 def merge_AQS_data(AQS_list):
@@ -62,6 +71,7 @@ def merge_AQS_data(AQS_list):
     Merge the data and return a new AQS
 
     To use with multiple AQS objects representing the same location but at different times (different records)
+    Any number of AQS is merged in a single pass (see pandas_utils.merge_dfs)
     """
     equality = check_AQS_equality(AQS_list, compare_data=False, compare_metadata=False)
     if not equality:
@@ -70,13 +80,28 @@ def merge_AQS_data(AQS_list):
     new_AQS = AirQualityStation.AirQualityStation(AQS_list[0].name)
     new_AQS.set_address(region=AQS_list[0].region, province=AQS_list[0].province, comune=AQS_list[0].comune)
     # TODO: Check if metadata is coherent among all the AQS
-    new_AQS.metadata['premerge_history'] = AQS_list[0].metadata['premerge_history']
+    if 'premerge_history' in AQS_list[0].metadata:
+        new_AQS.metadata['premerge_history'] = AQS_list[0].metadata['premerge_history']
     new_AQS.geolocation = AQS_list[0].geolocation
-    # TODO: Support for more than 2 AQS
-    new_AQS.data = merge_dfs([AQS_list[0].data, AQS_list[1].data])
+    new_AQS.data = merge_dfs([AQS.data for AQS in AQS_list])
     return new_AQS
 
 
+def count_values(AQS):
+    """
+    Return a dict with as key each pollutant of an AQS and as value the amount of its values (missing ones excluded)
+
+    The counts are read from the rollups of the AQS if available (see AirQualityStation.has_rollup), without
+    decoding its data
+    """
+    for freq in aggregation_utils.ROLLUP_FREQUENCIES:
+        if AQS.has_rollup(freq):
+            counts = AQS.get_rollup(freq).xs('count', axis=1, level=1).sum()
+            if set(AQS.pollutants) <= set(counts.index):
+                return {pl: int(counts[pl]) for pl in AQS.pollutants}
+    return {pl: int(AQS.data[pl].count()) for pl in AQS.pollutants}
+
+
 def check_AQS_equality(AQS_list, compare_metadata=True, compare_data=True):
     """Check if the AQS in the list are all equal"""
     equality = True
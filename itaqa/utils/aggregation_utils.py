@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Utilities to aggregate AQS data over time
+
+All the functions work on a DataFrame indexed by Timestamp with a column per series: the pollutants of an AQS (see
+AirQualityStation.aggregate) or the AQS measuring a pollutant (see AirQualityStationCollection.aggregate), so every
+aggregation runs at once on all the series
+"""
+
+import pandas as pd
+
+# Aliases of the resampling frequencies (any pandas offset alias is accepted too)
+FREQUENCIES = {'hourly': 'H', 'daily': 'D', 'weekly': 'W-MON', 'monthly': 'MS', 'yearly': 'AS'}
+
+# Limit values (µg/m3) of the EU air quality directive 2008/50/EC and the daily metric they refer to
+LIMIT_VALUES = {'PM10': 50, 'O3': 120}
+DAILY_METRICS = {'PM10': 'daily_mean', 'O3': 'max_daily_8h_mean'}
+
+# Rollups: aggregates of each pollutant that can be precomputed and stored with an AQSC (see get_rollup)
+ROLLUP_FREQUENCIES = ('daily', 'weekly', 'monthly')
+ROLLUP_STATS = ('count', 'min', 'max', 'mean', 'sum')
+# Rollups from which the rollup of a frequency can be derived (its periods are unions of their periods), coarsest first
+ROLLUP_SOURCES = {'monthly': ('monthly', 'daily'), 'yearly': ('yearly', 'monthly', 'daily')}
+
+# Minimum amount of hourly values for a valid daily mean (75%) and 8-hour mean (75%)
+MIN_DAILY_VALUES = 18
+MIN_8H_VALUES = 6
+
+
+def get_frequency(freq):
+    """Return the pandas offset alias of a frequency (see FREQUENCIES)"""
+    return FREQUENCIES.get(freq, freq)
+
+
+def resample(df, freq='daily', stat='mean', min_count=None):
+    """
+    Aggregate the values of each period (freq) with stat ('mean', 'max', 'min', 'median', 'sum', 'count', ...)
+
+    Periods with less than min_count values are set to NaN
+    """
+    resampler = df.resample(get_frequency(freq))
+    resampled = resampler.agg(stat)
+    if min_count:
+        resampled = resampled.where(resampler.count() >= min_count)
+    return resampled
+
+
+def get_rollup(df, freq):
+    """Return count, min, max, mean, sum of each series for each period (columns: series, stat)"""
+    return df.resample(get_frequency(freq)).agg(list(ROLLUP_STATS))
+
+
+def get_rollup_sources(freq):
+    """Return the frequencies of the rollups from which the rollup of freq can be derived (see ROLLUP_SOURCES)"""
+    return ROLLUP_SOURCES.get(freq, (freq, ))
+
+
+def coarsen_rollup(rollup, freq):
+    """Return the rollup of freq derived from a rollup of a finer frequency (see get_rollup_sources)"""
+    # Function aggregating the values of each stat over the finer periods
+    stats = {'count': 'sum', 'min': 'min', 'max': 'max', 'sum': 'sum'}
+    coarse = {
+        stat: rollup.xs(stat, axis=1, level=1).resample(get_frequency(freq)).agg(func)
+        for stat, func in stats.items()
+    }
+    coarse['mean'] = coarse['sum'] / coarse['count'].where(coarse['count'] > 0)
+    return pd.concat(coarse, axis=1).swaplevel(axis=1)[rollup.columns]
+
+
+def resample_from_rollup(rollup, stat='mean', min_count=None):
+    """Return the result of resample() from the rollup of the same frequency (stat must be in ROLLUP_STATS)"""
+    resampled = rollup.xs(stat, axis=1, level=1)
+    if min_count:
+        resampled = resampled.where(rollup.xs('count', axis=1, level=1) >= min_count)
+    return resampled
+
+
+def rolling(df, window='8H', stat='mean', min_count=None):
+    """Aggregate with stat the values in the time window ending at each Timestamp (NaN if less than min_count)"""
+    return df.rolling(window, min_periods=min_count or 1).agg(stat)
+
+
+def daily_mean(df, min_count=MIN_DAILY_VALUES):
+    """Return the daily means (e.g. the PM10 regulatory metric)"""
+    return resample(df, 'daily', 'mean', min_count=min_count)
+
+
+def max_daily_8h_mean(df, min_count=MIN_8H_VALUES):
+    """Return the daily maximum of the 8-hour running means (e.g. the O3 regulatory metric)"""
+    return resample(rolling(df, '8H', 'mean', min_count=min_count), 'daily', 'max')
+
+
+def count_exceedances(df, limit=None, daily_metric=None, freq='yearly'):
+    """
+    Count, for each period (freq), the days in which the daily metric exceeds the limit value
+
+    Args:
+        limit (float/dict): Limit value of all the series, or dict series: limit value (default: LIMIT_VALUES by
+                            series name, series without a limit value are dropped)
+        daily_metric (str/dict): 'daily_mean' or 'max_daily_8h_mean' for all the series, or dict series: metric
+                                 (default: DAILY_METRICS by series name, otherwise 'daily_mean')
+    """
+    if limit is None:
+        limit = {col: LIMIT_VALUES[col] for col in df.columns if col in LIMIT_VALUES}
+    elif not isinstance(limit, dict):
+        limit = {col: limit for col in df.columns}
+    if daily_metric is None:
+        daily_metric = {col: DAILY_METRICS.get(col, 'daily_mean') for col in df.columns}
+    elif not isinstance(daily_metric, dict):
+        daily_metric = {col: daily_metric for col in df.columns}
+    # Compute each daily metric once, on all the series it applies to
+    series_by_metric = {}
+    for col in limit:
+        series_by_metric.setdefault(daily_metric[col], []).append(col)
+    exceedances = []
+    for metric, cols in series_by_metric.items():
+        daily = METRICS[metric](df[cols])
+        exceedances.append((daily > pd.Series(limit)[cols]).resample(get_frequency(freq)).sum())
+    if not exceedances:
+        return pd.DataFrame(index=df.resample(get_frequency(freq)).count().index)
+    return pd.concat(exceedances, axis=1)[list(limit)]
+
+
+def percentiles(df, q=(0.5, 0.9, 0.98)):
+    """Return the percentiles q of the values of each series (a row per series, a column per percentile)"""
+    return df.quantile(list(q)).T
+
+
+METRICS = {
+    'resample': resample,
+    'rolling': rolling,
+    'daily_mean': daily_mean,
+    'max_daily_8h_mean': max_daily_8h_mean,
+    'exceedances': count_exceedances,
+    'percentiles': percentiles
+}
+
+
+def aggregate(df, metric, **params):
+    """Compute a metric (see METRICS) with the specified parameters"""
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric '{metric}', available: {', '.join(METRICS)}")
+    return METRICS[metric](df, **params)
+
+
+def get_spec_key(metric, params):
+    """Return a hashable key identifying a metric and its parameters (to cache its results)"""
+    def to_hashable(value):
+        if isinstance(value, dict):
+            return tuple(sorted((kk, to_hashable(vv)) for kk, vv in value.items()))
+        if isinstance(value, (list, tuple, set)):
+            return tuple(to_hashable(vv) for vv in value)
+        return value
+
+    return (metric, to_hashable(params))
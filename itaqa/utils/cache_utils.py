@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In-memory cache of the collections loaded from AQSC files
+
+Collections are evicted in least recently used order once their estimated memory (the decoded DataFrames) exceeds
+the budget, and discarded when their file changes (modification time or size differ from the ones at loading)
+"""
+
+import logging
+import os
+
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_MEMORY = 1 << 30
+
+
+def get_file_signature(file_path):
+    """Return modification time (ns) and size of a file, changing whenever the file is rewritten or appended to"""
+    stat = os.stat(file_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def get_AQSC_memory(AQSC):
+    """Estimate the memory (bytes) used by the decoded data of the AQS of a collection (lazy data is not counted)"""
+    return int(sum(AQS.data.memory_usage(deep=True).sum() for AQS in AQSC.AQS_list if AQS.is_loaded))
+
+
+class CollectionCache():
+    """
+    LRU cache of AQSC, keyed by the file they were loaded from and bounded by their estimated memory
+
+    Args:
+        max_memory (int): Memory budget in bytes (collections larger than it are not cached)
+
+    Examples:
+        cache = CollectionCache(max_memory=512 << 20)
+        cache.put(file_path, AQSC, signature)
+        AQSC = cache.get(file_path)
+    """
+    def __init__(self, max_memory=DEFAULT_MAX_MEMORY):
+        self.max_memory = max_memory
+        self.memory = 0
+        # Key: resolved file path, value: (file signature, AQSC, estimated memory), least recently used first
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, file_path):
+        return self._get_key(file_path) in self._entries
+
+    @staticmethod
+    def _get_key(file_path):
+        return str(Path(file_path).resolve())
+
+    def get(self, file_path):
+        """Return the AQSC loaded from file_path (None if not cached or if the file changed since its loading)"""
+        key = self._get_key(file_path)
+        if key not in self._entries:
+            return None
+        try:
+            signature = get_file_signature(key)
+        except FileNotFoundError:
+            signature = None
+        if signature != self._entries[key][0]:
+            logger.info(f"'{file_path}' changed since its loading, dropped from the cache")
+            self.invalidate(file_path)
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key][1]
+
+    def put(self, file_path, AQSC, signature=None):
+        """
+        Cache an AQSC loaded from file_path, evicting the least recently used ones to stay within the memory budget
+
+        The signature of the file (see get_file_signature) should be taken before the loading, so that changes made
+        meanwhile invalidate the entry; by default it's taken now
+        """
+        self.invalidate(file_path)
+        memory = get_AQSC_memory(AQSC)
+        if memory > self.max_memory:
+            logger.info(f"'{file_path}' exceeds the cache memory budget, not cached")
+            return
+        key = self._get_key(file_path)
+        self._entries[key] = (signature or get_file_signature(key), AQSC, memory)
+        self.memory += memory
+        while self.memory > self.max_memory:
+            _, (_, _, evicted_memory) = self._entries.popitem(last=False)
+            self.memory -= evicted_memory
+
+    def invalidate(self, file_path):
+        """Remove the AQSC loaded from file_path, if cached"""
+        entry = self._entries.pop(self._get_key(file_path), None)
+        if entry is not None:
+            self.memory -= entry[2]
+
+    def clear(self):
+        """Remove all the cached AQSC"""
+        self._entries.clear()
+        self.memory = 0
@@ -5,8 +5,18 @@ Utilities to handle CSV files
 """
 
 import csv
-import pickle
-import requests
+import os
+import pandas as pd
+import shutil
+
+from pathlib import Path
+
+from itaqa.utils import http_utils
+
+# Rows per df yielded by read_csv_chunks
+CSV_CHUNK_SIZE = 500000
+# Bytes per block used when scanning files
+SCAN_BLOCK_SIZE = 1 << 20
 
 
 def save_csv(csv_data, file_path):
@@ -16,17 +26,42 @@ def save_csv(csv_data, file_path):
         csvfile.write(csv_data)
 
 
-def download_csv(url, file_path):
-    """Download a csv file and pickle it"""
-    print(f"Downloading {url}...")
-    with requests.Session() as session:
-        ret = session.get(url)
-    csv_file = ret.content.decode('utf-8')
-    pickle.dump(csv_file, open(file_path, 'wb'))
+def download_csv(url, file_path, revalidate=True):
+    """
+    Download a csv file through the shared HTTP cache and make it available in file_path
+
+    Unchanged tables are not downloaded again (conditional requests), file_path is a hard link to the cached body
+    """
+    cached_path = http_utils.fetch(url, revalidate=revalidate)
+    Path(file_path).parent.mkdir(parents=True, exist_ok=True)
+    if Path(file_path).exists() and os.path.samefile(cached_path, file_path):
+        return
+    partial_path = Path(f'{file_path}.part')
+    partial_path.unlink(missing_ok=True)
+    try:
+        os.link(cached_path, partial_path)
+    except OSError:
+        # Hard links not supported (e.g. cache on a different filesystem)
+        shutil.copyfile(cached_path, partial_path)
+    os.replace(partial_path, file_path)
 
 
 def read_csv(file_path):
-    """Read a pickled csv file"""
-    csv_file = pickle.load(open(file_path, 'rb')).splitlines()
-    reader = csv.reader(csv_file)
-    return reader, len(csv_file)
+    """Read a (small) csv file, return a reader over its rows and the amount of rows"""
+    with open(file_path, newline='', encoding='utf-8') as csvfile:
+        rows = list(csv.reader(csvfile))
+    return iter(rows), len(rows)
+
+
+def read_csv_chunks(file_path, chunksize=CSV_CHUNK_SIZE, **kwargs):
+    """Read a csv file without loading it in memory, as an iterator of dfs of at most chunksize rows"""
+    return pd.read_csv(file_path, chunksize=chunksize, encoding='utf-8', **kwargs)
+
+
+def count_lines(file_path):
+    """Count the lines of a file, scanning it in blocks"""
+    lines = 0
+    with open(file_path, 'rb') as fp:
+        for block in iter(lambda: fp.read(SCAN_BLOCK_SIZE), b''):
+            lines += block.count(b'\n')
+    return lines
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Utilities to download data over HTTP, through an on-disk cache shared by all the crawlers
+
+Response bodies are stored content-addressed (by their sha256) in CACHE_DIR/objects, while CACHE_DIR/urls holds,
+for each downloaded url, the digest of its latest body and its validators (ETag, Last-Modified). Cached urls are
+revalidated with conditional requests, so unchanged resources are not downloaded again
+"""
+
+import hashlib
+import json
+import logging
+import os
+import requests
+import tempfile
+
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = 'dump/cache'
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+_session = None
+_session_pid = None
+
+
+def get_session():
+    """Return the HTTP session of this process (pooled connections, retries on failures, gzip transfer)"""
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        retries = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=retries)
+        _session = requests.Session()
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+        _session.headers['Accept-Encoding'] = 'gzip, deflate'
+        _session_pid = os.getpid()
+    return _session
+
+
+def fetch(url, revalidate=True, cache_dir=CACHE_DIR):
+    """
+    Return the path of the cached body of url, downloading it only if needed
+
+    If the url was already downloaded and revalidate is False, the cached body is returned without any request,
+    otherwise a conditional request is performed and the body is downloaded only if changed
+    Raise requests.HTTPError if the resource is not available
+    """
+    entry = read_entry(url, cache_dir)
+    cached_path = get_object_path(entry['digest'], cache_dir) if entry else None
+    headers = {}
+    if cached_path and cached_path.exists():
+        if not revalidate:
+            return cached_path
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    with get_session().get(url, headers=headers, stream=True) as ret:
+        if ret.status_code == 304:
+            logger.info(f"Not modified, using cached {url}")
+            return cached_path
+        ret.raise_for_status()
+        logger.info(f"Downloading {url}...")
+        digest = store_object(ret.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE), cache_dir)
+        entry = {
+            'url': url,
+            'digest': digest,
+            'etag': ret.headers.get('ETag'),
+            'last_modified': ret.headers.get('Last-Modified')
+        }
+    write_entry(entry, cache_dir)
+    return get_object_path(digest, cache_dir)
+
+
+def store_object(chunks, cache_dir=CACHE_DIR):
+    """Store a body (iterable of bytes chunks) in the cache, return its digest (nothing is left if it fails)"""
+    objects_dir = Path(cache_dir, 'objects')
+    objects_dir.mkdir(parents=True, exist_ok=True)
+    sha256 = hashlib.sha256()
+    fp = tempfile.NamedTemporaryFile(dir=objects_dir, delete=False)
+    try:
+        with fp:
+            for chunk in chunks:
+                sha256.update(chunk)
+                fp.write(chunk)
+        digest = sha256.hexdigest()
+        object_path = get_object_path(digest, cache_dir)
+        object_path.parent.mkdir(exist_ok=True)
+        os.replace(fp.name, object_path)
+    except BaseException:
+        Path(fp.name).unlink(missing_ok=True)
+        raise
+    return digest
+
+
+def get_object_path(digest, cache_dir=CACHE_DIR):
+    """Return the path of a cached body given its digest"""
+    return Path(cache_dir, 'objects', digest[:2], digest)
+
+
+def get_entry_path(url, cache_dir=CACHE_DIR):
+    """Return the path of the cache entry of an url"""
+    return Path(cache_dir, 'urls', hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+
+def read_entry(url, cache_dir=CACHE_DIR):
+    """Return the cache entry of an url (None if never downloaded)"""
+    entry_path = get_entry_path(url, cache_dir)
+    if not entry_path.exists():
+        return None
+    with open(entry_path) as fp:
+        return json.load(fp)
+
+
+def write_entry(entry, cache_dir=CACHE_DIR):
+    """Write (atomically) the cache entry of an url"""
+    entry_path = get_entry_path(entry['url'], cache_dir)
+    entry_path.parent.mkdir(parents=True, exist_ok=True)
+    fp = tempfile.NamedTemporaryFile('w', dir=entry_path.parent, delete=False)
+    try:
+        with fp:
+            json.dump(entry, fp)
+        os.replace(fp.name, entry_path)
+    except BaseException:
+        Path(fp.name).unlink(missing_ok=True)
+        raise
@@ -4,8 +4,12 @@
 Utilities to handle pandas DataFrame objects
 """
 
+import numpy as np
 import pandas as pd
 
+# Inferred dtypes of object columns that can be safely stored as float64 buffers
+NUMERIC_INFERRED_DTYPES = {'floating', 'integer', 'mixed-integer-float', 'decimal', 'empty'}
+
 
 def print_full(df):
     """Print the entire df, displaying all rows and columns"""
@@ -14,11 +18,42 @@ def print_full(df):
 
 
 def merge_dfs(dfs):
-    """Given two dfs, concatenate them removing duplicates"""
-    # TODO: Check if both have the same columns and fields and if there are gaps in data
-    # TODO: Support more than 2 dfs
-    dataconcat = pd.concat([dfs[0], dfs[1]])
-    return dataconcat.drop_duplicates().set_index('Timestamp').reset_index()
+    """
+    Given any number of dfs sorted by Timestamp, merge them in a single df sorted by Timestamp, one row per Timestamp
+
+    The dfs are concatenated and stably sorted in a single pass (the sorted runs are merged, as in a k-way merge).
+    Rows with the same Timestamp are combined, keeping for each column the first non-missing value (in dfs order)
+    """
+    dataconcat = pd.concat(dfs, ignore_index=True)
+    timestamps = pd.to_datetime(dataconcat['Timestamp'])
+    order = np.argsort(timestamps.to_numpy(), kind='stable')
+    dataconcat = dataconcat.take(order).assign(Timestamp=timestamps.take(order).to_numpy())
+    if dataconcat['Timestamp'].is_unique:
+        return dataconcat.reset_index(drop=True)
+    return dataconcat.groupby('Timestamp', sort=False).first().reset_index()
+
+
+def concat_on_timestamp(dfs):
+    """
+    Given dfs with a Timestamp column, align them in a single df (outer join on Timestamp) with a single concat
+
+    Duplicated Timestamps in a df are dropped (first kept), columns present in more dfs are combined keeping the first
+    non-missing value (in dfs order)
+    """
+    frames = []
+    for df in dfs:
+        frame = df.set_index('Timestamp')
+        frames.append(frame[~frame.index.duplicated()])
+    merged_df = pd.concat(frames, axis=1)
+    if merged_df.columns.has_duplicates:
+        columns = {}
+        for col in merged_df.columns.unique():
+            same_cols = merged_df.loc[:, merged_df.columns == col]
+            columns[col] = same_cols.bfill(axis=1).iloc[:, 0] if same_cols.shape[1] > 1 else same_cols.iloc[:, 0]
+        merged_df = pd.DataFrame(columns, index=merged_df.index)
+    if not merged_df.index.is_monotonic_increasing:
+        merged_df = merged_df.sort_index()
+    return merged_df.rename_axis('Timestamp').reset_index()
 
 
 def reorder_columns(df):
@@ -28,3 +63,62 @@ def reorder_columns(df):
     cols.sort()
     cols.insert(0, 'Timestamp')
     return df[cols]
+
+
+def encode_df_columns(df):
+    """
+    Encode a df as a dict of contiguous typed column buffers
+
+    Timestamps are stored as int64 nanoseconds since epoch, numeric columns as raw little-endian buffers.
+    Missing values of dtypes without a native missing representation (nullable integers/booleans) are stored
+    in a packed bit mask. Non-numeric object columns fall back to a plain list of values
+    """
+    return {'rows': len(df), 'columns': [encode_column(name, df[name]) for name in df.columns]}
+
+
+def encode_column(name, series):
+    """Encode a single df column (see encode_df_columns)"""
+    column = {'name': name}
+    if name == 'Timestamp' or pd.api.types.is_datetime64_any_dtype(series):
+        values = pd.to_datetime(series).to_numpy(dtype='datetime64[ns]').view('<i8')
+        column['dtype'] = '<M8[ns]'
+    elif pd.api.types.is_extension_array_dtype(series) and not isinstance(series.dtype, pd.CategoricalDtype):
+        # Nullable dtypes (Int64, boolean, ...): missing values are replaced by 0 and tracked by the mask
+        values = series.to_numpy(dtype=series.dtype.numpy_dtype, na_value=0)
+        column['dtype'] = series.dtype.name
+        column['mask'] = np.packbits(series.isna().to_numpy()).tobytes()
+    elif pd.api.types.is_numeric_dtype(series) or pd.api.types.is_bool_dtype(series):
+        values = series.to_numpy()
+        column['dtype'] = values.dtype.newbyteorder('<').str
+    elif pd.api.types.infer_dtype(series, skipna=True) in NUMERIC_INFERRED_DTYPES:
+        values = pd.to_numeric(series).to_numpy(dtype='float64')
+        column['dtype'] = '<f8'
+    else:
+        column['dtype'] = 'object'
+        column['data'] = series.tolist()
+        return column
+    column['data'] = np.ascontiguousarray(values, dtype=values.dtype.newbyteorder('<')).tobytes()
+    return column
+
+
+def decode_df_columns(encoded):
+    """Build a df from the output of encode_df_columns, without any per-row pass"""
+    rows = encoded['rows']
+    names = [column['name'] for column in encoded['columns']]
+    data = {column['name']: decode_column(column, rows) for column in encoded['columns']}
+    return pd.DataFrame(data, columns=names)
+
+
+def decode_column(column, rows):
+    """Decode a single column buffer (see encode_column)"""
+    dtype = column['dtype']
+    if dtype == 'object':
+        return column['data']
+    if dtype == '<M8[ns]':
+        return np.frombuffer(column['data'], dtype='<i8').view('datetime64[ns]')
+    if 'mask' in column:
+        ext_dtype = pd.api.types.pandas_dtype(dtype)
+        values = pd.array(np.frombuffer(column['data'], dtype=ext_dtype.numpy_dtype), dtype=ext_dtype)
+        values[np.unpackbits(np.frombuffer(column['mask'], dtype='u1'), count=rows).astype(bool)] = pd.NA
+        return values
+    return np.frombuffer(column['data'], dtype=dtype)
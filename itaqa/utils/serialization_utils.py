@@ -2,11 +2,61 @@
 # -*- coding: utf-8 -*-
 """
 Utilities to handle serialization
+
+AQSC files are written with the following layout, so that the stations can be listed (and their data decoded
+one by one, or memory-mapped) without reading the whole file:
+
+    +--------+---------+--------------------------------+-----+---------+---------------+--------+
+    | MAGIC  | VERSION | AQS 0 column buffers           | ... | INDEX   | INDEX LENGTH  | MAGIC  |
+    | 6 B    | uint16  | raw, 64 B aligned              |     | msgpack | uint64        | 6 B    |
+    +--------+---------+--------------------------------+-----+---------+---------------+--------+
+
+The index holds, for each station, everything but the data (name, address, geolocation, metadata), a summary of
+the data (pollutants, rows, time range) and its segments. A segment is a time slice of the station data: its rows,
+time range and the description of each data column (dtype, offset and size of the buffer in the file). Column
+buffers use the encoding of pandas_utils.encode_df_columns, so numeric columns can be exposed as zero-copy NumPy
+views over a memory-mapped file. Segments also hold the time range of each block of AQSC_BLOCK_ROWS rows: when
+loading with a time range filter, only the rows of the overlapping blocks are read from the column buffers. Object
+columns (e.g. strings) are the exception: each is stored as a single msgpack buffer per segment, so reading any of
+its rows decodes the whole column of the segment.
+Optionally, each station entry also describes its rollups (per period aggregates of each pollutant, see
+aggregation_utils.get_rollup), stored as column buffers too, so that aggregates can be read instead of computed.
+
+New time slices are appended to an existing file as additional segments, followed by a new index (the previous
+one is left in place, unused): nothing already written is modified, until the file is compacted (rewritten with
+one segment per station).
+
+AQS loaded lazily read their data (and rollups) through the file opened at loading, which stays open as long as any
+of them needs it: replacing the file (e.g. saving or compacting it) does not change the data they decode.
 """
 
+import json
+import mmap
 import msgpack
+import numpy as np
+import os
+import pandas as pd
+import struct
+import threading
+
+from enum import Enum
+from functools import partial
+from pathlib import Path
 
 from itaqa.core.AirQualityStation import AirQualityStation
+from itaqa.geography import Italy
+from itaqa.utils.pandas_utils import decode_column, decode_df_columns, encode_df_columns
+
+AQSC_FILE_MAGIC = b'ITAQAC'
+AQSC_FILE_VERSION = 3
+AQSC_FILE_HEADER = struct.Struct('<6sH')
+AQSC_FILE_TRAILER = struct.Struct('<Q6s')
+AQSC_BUFFER_ALIGNMENT = 64
+# Rows of a block with its own time range in a segment (31 days of hourly data, a multiple of 8 so that blocks start
+# on a byte of the packed masks)
+AQSC_BLOCK_ROWS = 744
+# Separator of pollutant and stat in the column names of stored rollups
+ROLLUP_SEPARATOR = '|'
 
 
 def dump_AQS_to_msgpack(AQS, file_path):
@@ -21,3 +71,616 @@ def load_AQS_from_msgpack(file_path):
     with open(file_path, 'rb') as fp:
         bytedata = fp.read()
     return msgpack.unpackb(bytedata, object_hook=AirQualityStation.decode_AQS_msgpack)
+
+
+def is_AQSC_file(file_path):
+    """Check if the file uses the indexed AQSC layout (older files are a plain msgpack list of AQS)"""
+    with open(file_path, 'rb') as fp:
+        return fp.read(len(AQSC_FILE_MAGIC)) == AQSC_FILE_MAGIC
+
+
+def dump_AQSC_file(AQS_list, file_path, rollups=None):
+    """
+    Serialize a list of AQS to a file, using the indexed AQSC layout (one segment per station)
+
+    The rollups of the AQS at the specified frequencies (see AirQualityStation.get_rollup) are stored too
+
+    The file is written atomically: a temporary file is replaced to file_path only once complete, so file_path can
+    also be the file the AQS were lazily loaded from
+    """
+    tmp_path = get_tmp_path(file_path)
+    try:
+        write_AQSC_file(AQS_list, tmp_path, rollups=rollups)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, file_path)
+
+
+def write_AQSC_file(AQS_list, file_path, rollups=None):
+    """Write a list of AQS to a new file, using the indexed AQSC layout (one segment per station)"""
+    index = []
+    with open(file_path, 'wb') as fp:
+        fp.write(AQSC_FILE_HEADER.pack(AQSC_FILE_MAGIC, AQSC_FILE_VERSION))
+        for AQS in AQS_list:
+            entry = get_index_entry(AQS)
+            entry['segments'] = [write_segment(fp, AQS.data)]
+            if rollups:
+                entry['rollups'] = {freq: write_rollup(fp, AQS.get_rollup(freq)) for freq in rollups}
+            index.append(entry)
+        write_index(fp, index)
+
+
+def append_AQSC_segments(file_path, AQS_slices):
+    """
+    Append new time slices of AQS data to a file using the indexed AQSC layout, without rewriting it
+
+    Each slice is written as an additional segment of its station (stations not in the file are added), then the
+    updated index is written at the end of the file. If anything fails, the file is truncated to its original size
+
+    Args:
+        file_path (str): Path of the AQSC file
+        AQS_slices (list): List of (AQS, DataFrame) tuples, the DataFrame containing only the new rows of the AQS
+    """
+    with open(file_path, 'r+b') as fp:
+        index = read_index(fp)
+        entries = {entry['uuid']: entry for entry in index['stations']}
+        original_size = fp.seek(0, os.SEEK_END)
+        try:
+            for AQS, data in AQS_slices:
+                if data.empty:
+                    continue
+                segment = write_segment(fp, data)
+                if AQS.uuid not in entries:
+                    entry = get_index_entry(AQS)
+                    entry.update({'segments': [], 'pollutants': [], 'rows': 0, 'min_ts': None, 'max_ts': None})
+                    entries[AQS.uuid] = entry
+                    index['stations'].append(entry)
+                add_segment(entries[AQS.uuid], segment)
+            write_index(fp, index['stations'])
+        except BaseException:
+            fp.truncate(original_size)
+            raise
+
+
+def compact_AQSC_file(file_path):
+    """
+    Rewrite an AQSC file with a single segment per station, dropping unused indexes
+
+    Rollups stored in the file (dropped for the stations updated since the last save) are computed again
+
+    The compacted file replaces file_path only if the file was not modified meanwhile (e.g. a concurrent append)
+    Return True if the file was compacted
+    """
+    original_stat = os.stat(file_path)
+    tmp_path = get_tmp_path(file_path)
+    try:
+        write_AQSC_file(load_AQSC_file(file_path), tmp_path, rollups=get_rollup_frequencies(file_path))
+        current_stat = os.stat(file_path)
+        if (current_stat.st_size, current_stat.st_mtime_ns) != (original_stat.st_size, original_stat.st_mtime_ns):
+            tmp_path.unlink()
+            return False
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, file_path)
+    return True
+
+
+def get_tmp_path(file_path):
+    """Return the path of the temporary file used to write file_path atomically"""
+    return Path(file_path).with_name(f'.{Path(file_path).name}.tmp')
+
+
+def write_columns(fp, encoded):
+    """Write the buffers of encoded columns to an open file, return the column descriptors for the index"""
+    descriptors = []
+    for column in encoded['columns']:
+        descriptor = {kk: vv for kk, vv in column.items() if kk not in ('data', 'mask')}
+        if column['dtype'] == 'object':
+            descriptor['data'] = write_buffer(fp, msgpack.packb(column['data']))
+        else:
+            descriptor['data'] = write_buffer(fp, column['data'])
+        if 'mask' in column:
+            descriptor['mask'] = write_buffer(fp, column['mask'])
+        descriptors.append(descriptor)
+    return descriptors
+
+
+def write_buffer(fp, buffer):
+    """Write an aligned buffer to an open file, return its [offset, size]"""
+    fp.write(bytes(-fp.tell() % AQSC_BUFFER_ALIGNMENT))
+    offset = fp.tell()
+    fp.write(buffer)
+    return [offset, len(buffer)]
+
+
+def write_segment(fp, data):
+    """Write the column buffers of a time slice of AQS data to an open file, return the segment descriptor"""
+    min_ts, max_ts = get_time_range(data)
+    return {
+        'rows': data.shape[0],
+        'min_ts': min_ts,
+        'max_ts': max_ts,
+        'block_rows': AQSC_BLOCK_ROWS,
+        'blocks': get_blocks_time_range(data),
+        'columns': write_columns(fp, encode_df_columns(data))
+    }
+
+
+def get_blocks_time_range(data):
+    """Return the [first, last] Timestamp (ns since epoch) of each block of AQSC_BLOCK_ROWS rows of AQS data"""
+    if data.empty:
+        return []
+    ts = pd.to_datetime(data['Timestamp']).to_numpy(dtype='datetime64[ns]').view('<i8')
+    # Pad to whole blocks; NaT (and padding) never extends the time range of a block
+    pad = -len(ts) % AQSC_BLOCK_ROWS
+    nat = np.iinfo('<i8').min
+    ts = np.concatenate([ts, np.full(pad, nat, dtype='<i8')]).reshape(-1, AQSC_BLOCK_ROWS)
+    blocks_min = np.where(ts == nat, np.iinfo('<i8').max, ts).min(axis=1)
+    blocks_max = ts.max(axis=1)
+    return [[int(b_min), int(b_max)] for b_min, b_max in zip(blocks_min, blocks_max)]
+
+
+def write_index(fp, stations):
+    """Write the index at the current position of an open file (which must be its end)"""
+    footer = msgpack.packb({'version': AQSC_FILE_VERSION, 'stations': stations})
+    fp.write(footer)
+    fp.write(AQSC_FILE_TRAILER.pack(len(footer), AQSC_FILE_MAGIC))
+
+
+def add_segment(entry, segment):
+    """Add a segment to a station entry of the index, updating the summary of the data"""
+    entry['segments'] = entry['segments'] + [segment]
+    # Stored rollups do not include the new segment
+    entry.pop('rollups', None)
+    entry['rows'] += segment['rows']
+    entry['min_ts'] = min(ts for ts in (entry['min_ts'], segment['min_ts']) if ts is not None)
+    entry['max_ts'] = max(ts for ts in (entry['max_ts'], segment['max_ts']) if ts is not None)
+    for column in segment['columns']:
+        if column['name'] != 'Timestamp' and column['name'] not in entry['pollutants']:
+            entry['pollutants'].append(column['name'])
+
+
+def get_rollup_frequencies(file_path):
+    """Return the frequencies of the rollups stored in an AQSC file (none for the legacy layout)"""
+    try:
+        index = load_AQSC_index(file_path)
+    except ValueError:
+        return []
+    return sorted({freq for entry in index['stations'] for freq in entry.get('rollups', {})})
+
+
+def load_AQSC_index(file_path):
+    """Read only the index of a file using the indexed AQSC layout"""
+    with open(file_path, 'rb') as fp:
+        return read_index(fp)
+
+
+def read_index(fp):
+    """Read the index from an open file using the indexed AQSC layout"""
+    fp.seek(-AQSC_FILE_TRAILER.size, os.SEEK_END)
+    footer_len, magic = AQSC_FILE_TRAILER.unpack(fp.read(AQSC_FILE_TRAILER.size))
+    if magic != AQSC_FILE_MAGIC:
+        raise ValueError("Invalid AQSC file, index not found")
+    fp.seek(-AQSC_FILE_TRAILER.size - footer_len, os.SEEK_END)
+    index = msgpack.unpackb(fp.read(footer_len))
+    if index['version'] != AQSC_FILE_VERSION:
+        raise ValueError(f"Unsupported version of the AQSC layout ({index['version']}), save the AQSC again")
+    return index
+
+
+def load_AQSC_file(file_path, lazy=False, use_mmap=False, filters=None):
+    """
+    Load the AQS stored in a file using the indexed AQSC layout
+
+    If lazy, only the index is read: the data of each AQS is decoded from the file on first access
+    If use_mmap, the file is memory-mapped and the AQS columns are exposed as zero-copy NumPy views over it
+    (see AirQualityStation.get_column, only for AQS stored in a single segment), while AQS.data is built (as a
+    private copy) from them on first access
+    If filters are specified (see get_load_filters), AQS not matching them are skipped using the index and only the
+    selected columns and the blocks overlapping the time range are read (see load_AQS_filtered). If lazy, blocks are
+    read on first access too: AQS whose blocks overlap the time range but hold no row within it are kept (empty),
+    and their rows and time range are known only once the data is decoded
+    """
+    AQS_list = []
+    reader = FileReader(file_path)
+    read = reader.read
+    index = read_index(reader.fp)
+    if use_mmap:
+        mapped_file = memoryview(mmap.mmap(reader.fp.fileno(), 0, access=mmap.ACCESS_READ))
+    for entry in index['stations']:
+        if filters and not match_index_entry(entry, filters):
+            continue
+        AQS = AQS_from_index_entry(entry)
+        segments = entry['segments']
+        if filters:
+            if has_time_filter(filters) and not any(select_row_ranges(segment, filters) for segment in segments):
+                continue
+            if use_mmap:
+                read_view = partial(read_mapped, mapped_file)
+                segments_views = [read_segment(segment, read_view, filters) for segment in segments]
+                segments_views = [views for views in segments_views if views]
+                if len(segments_views) == 1:
+                    AQS.set_column_views(segments_views[0])
+                AQS.set_lazy_data(partial(load_AQS_views, segments_views),
+                                  get_filtered_summary(entry, filters, segments_views))
+            elif lazy:
+                AQS.set_lazy_data(partial(load_AQS_filtered, read, segments, filters),
+                                  get_filtered_summary(entry, filters))
+            else:
+                AQS.data = load_AQS_filtered(read, segments, filters)
+            if has_time_filter(filters):
+                if (lazy and not use_mmap) or AQS.entries:
+                    AQS_list.append(AQS)
+                continue
+            set_rollup_loaders(AQS, entry, read)
+            AQS_list.append(AQS)
+            continue
+        if use_mmap:
+            segments_views = [get_segment_views(segment, mapped_file) for segment in segments]
+            if len(segments_views) == 1:
+                AQS.set_column_views(segments_views[0])
+            loader = partial(load_AQS_views, segments_views)
+        else:
+            loader = partial(load_AQS_data, read, segments)
+        if lazy or use_mmap:
+            AQS.set_lazy_data(loader, get_data_summary(entry))
+        else:
+            AQS.data = loader()
+        set_rollup_loaders(AQS, entry, read)
+        AQS_list.append(AQS)
+    return AQS_list
+
+
+class FileReader():
+    """
+    Reader of the buffers of a file, kept open as long as the reader is referenced (e.g. by the loaders of lazy AQS)
+
+    Reads are serialized, so the loaders can run in different threads
+    """
+    def __init__(self, file_path):
+        self.fp = open(file_path, 'rb')
+        self._lock = threading.Lock()
+
+    def __del__(self):
+        if hasattr(self, 'fp'):
+            self.fp.close()
+
+    def read(self, offset, size):
+        """Read a buffer from the file"""
+        with self._lock:
+            return read_buffer(self.fp, offset, size)
+
+
+def set_rollup_loaders(AQS, entry, read):
+    """Let the AQS read from the file the rollups stored in its index entry (see AirQualityStation.get_rollup)"""
+    for freq, rollup in entry.get('rollups', {}).items():
+        AQS.set_rollup_loader(freq, partial(load_rollup, read, rollup))
+
+
+def write_rollup(fp, rollup):
+    """Write the columns of a rollup (columns: pollutant, stat) to an open file, return its descriptor"""
+    rollup = rollup.set_axis([f'{pl}{ROLLUP_SEPARATOR}{stat}' for pl, stat in rollup.columns], axis=1)
+    rollup = rollup.rename_axis('Timestamp').reset_index()
+    return {'rows': rollup.shape[0], 'columns': write_columns(fp, encode_df_columns(rollup))}
+
+
+def load_rollup(read, rollup):
+    """Decode a rollup stored in a file, using read(offset, size) to get the buffers"""
+    df = decode_df_columns(read_columns(rollup, read)).set_index('Timestamp')
+    df.columns = pd.MultiIndex.from_tuples([tuple(col.rsplit(ROLLUP_SEPARATOR, 1)) for col in df.columns])
+    return df
+
+
+def get_load_filters(min_dt=None, max_dt=None, pollutants=None, regions=None, provinces=None, stations=None):
+    """
+    Return the filters to apply while loading an AQSC (None if no filter is specified)
+
+    Args:
+        min_dt (datetime): First Timestamp to load
+        max_dt (datetime): Last Timestamp to load
+        pollutants (list): Pollutants (names or Pollutant) to load, AQS measuring none of them are skipped
+        regions (list): Italy.Region of the AQS to load
+        provinces (list): Italy.Province of the AQS to load
+        stations (list): Names or uuids of the AQS to load
+    Single values are accepted instead of lists
+    """
+    def as_set(values, convert):
+        if values is None:
+            return None
+        if isinstance(values, (str, Enum)) or not hasattr(values, '__iter__'):
+            values = [values]
+        return {convert(value) for value in values}
+
+    filters = {
+        'min_ts': None if min_dt is None else pd.Timestamp(min_dt).value,
+        'max_ts': None if max_dt is None else pd.Timestamp(max_dt).value,
+        'pollutants': as_set(pollutants, lambda pl: pl.name if isinstance(pl, Enum) else pl),
+        'regions': as_set(regions, lambda region: region.value),
+        'provinces': as_set(provinces, lambda province: province.value),
+        'stations': as_set(stations, str)
+    }
+    if all(value is None for value in filters.values()):
+        return None
+    return filters
+
+
+def has_time_filter(filters):
+    """Check if the filters select a time range"""
+    return filters['min_ts'] is not None or filters['max_ts'] is not None
+
+
+def overlaps_time_filter(min_ts, max_ts, filters):
+    """Check if a time range (ns since epoch, None if there is no data) overlaps the time range of the filters"""
+    if not has_time_filter(filters):
+        return True
+    if min_ts is None or max_ts is None:
+        return False
+    return ((filters['min_ts'] is None or max_ts >= filters['min_ts'])
+            and (filters['max_ts'] is None or min_ts <= filters['max_ts']))
+
+
+def match_index_entry(entry, filters):
+    """Check, using only its index entry, if an AQS may match the filters"""
+    if filters['regions'] is not None and entry['region'] not in filters['regions']:
+        return False
+    if filters['provinces'] is not None and entry['province'] not in filters['provinces']:
+        return False
+    if filters['stations'] is not None and not {entry['name'], entry['uuid']} & filters['stations']:
+        return False
+    if filters['pollutants'] is not None and not set(entry['pollutants']) & filters['pollutants']:
+        return False
+    return overlaps_time_filter(entry['min_ts'], entry['max_ts'], filters)
+
+
+def filter_AQS_list(AQS_list, filters):
+    """Apply the filters to already decoded AQS (files not using the indexed AQSC layout)"""
+    filtered_AQS_list = []
+    for AQS in AQS_list:
+        if match_index_entry(get_index_entry(AQS), filters):
+            AQS.data = filter_data(AQS.data, filters)
+            if not has_time_filter(filters) or AQS.entries:
+                filtered_AQS_list.append(AQS)
+    return filtered_AQS_list
+
+
+def filter_data(data, filters):
+    """Apply the pollutants and time range filters to AQS data"""
+    if filters['pollutants'] is not None:
+        data = data[[col for col in data.columns if col == 'Timestamp' or col in filters['pollutants']]]
+    if has_time_filter(filters):
+        ts = pd.to_datetime(data['Timestamp'])
+        keep = pd.Series(True, index=data.index)
+        if filters['min_ts'] is not None:
+            keep &= ts >= pd.Timestamp(filters['min_ts'])
+        if filters['max_ts'] is not None:
+            keep &= ts <= pd.Timestamp(filters['max_ts'])
+        data = data[keep].reset_index(drop=True)
+    return data
+
+
+def select_row_ranges(segment, filters):
+    """Return the [start, stop) row ranges of the blocks of a segment overlapping the time range of the filters"""
+    if not segment['rows'] or not overlaps_time_filter(segment['min_ts'], segment['max_ts'], filters):
+        return []
+    if not has_time_filter(filters) or not segment.get('blocks'):
+        return [(0, segment['rows'])]
+    ranges = []
+    block_rows = segment['block_rows']
+    for idx, (block_min, block_max) in enumerate(segment['blocks']):
+        if overlaps_time_filter(block_min, block_max, filters):
+            start, stop = idx * block_rows, min((idx + 1) * block_rows, segment['rows'])
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], stop)
+            else:
+                ranges.append((start, stop))
+    return ranges
+
+
+def read_segment(segment, read, filters):
+    """
+    Read and decode only the rows and columns (Timestamp and the pollutants of the filters) of a segment selected by
+    the filters
+
+    Only the blocks overlapping the time range are read (using read(offset, size)), then their rows are filtered by
+    Timestamp (as a slice, keeping views over the buffers, if the selected rows are contiguous)
+    Return a dict with the decoded columns (empty if no row is selected)
+    """
+    ranges = select_row_ranges(segment, filters)
+    if not ranges:
+        return {}
+    rows = sum(stop - start for start, stop in ranges)
+    decoded = {}
+    for descriptor in segment['columns']:
+        name = descriptor['name']
+        if filters['pollutants'] is not None and name != 'Timestamp' and name not in filters['pollutants']:
+            continue
+        decoded[name] = decode_column(read_column_rows(descriptor, read, ranges, segment['rows']), rows)
+    return filter_time_range(decoded, filters)
+
+
+def read_column_rows(descriptor, read, ranges, rows):
+    """
+    Read only the rows in ranges of an encoded column (see read_columns)
+
+    Object columns are packed in a single msgpack buffer: the whole column is read and unpacked to extract the rows
+    """
+    column = dict(descriptor)
+    offset = descriptor['data'][0]
+    if column['dtype'] == 'object':
+        values = msgpack.unpackb(read(*descriptor['data']))
+        column['data'] = [value for start, stop in ranges for value in values[start:stop]]
+        return column
+    if ranges == [(0, rows)]:
+        column['data'] = read(*descriptor['data'])
+    else:
+        itemsize = get_column_itemsize(column['dtype'])
+        parts = [read(offset + start * itemsize, (stop - start) * itemsize) for start, stop in ranges]
+        column['data'] = parts[0] if len(parts) == 1 else b''.join(parts)
+    if 'mask' in descriptor:
+        # Ranges start on a byte of the mask (AQSC_BLOCK_ROWS is a multiple of 8)
+        mask = np.unpackbits(np.frombuffer(read(*descriptor['mask']), dtype='u1'), count=rows).astype(bool)
+        column['mask'] = np.packbits(np.concatenate([mask[start:stop] for start, stop in ranges])).tobytes()
+    return column
+
+
+def get_column_itemsize(dtype):
+    """Return the size in bytes of a value of an encoded column"""
+    if dtype == '<M8[ns]':
+        return 8
+    dtype = pd.api.types.pandas_dtype(dtype)
+    return getattr(dtype, 'numpy_dtype', dtype).itemsize
+
+
+def filter_time_range(columns, filters):
+    """Keep only the rows of decoded columns in the time range of the filters"""
+    if not has_time_filter(filters) or 'Timestamp' not in columns:
+        return columns
+    ts = columns['Timestamp'].view('<i8')
+    keep = np.ones(len(ts), dtype=bool)
+    if filters['min_ts'] is not None:
+        keep &= ts >= filters['min_ts']
+    if filters['max_ts'] is not None:
+        keep &= ts <= filters['max_ts']
+    if keep.all():
+        return columns
+    rows = np.flatnonzero(keep)
+    if not len(rows):
+        return {}
+    if rows[-1] - rows[0] + 1 == len(rows):
+        rows = slice(rows[0], rows[-1] + 1)
+    elif any(isinstance(values, list) for values in columns.values()):
+        # Object columns are decoded as lists
+        columns = {name: np.asarray(values, dtype=object) if isinstance(values, list) else values
+                   for name, values in columns.items()}
+    return {name: values[rows] for name, values in columns.items()}
+
+
+def get_filtered_summary(entry, filters, segments_columns=None):
+    """
+    Return the summary of the AQS data selected by the filters (see AirQualityStation.set_lazy_data)
+
+    With a time range filter, rows and time range are included only if the columns read from the segments are given
+    """
+    pollutants = entry['pollutants']
+    if filters['pollutants'] is not None:
+        pollutants = [pollutant for pollutant in pollutants if pollutant in filters['pollutants']]
+    summary = {'pollutants': pollutants}
+    if segments_columns is not None:
+        ts = [columns['Timestamp'].view('<i8') for columns in segments_columns if columns]
+        ts = np.concatenate(ts) if ts else np.empty(0, dtype='<i8')
+        valid_ts = ts[ts != np.iinfo('<i8').min]
+        summary.update({
+            'rows': len(ts),
+            'min_ts': int(valid_ts.min()) if len(valid_ts) else None,
+            'max_ts': int(valid_ts.max()) if len(valid_ts) else None
+        })
+    elif not has_time_filter(filters):
+        summary.update({kk: entry[kk] for kk in ('rows', 'min_ts', 'max_ts')})
+    return summary
+
+
+def load_AQS_filtered(read, segments, filters):
+    """Decode the data of a single AQS stored in a file, reading only what is selected by the filters"""
+    segments_columns = [read_segment(segment, read, filters) for segment in segments]
+    frames = [pd.DataFrame(columns, copy=True) for columns in segments_columns if columns]
+    if not frames:
+        names = dict.fromkeys(column['name'] for segment in segments for column in segment['columns'])
+        if filters['pollutants'] is not None:
+            names = [name for name in names if name == 'Timestamp' or name in filters['pollutants']]
+        return pd.DataFrame(columns=list(names))
+    return concat_segments(frames)
+
+
+def read_mapped(mapped_file, offset, size):
+    """Read a buffer from a memory-mapped file, as a zero-copy view"""
+    return mapped_file[offset:offset + size]
+
+
+def get_segment_views(segment, mapped_file):
+    """Return a dict with the columns of a segment as NumPy views over a memory-mapped file"""
+    encoded = read_columns(segment, lambda offset, size: mapped_file[offset:offset + size])
+    return {column['name']: decode_column(column, encoded['rows']) for column in encoded['columns']}
+
+
+def load_AQS_views(segments_views):
+    """Build the data of a single AQS from the views over its segments"""
+    return concat_segments([pd.DataFrame(views, copy=True) for views in segments_views])
+
+
+def concat_segments(frames):
+    """Concatenate the dfs of the segments of a station, sorted by Timestamp"""
+    if len(frames) == 1:
+        return frames[0]
+    data = pd.concat(frames, ignore_index=True)
+    if not data['Timestamp'].is_monotonic_increasing:
+        data = data.sort_values(by='Timestamp', kind='mergesort', ignore_index=True)
+    return data
+
+
+def read_columns(entry, read):
+    """Read the encoded columns of an index entry, using read(offset, size) to get the buffers"""
+    columns = []
+    for descriptor in entry['columns']:
+        column = dict(descriptor)
+        column['data'] = read(*descriptor['data'])
+        if column['dtype'] == 'object':
+            column['data'] = msgpack.unpackb(column['data'])
+        if 'mask' in descriptor:
+            column['mask'] = read(*descriptor['mask'])
+        columns.append(column)
+    return {'rows': entry['rows'], 'columns': columns}
+
+
+def load_AQS_data(read, segments):
+    """Decode the data of a single AQS stored in a file, using read(offset, size) to get the buffers"""
+    return concat_segments([decode_df_columns(read_columns(segment, read)) for segment in segments])
+
+
+def read_buffer(fp, offset, size):
+    """Read a buffer from an open file"""
+    fp.seek(offset)
+    return fp.read(size)
+
+
+def get_index_entry(AQS):
+    """Return the index entry of an AQS (all but its segments)"""
+    min_ts, max_ts = AQS.time_range
+    return {
+        'uuid': AQS.uuid,
+        'name': AQS.name,
+        'region': AQS.region.value,
+        'province': AQS.province.value,
+        'comune': AQS.comune,
+        'geolocation': AQS.geolocation,
+        'metadata': json.dumps(AQS.metadata),
+        'pollutants': AQS.pollutants,
+        'rows': AQS.entries,
+        'min_ts': None if pd.isna(min_ts) else min_ts.value,
+        'max_ts': None if pd.isna(max_ts) else max_ts.value
+    }
+
+
+def get_time_range(data):
+    """Return the first and last Timestamp of AQS data, as ns since epoch (None if empty)"""
+    if data.empty:
+        return None, None
+    ts = pd.to_datetime(data['Timestamp'])
+    return ts.min().value, ts.max().value
+
+
+def get_data_summary(entry):
+    """Extract from an index entry the summary of the AQS data"""
+    return {kk: entry[kk] for kk in ('pollutants', 'rows', 'min_ts', 'max_ts')}
+
+
+def AQS_from_index_entry(entry):
+    """Create an AQS (without data) from an index entry"""
+    AQS = AirQualityStation(entry['name'])
+    AQS.region = Italy.Region(entry['region'])
+    AQS.province = Italy.Province(entry['province'])
+    AQS.comune = entry['comune']
+    AQS.geolocation = entry['geolocation']
+    AQS.metadata = json.loads(entry['metadata'])
+    return AQS
@@ -4,14 +4,46 @@
 Definition of visualization-related constants and values
 """
 
+import math
+import plotly.graph_objects as go
+import plotly.io as pio
+
+from pandas import Timestamp as pd_ts
+
+# Name of the plotly template shared by all the plots (see get_template)
+TEMPLATE_NAME = 'itaqa'
+
 SUBPLOT_LAYOUT = {(4, 4): (2, 2), (5, 6): (3, 2), (7, 8): (4, 2), (9, 9): (3, 3)}
 
+# COVID-19 lockdown milestones in Italy (first cases in Lombardia, lockdown of Lombardia, national lockdown)
+LOCKDOWN_DATES = {
+    'first_cases': pd_ts(year=2020, month=2, day=21),
+    'lombardia_lockdown': pd_ts(year=2020, month=3, day=8),
+    'national_lockdown': pd_ts(year=2020, month=3, day=21)
+}
+
 
 def get_geometry_from_subplots_amount(subplots):
     """Return the correspondant geometry (rows, cols) depending on the amount of pollutants to plot"""
     for k, v in SUBPLOT_LAYOUT.items():
         if subplots >= k[0] and subplots <= k[1]:
             return v
+    # More subplots than pollutants (e.g. a subplot per station): grid as square as possible
+    cols = math.ceil(math.sqrt(subplots))
+    return math.ceil(subplots / cols), cols
+
+
+def get_template():
+    """
+    Return the name of the layout template shared by all the plots, registering it in plotly on first use
+
+    The template is built once per process and figures refer to it by name (cheap to create and to export in batch)
+    """
+    if TEMPLATE_NAME not in pio.templates:
+        template = go.layout.Template(pio.templates['none'])
+        template.layout.plot_bgcolor = 'rgba(0,0,0,0.04)'
+        pio.templates[TEMPLATE_NAME] = template
+    return TEMPLATE_NAME
 
 
 def get_pollutant_color(pollutant):
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Downsampling of time series for plotting
+
+Series longer than the points budget of a plot are reduced keeping their visual shape:
+- lttb: Largest-Triangle-Three-Buckets, one point per bucket, the one forming the largest triangle with the
+  neighbouring buckets (smooth lines, peaks mostly preserved)
+- minmax: minimum and maximum of each bucket (every peak preserved)
+"""
+
+import numpy as np
+import pandas as pd
+
+# Points drawn for each series (about the horizontal resolution of a plot, in pixels)
+DEFAULT_POINTS = 2000
+
+
+def downsample(x, y, n_out=DEFAULT_POINTS, method='lttb'):
+    """
+    Reduce a series to about n_out points with the specified method ('lttb' or 'minmax')
+
+    x must be sorted (numeric or datetime64), missing values of y are dropped
+    Return the downsampled x, y (the original arrays if already within n_out points)
+    """
+    x, y = np.asarray(x), to_float_array(y)
+    valid = ~np.isnan(y)
+    if not valid.all():
+        x, y = x[valid], y[valid]
+    if len(x) <= n_out or n_out < 3:
+        return x, y
+    if method == 'lttb':
+        idx = lttb_indices(x, y, n_out)
+    elif method == 'minmax':
+        idx = minmax_indices(y, n_out)
+    else:
+        raise ValueError(f"Unknown downsampling method ({method})")
+    return x[idx], y[idx]
+
+
+def to_float_array(y):
+    """Return the values as a float64 array, missing values (also pd.NA of nullable dtypes, e.g. Int64) as NaN"""
+    return pd.Series(y).to_numpy(dtype='float64', na_value=np.nan)
+
+
+def get_bucket_edges(length, n_buckets):
+    """Return the edges of n_buckets buckets of (about) equal size splitting length points"""
+    return np.linspace(0, length, n_buckets + 1).astype('int64')
+
+
+def lttb_indices(x, y, n_out):
+    """Return the indices of the points selected by LTTB (first and last point always included)"""
+    x = x.view('int64') if np.issubdtype(x.dtype, np.datetime64) else x
+    x = x.astype('float64')
+    # First and last point are buckets on their own, the others are split in n_out - 2 buckets
+    edges = get_bucket_edges(len(x) - 2, n_out - 2) + 1
+    idx = np.empty(n_out, dtype='int64')
+    idx[0], idx[-1] = 0, len(x) - 1
+    # Average point of each bucket (the third vertex of the triangles of the previous bucket)
+    sums_x, sums_y = np.add.reduceat(x[1:-1], edges[:-1] - 1), np.add.reduceat(y[1:-1], edges[:-1] - 1)
+    counts = np.diff(edges)
+    avg_x = np.append(sums_x / counts, x[-1])
+    avg_y = np.append(sums_y / counts, y[-1])
+    prev = 0
+    for bucket in range(n_out - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        # Twice the area of the triangles (previous selected point, candidate, average of the next bucket)
+        areas = np.abs((x[prev] - avg_x[bucket + 1]) * (y[start:stop] - y[prev]) -
+                       (x[prev] - x[start:stop]) * (avg_y[bucket + 1] - y[prev]))
+        prev = start + np.argmax(areas)
+        idx[bucket + 1] = prev
+    return idx
+
+
+def minmax_indices(y, n_out):
+    """Return the indices (sorted) of the minimum and maximum of n_out / 2 buckets"""
+    edges = get_bucket_edges(len(y), n_out // 2)
+    idx = []
+    for start, stop in zip(edges[:-1], edges[1:]):
+        bucket = y[start:stop]
+        idx.extend(sorted((start + np.argmin(bucket), start + np.argmax(bucket))))
+    return np.unique(idx)
+
+
+def select_range(x, y, x_range, n_out=DEFAULT_POINTS, method='lttb'):
+    """Downsample only the part of a series within x_range (plus a point per side, to draw lines to the edges)"""
+    x = np.asarray(x)
+    bounds = np.asarray(x_range, dtype=x.dtype)
+    start = max(np.searchsorted(x, bounds[0], side='left') - 1, 0)
+    stop = min(np.searchsorted(x, bounds[1], side='right') + 1, len(x))
+    return downsample(x[start:stop], to_float_array(y)[start:stop], n_out, method)
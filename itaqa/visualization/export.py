@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batch export of the plots of an AQSC to files (HTML or static images)
+
+Plots are rendered in a process pool: each worker loads the AQSC file once (lazily, decoding only the data of the
+stations it renders) and builds its figures on the shared layout template (see defs.get_template)
+HTML files share a single copy of plotly.js, written in the output folder
+Static images (png, svg, pdf) require the kaleido package (the 'images' extra of the project)
+"""
+
+import importlib.util
+import logging
+import os
+import re
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from plotly.offline import get_plotlyjs
+
+from itaqa.core.AirQualityStationCollection import AirQualityStationCollection
+from itaqa.visualization import plotting
+from itaqa.visualization.defs import get_template
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('html', 'png', 'svg', 'pdf')
+PLOTLYJS_FILENAME = 'plotly.min.js'
+
+# AQSC loaded by each worker of the pool (see init_worker)
+_worker_AQSC = None
+
+
+def check_export_format(fmt):
+    """Check that a format is supported and that the package needed to render it is installed"""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format ({fmt}), available: {', '.join(EXPORT_FORMATS)}")
+    if fmt != 'html' and importlib.util.find_spec('kaleido') is None:
+        raise ImportError(f"Export to {fmt} requires the kaleido package: install it (pip install kaleido) or the "
+                          f"'images' extra of the project (poetry install -E images)")
+
+
+def get_export_filename(AQS, fmt):
+    """Return the file name of the plot of an AQS (name, made safe for file systems, and short uuid)"""
+    name = re.sub(r'[^\w\-]+', '_', AQS.name).strip('_')
+    return f'{name}_{AQS.uuid[:8]}.{fmt}'
+
+
+def export_figure(fig, file_path, fmt):
+    """Write a figure to file_path in the specified format"""
+    if fmt == 'html':
+        # plotly.js is loaded from the output folder (see export_AQSC_file)
+        fig.write_html(str(file_path), include_plotlyjs=PLOTLYJS_FILENAME, full_html=True)
+    else:
+        fig.write_image(str(file_path), format=fmt)
+
+
+def export_AQS(AQS, out_dir, fmt='html', mode='multiple', **kwargs):
+    """Export the plot of an AQS ('single' or 'multiple' mode, see AirQualityStation.plot), return its path"""
+    if mode == 'single':
+        fig = plotting.get_AQS_figure(AQS, **kwargs)
+    elif mode == 'multiple':
+        fig = plotting.get_AQS_multifigure(AQS, **kwargs)
+    else:
+        raise ValueError(f"Unknown plot mode ({mode})")
+    file_path = Path(out_dir) / get_export_filename(AQS, fmt)
+    export_figure(fig, file_path, fmt)
+    return file_path
+
+
+def init_worker(file_path, filters):
+    """Initialize a worker of the pool: load the AQSC (lazily) and register the layout template"""
+    global _worker_AQSC
+    _worker_AQSC = AirQualityStationCollection(file_path=file_path, lazy=True, **filters)
+    get_template()
+
+
+def export_station(uuid, out_dir, fmt, mode, kwargs):
+    """Export the plot of a station of the worker AQSC, return its uuid, path and error message (None if successful)"""
+    try:
+        file_path = export_AQS(_worker_AQSC[uuid], out_dir, fmt, mode, **kwargs)
+    except Exception as err:
+        logger.error(f"Export of {uuid} failed\n{traceback.format_exc()}")
+        return uuid, None, repr(err)
+    return uuid, file_path, None
+
+
+def export_AQSC_file(file_path, out_dir, fmt='html', mode='multiple', workers=None, stations=None, **kwargs):
+    """
+    Export the plots of all the stations of an AQSC file, rendering them in a process pool
+
+    A failing station does not abort the others
+    Return a dict with as key the uuid of each station and as value (path of the plot, error message)
+
+    Args:
+        stations (list): Names of the stations to export (default all)
+        kwargs: Plot parameters (n_points, method, freq)
+    """
+    check_export_format(fmt)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if fmt == 'html':
+        (out_dir / PLOTLYJS_FILENAME).write_text(get_plotlyjs(), encoding='utf-8')
+    filters = {'stations': stations} if stations else {}
+    # Only the index is read here, the data is decoded by the workers
+    AQSC = AirQualityStationCollection(file_path=file_path, lazy=True, **filters)
+    uuids = [AQS.uuid for AQS in AQSC.AQS_list]
+    workers = workers or os.cpu_count()
+    outcomes = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(file_path, filters)) as executor:
+        # Stations are sent in chunks, to limit the inter-process communication
+        results = executor.map(partial(export_station, out_dir=out_dir, fmt=fmt, mode=mode, kwargs=kwargs),
+                               uuids,
+                               chunksize=max(1, len(uuids) // (4 * workers)))
+        for uuid, path, error in results:
+            outcomes[uuid] = (path, error)
+    return outcomes
@@ -4,25 +4,64 @@
 Visualization functions
 """
 
-from itaqa.visualization.defs import get_geometry_from_subplots_amount, get_pollutant_color
-from pandas import Timestamp as pd_ts
+from itaqa.core.defs import Pollutant
+from itaqa.utils.aggregation_utils import get_frequency
+from itaqa.visualization.defs import (LOCKDOWN_DATES, get_geometry_from_subplots_amount, get_pollutant_color,
+                                     get_template)
+from itaqa.visualization.downsampling import DEFAULT_POINTS, downsample, select_range
+from pandas import Series, isna, to_datetime
 from plotly.subplots import make_subplots
 
 import plotly.graph_objects as go
 
 
-def AQS_plot(AQS, pollutant=None):
-    """Create a single plot, with all the pollutants on the same graph area"""
-    data_lines = get_data_lines(AQS)
-    fig = go.Figure(data=data_lines)
-    fig.layout.template = 'none'
-    fig.update_layout(title=f'{AQS.name}', xaxis_title='Time', plot_bgcolor='rgba(0,0,0,0.04)')
+def AQS_plot(AQS, pollutant=None, n_points=DEFAULT_POINTS, method='lttb', widget=False, freq=None):
+    """
+    Create a single plot, with all the pollutants (or only the specified one) on the same graph area
+
+    Each series is downsampled to n_points (see downsampling.downsample)
+    If freq is specified, the means of each period are plotted instead (see get_series)
+    If widget, return a FigureWidget (for Jupyter) in which the series are downsampled again at each zoom, otherwise
+    show the figure and return it
+    """
+    series = get_series(AQS, pollutant, freq)
+    fig = get_AQS_figure(AQS, pollutant, n_points, method, series)
+    if widget:
+        fig = go.FigureWidget(fig)
+        add_zoom_downsampling(fig, series, n_points, method)
+        return fig
+    fig.show()
+    return fig
+
+
+def AQS_multiplot(AQS, n_points=DEFAULT_POINTS, method='lttb', widget=False, freq=None):
+    """
+    Create multiple subplots (1 for pollutant), automatically choosing the layout
+
+    Series are downsampled (again at each zoom, if widget) or averaged over periods of freq as in AQS_plot
+    """
+    series = get_series(AQS, freq=freq)
+    fig = get_AQS_multifigure(AQS, n_points, method, series)
+    if widget:
+        fig = go.FigureWidget(fig)
+        add_zoom_downsampling(fig, series, n_points, method)
+        return fig
     fig.show()
+    return fig
 
 
-def AQS_multiplot(AQS):
-    """Create multiple subplots (1 for pollutant), automatically choosing the layout"""
-    data_lines = get_data_lines(AQS)
+def get_AQS_figure(AQS, pollutant=None, n_points=DEFAULT_POINTS, method='lttb', series=None, freq=None):
+    """Return the figure of AQS_plot"""
+    data_lines = get_data_lines(AQS, pollutant, n_points, method, series or get_series(AQS, pollutant, freq))
+    fig = go.Figure(data=data_lines)
+    fig.update_layout(template=get_template(), title=f'{AQS.name}', xaxis_title='Time')
+    return fig
+
+
+def get_AQS_multifigure(AQS, n_points=DEFAULT_POINTS, method='lttb', series=None, freq=None):
+    """Return the figure of AQS_multiplot"""
+    series = series or get_series(AQS, freq=freq)
+    data_lines = get_data_lines(AQS, n_points=n_points, method=method, series=series)
     # Determine rows and cols depending on the subplots to visualize
     if len(data_lines) <= 3:
         rows = len(data_lines)
@@ -35,53 +74,235 @@ def AQS_multiplot(AQS):
                         horizontal_spacing=0.05 / cols,
                         vertical_spacing=0.15 / rows,
                         shared_xaxes=True,
-                        subplot_titles=([col for col in AQS.data.columns if col != 'Timestamp']))
+                        subplot_titles=list(series))
     for idx, scatter in enumerate(data_lines):
         quo, rem = divmod(idx, rows)
         fig.add_trace(scatter, row=rem + 1, col=quo + 1)
-    fig.update_layout(title=f'{AQS.name}',
+    fig.update_layout(template=get_template(),
+                      title=f'{AQS.name}',
                       title_font_size=30,
                       title_x=0.5,
-                      plot_bgcolor='rgba(0,0,0,0.04)',
                       showlegend=False)
 
-    lockdown_21_feb = pd_ts(year=2020, month=2, day=21)
-    lockdown_8_mar = pd_ts(year=2020, month=3, day=8)
-    lockdown_21_mar = pd_ts(year=2020, month=3, day=21)
-
-    #for i in range(1, len(data_lines):
-    #    import ipdb; ipdb.set_trace()
-
-    #fig.update_layout(shapes=[
-    #                            {
-    #                                'type': 'line',
-    #                                'x0': lockdown_21_feb,
-    #                                'y0': 0,
-    #                                'x1': lockdown_21_feb,
-    #                                'y1': 85,
-    #                                'line': {
-    #                                    'color': 'black',
-    #                                    'width': 2
-    #                                }
-    #                            }
-    #                        ])
+    fig.update_layout(shapes=get_lockdown_shapes(cols, AQS.time_range))
 
     # Tweak: link all x-axes when multiple columns are visualized
     for i in range(1, len(data_lines) + 1):
         fig['layout'][f'xaxis{str(i)}']['matches'] = 'x'
+    return fig
+
+
+def get_series(AQS, pollutant=None, freq=None):
+    """
+    Return a dict with as key the pollutant and as value its (Timestamp, values) arrays
+
+    If freq is specified, the values are the means of each period (read from the rollups of the AQS if available, see
+    AirQualityStation.aggregate, without decoding its data)
+    """
+    if isinstance(pollutant, Pollutant):
+        pollutant = pollutant.name
+    pollutants = [pollutant] if pollutant else AQS.pollutants
+    if freq is not None:
+        means = AQS.aggregate('resample', freq=freq, stat='mean')
+        timestamps = means.index.to_numpy()
+        return {pl: (timestamps, means[pl].to_numpy()) for pl in pollutants if pl in means.columns}
+    timestamps = to_datetime(AQS.get_column('Timestamp')).to_numpy()
+    return {pl: (timestamps, AQS.get_column(pl)) for pl in pollutants}
+
+
+def get_data_lines(AQS, pollutant=None, n_points=DEFAULT_POINTS, method='lttb', series=None):
+    """Obtain scatter lines for plotting from the data stored in the AQS, downsampled to n_points"""
+    data_lines = list()
+    for pl, (timestamps, values) in (series or get_series(AQS, pollutant)).items():
+        x, y = downsample(timestamps, values, n_points, method)
+        data_line = go.Scattergl(x=x,
+                                 y=y,
+                                 name=f'{pl}',
+                                 mode='lines+markers',
+                                 marker=dict(color='Black', size=2),
+                                 line=dict(color=get_pollutant_color(pl), width=2))
+        data_lines.append(data_line)
+    return data_lines
+
+
+def add_zoom_downsampling(fig, series, n_points=DEFAULT_POINTS, method='lttb'):
+    """
+    Downsample again the series of a FigureWidget (traces in the same order as series) when the x-axis range changes
+
+    The points within the visible range are downsampled to n_points, so details appear while zooming in
+    """
+    def update_traces(layout, x_range):
+        with fig.batch_update():
+            for trace, (timestamps, values) in zip(fig.data, series.values()):
+                if x_range is None:
+                    x, y = downsample(timestamps, values, n_points, method)
+                else:
+                    x, y = select_range(timestamps, values, x_range, n_points, method)
+                trace.x, trace.y = x, y
+
+    fig.layout.on_change(update_traces, 'xaxis.range')
+
+
+def AQSC_plot(AQSC,
+              pollutant,
+              mode='overlay',
+              stations=None,
+              group_by=None,
+              n_points=DEFAULT_POINTS,
+              method='lttb',
+              lockdown=True):
+    """
+    Compare the values of a pollutant among the AQS of a collection in a single figure (shown and returned)
+
+    All the series are aligned on a common Timestamp index at once (see get_comparison_data)
+
+    Args:
+        mode (str): 'overlay' (all the series in one plot), 'multiple' (a subplot per series) or 'heatmap' (series x
+                    time, averaged over periods so that at most n_points columns are drawn, see get_heatmap_data)
+        stations (list): AQS (or names of AQS) to compare, default all the AQS measuring the pollutant
+        group_by (str/callable): Compare the mean of the AQS of each group instead (e.g. 'region', 'province')
+        lockdown (bool): Mark the lockdown dates (see defs.LOCKDOWN_DATES)
+    """
+    fig = get_AQSC_figure(AQSC, pollutant, mode, stations, group_by, n_points, method, lockdown)
     fig.show()
+    return fig
+
+
+def get_AQSC_figure(AQSC,
+                    pollutant,
+                    mode='overlay',
+                    stations=None,
+                    group_by=None,
+                    n_points=DEFAULT_POINTS,
+                    method='lttb',
+                    lockdown=True):
+    """Return the figure of AQSC_plot"""
+    if mode not in ('overlay', 'multiple', 'heatmap'):
+        raise ValueError(f"Unknown comparison plot mode ({mode})")
+    title = f'{pollutant}' + (f' by {group_by}' if isinstance(group_by, str) else '')
+    if mode == 'heatmap':
+        comparison = get_heatmap_data(AQSC, pollutant, stations, group_by, n_points)
+        fig = go.Figure(data=go.Heatmap(
+            x=comparison.index, y=comparison.columns, z=comparison.T.to_numpy(), colorscale='Viridis'))
+        cols = 1
+    else:
+        comparison = get_comparison_data(AQSC, pollutant, stations, group_by)
+        if mode == 'overlay':
+            fig = go.Figure(data=get_comparison_lines(comparison, n_points, method))
+            fig.update_layout(xaxis_title='Time')
+            cols = 1
+        else:
+            fig, cols = get_comparison_subplots(comparison, n_points, method)
+    fig.update_layout(template=get_template(), title=title, title_x=0.5)
+    if lockdown:
+        fig.update_layout(shapes=get_lockdown_shapes(cols, (comparison.index.min(), comparison.index.max())))
+    return fig
+
+
+def get_comparison_data(AQSC, pollutant, stations=None, group_by=None, wide=None):
+    """
+    Return the values of a pollutant of the AQS of a collection as a wide DataFrame
+
+    The series are aligned in a single pivot (AQSC.to_wide, unless a wide DataFrame with the same columns is given),
+    columns are labeled with the AQS names (made unique) or, if group_by, with the groups (each the mean of its AQS)
+    """
+    if wide is None:
+        wide = AQSC.to_wide(pollutant)
+    if stations is not None:
+        uuids = set()
+        for station in stations:
+            matches = AQSC.get_by_name(station) if isinstance(station, str) else [station]
+            uuids.update(AQS.uuid for AQS in matches)
+        wide = wide[[uuid for uuid in wide.columns if uuid in uuids]]
+    if group_by is not None:
+        groups = {AQS.uuid: get_label(group) for group, AQS_list in AQSC.group_by(group_by).items() for AQS in AQS_list}
+        labels = list(dict.fromkeys(groups[uuid] for uuid in wide.columns))
+        return wide.T.groupby(groups).mean().T.reindex(columns=labels)
+    names = {AQS.uuid: AQS.name for AQS in AQSC.AQS_list}
+    labels = [names[uuid] for uuid in wide.columns]
+    duplicated = {label for label in labels if labels.count(label) > 1}
+    return wide.set_axis([f'{names[uuid]} ({uuid[:8]})' if names[uuid] in duplicated else names[uuid]
+                          for uuid in wide.columns],
+                         axis=1)
+
+
+def get_label(group):
+    """Return the label of a group (the name of enum values, e.g. Italy.Region)"""
+    return getattr(group, 'name', str(group))
 
 
-def get_data_lines(AQS):
-    """Obtain scatter lines for plotting from the data stored in the AQS"""
+def get_comparison_lines(comparison, n_points=DEFAULT_POINTS, method='lttb'):
+    """Obtain a downsampled scatter line for each series of a comparison DataFrame"""
+    timestamps = comparison.index.to_numpy()
     data_lines = list()
-    for pollutant in AQS.data.columns:
-        if pollutant != 'Timestamp':
-            data_line = go.Scattergl(x=AQS.data['Timestamp'],
-                                     y=AQS.data[f'{pollutant}'],
-                                     name=f'{pollutant}',
-                                     mode='lines+markers',
-                                     marker=dict(color='Black', size=2),
-                                     line=dict(color=get_pollutant_color(pollutant), width=2))
-            data_lines.append(data_line)
+    for label in comparison.columns:
+        x, y = downsample(timestamps, comparison[label].to_numpy(), n_points, method)
+        data_lines.append(go.Scattergl(x=x, y=y, name=f'{label}', mode='lines', line=dict(width=1.5)))
     return data_lines
+
+
+def get_comparison_subplots(comparison, n_points=DEFAULT_POINTS, method='lttb'):
+    """Create a subplot per series of a comparison DataFrame (shared axes), return the figure and its columns"""
+    data_lines = get_comparison_lines(comparison, n_points, method)
+    rows, cols = get_geometry_from_subplots_amount(len(data_lines)) if len(data_lines) > 3 else (len(data_lines), 1)
+    fig = make_subplots(rows=max(rows, 1),
+                        cols=cols,
+                        horizontal_spacing=0.05 / cols,
+                        vertical_spacing=0.15 / max(rows, 1),
+                        shared_xaxes='all',
+                        shared_yaxes='all',
+                        subplot_titles=[f'{label}' for label in comparison.columns])
+    for idx, scatter in enumerate(data_lines):
+        quo, rem = divmod(idx, cols)
+        fig.add_trace(scatter, row=quo + 1, col=rem + 1)
+    fig.update_layout(showlegend=False)
+    return fig, cols
+
+
+def get_heatmap_data(AQSC, pollutant, stations=None, group_by=None, n_points=DEFAULT_POINTS):
+    """
+    Return the comparison data (see get_comparison_data) averaged over the shortest period (hour, day, week, month)
+    giving at most n_points
+
+    The period is chosen from the time range of the AQS (known without decoding their data), the means are computed
+    by AQSC.aggregate (from the rollups of the AQS, if available)
+    """
+    time_ranges = [
+        AQS.time_range for AQS in AQSC.AQS_list if pollutant in AQS.pollutants and not isna(AQS.time_range[0])
+    ]
+    time_range = [min(ts[0] for ts in time_ranges), max(ts[1] for ts in time_ranges)] if time_ranges else []
+    for freq in ('hourly', 'daily', 'weekly', 'monthly'):
+        if len(Series(0, index=to_datetime(time_range)).resample(get_frequency(freq)).size()) <= n_points:
+            break
+    wide = AQSC.aggregate(pollutant, 'resample', freq=freq, stat='mean')
+    return get_comparison_data(AQSC, pollutant, stations, group_by, wide)
+
+
+def get_lockdown_shapes(cols=1, time_range=None):
+    """
+    Return the shapes of vertical lines marking the lockdown dates on the x-axes of the first cols subplots
+
+    If time_range (first, last Timestamp of the plotted data) is specified, only the dates within it are marked, so
+    that the lines do not extend the x-axes
+    """
+    dates = list(LOCKDOWN_DATES.values())
+    if time_range is not None:
+        dates = [date for date in dates if time_range[0] <= date <= time_range[1]]
+    shapes = []
+    for col in range(1, cols + 1):
+        for date in dates:
+            shapes.append({
+                'type': 'line',
+                'xref': 'x' if col == 1 else f'x{col}',
+                'yref': 'paper',
+                'x0': date,
+                'x1': date,
+                'y0': 0,
+                'y1': 1,
+                'line': {
+                    'color': 'black',
+                    'width': 1,
+                    'dash': 'dash'
+                }
+            })
+    return shapes